@@ -0,0 +1,86 @@
+"""
+Production entry point: the Bolt app and the Spotify install callback served as an ASGI app by
+uvicorn with uvloop and httptools.
+
+    python asgi.py
+
+PORT, WEB_CONCURRENCY (worker processes), KEEP_ALIVE_TIMEOUT and GRACEFUL_SHUTDOWN_TIMEOUT tune the
+server. Shutdown fits in GRACEFUL_SHUTDOWN_TIMEOUT: uvicorn stops accepting connections and waits for
+in-flight requests, which Bolt answers within Slack's 3 second ack deadline, then the listeners Bolt
+runs after acknowledging a request get the rest of the budget to finish before the write-behind
+buffer is flushed.
+"""
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
+
+import metrics
+from listener_tracking import ListenerTracker
+from main import PORT, SpotifyClient, app, complete_spotify_install, start_background_services, stop_background_services
+
+
+GRACEFUL_SHUTDOWN_TIMEOUT = float(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
+
+# Part of the shutdown budget uvicorn waits for in-flight requests, Bolt answers them within 3 seconds
+REQUEST_DRAIN_TIMEOUT = min(3, GRACEFUL_SHUTDOWN_TIMEOUT)
+
+# Listeners Bolt keeps running after a request is acknowledged
+listeners = ListenerTracker(app)
+
+
+@asynccontextmanager
+async def lifespan(_api: FastAPI):
+    await start_background_services()
+    try:
+        yield
+    finally:
+        await listeners.drain(GRACEFUL_SHUTDOWN_TIMEOUT - REQUEST_DRAIN_TIMEOUT)
+        await stop_background_services()
+
+
+api = FastAPI(lifespan=lifespan)
+slack_handler = AsyncSlackRequestHandler(app)
+
+
+@api.post("/slack/events")
+async def slack_events(req: Request):
+    return await slack_handler.handle(req)
+
+
+@api.get("/slack/install")
+async def slack_install(req: Request):
+    return await slack_handler.handle(req)
+
+
+@api.get("/slack/oauth_redirect")
+async def slack_oauth_redirect(req: Request):
+    return await slack_handler.handle(req)
+
+
+@api.get(SpotifyClient.REDIRECT_ENDPOINT)
+async def install_spotify_callback(code: Optional[str] = None, state: Optional[str] = None):
+    status, text = await complete_spotify_install(code, state)
+    return PlainTextResponse(text, status_code=status)
+
+
+@api.get("/metrics")
+async def metrics_endpoint():
+    return JSONResponse(metrics.collect())
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "asgi:api",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=PORT,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=int(os.getenv("KEEP_ALIVE_TIMEOUT", "5")),
+        timeout_graceful_shutdown=int(REQUEST_DRAIN_TIMEOUT),
+    )
@@ -0,0 +1,294 @@
+"""
+Resumable backfills of the documents of every workspace.
+
+    python backfill.py <migration> [--team T123 ...] [--concurrency 8] [--checkpoint FILE] [--dry-run]
+    python backfill.py --list
+
+Each migration transforms the documents of one collection of workspaces/{team_id} with the models
+and returns the fields to merge, or None to leave a document alone. Documents are streamed with
+cursor pagination in pages of 500 and each page's changes are written in one batched commit, while
+the next page is read. Workspaces are migrated concurrently, up to --concurrency at a time.
+
+After each commit the page's cursor is saved to the checkpoint file (backfill_<migration>.json by
+default), so an interrupted run started again with the same arguments continues where it stopped.
+Writes update the transformed fields of each document only if it is unchanged since it was read, so
+the app keeps serving while a backfill runs: when it wrote a document of the page in the meantime,
+the page's documents are read, transformed and written again one by one. Its caches pick up
+migrated documents as they expire.
+"""
+import argparse
+import asyncio
+import json
+import os
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from pydantic import ValidationError
+
+from models.users import LEGACY_PARTICIPATION_FLAGS, User
+from models.weekly_polls import WeeklyPoll
+
+
+# Firestore batches are limited to 500 writes
+BATCH_SIZE = 500
+
+# Writes of a document changed by the app while it was migrated, before it counts as failed
+MAX_ATTEMPTS = 5
+
+
+class Migration(NamedTuple):
+    name: str
+    collection: str  # Collection under workspaces/{team_id}
+    transform: Callable[[str, dict], Optional[dict]]  # (document ID, data) -> fields to merge or None
+    description: str
+
+
+MIGRATIONS: Dict[str, Migration] = {}
+
+
+def migration(name: str, collection: str):
+    """
+    Register a transform as a migration of the documents of a collection.
+    """
+    def register(transform: Callable[[str, dict], Optional[dict]]):
+        MIGRATIONS[name] = Migration(name, collection, transform, (transform.__doc__ or "").strip())
+        return transform
+    return register
+
+
+@migration("vote_counts", collection="weekly_polls")
+def backfill_vote_counts(poll_id: str, data: dict) -> Optional[dict]:
+    """
+    Recompute vote_counts from the votes of each poll.
+    """
+    vote_counts = WeeklyPoll(**data).count_votes()
+    if vote_counts == data.get("vote_counts"):
+        return None
+    return {"vote_counts": vote_counts}
+
+
+@migration("revalidate_polls", collection="weekly_polls")
+def revalidate_poll(poll_id: str, data: dict) -> Optional[dict]:
+    """
+    Rewrite polls through the WeeklyPoll model, filling in fields added since they were saved.
+    """
+    poll_data = WeeklyPoll(**data).model_dump(mode='json')
+    return _changed_fields(data, poll_data)
+
+
+@migration("revalidate_users", collection="users")
+def revalidate_user(user_id: str, data: dict) -> Optional[dict]:
+    """
+    Rewrite users through the User model, filling in fields added since they were saved.
+    """
+    user_data = User(**data).model_dump(mode='json')
+    return _changed_fields(data, user_data)
+
+
+@migration("participation_polls", collection="users")
+def backfill_participation_polls(user_id: str, data: dict) -> Optional[dict]:
+    """
+    Replace the legacy voted and submitted flags with voted_polls and submitted_polls, as this week's general poll.
+    """
+    music_config = data.get("slack_music_config") or {}
+    if not any(flag in music_config for flag in LEGACY_PARTICIPATION_FLAGS):
+        return None
+
+    # The whole config is written, which drops the flags from the document
+    new_music_config = {field: value for field, value in music_config.items() if field not in LEGACY_PARTICIPATION_FLAGS}
+    poll_id = WeeklyPoll.generate_poll_id()
+    for flag, field in LEGACY_PARTICIPATION_FLAGS.items():
+        poll_ids = new_music_config.get(field) or []
+        if music_config.get(flag) and poll_id not in poll_ids:
+            new_music_config[field] = [*poll_ids, poll_id]
+    return {"slack_music_config": new_music_config}
+
+
+def _changed_fields(data: dict, new_data: dict) -> Optional[dict]:
+    changed = {field: value for field, value in new_data.items() if data.get(field) != value}
+    return changed or None
+
+
+class Checkpoint():
+    """
+    Progress of a backfill per team, saved as JSON after every committed page.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.teams: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.teams = json.load(checkpoint_file)
+
+    def team(self, team_id: str) -> dict:
+        return self.teams.setdefault(team_id, {"cursor": None, "done": False, "read": 0, "written": 0, "failed": 0})
+
+    def save(self):
+        # Written aside and renamed, so an interrupted run never leaves a truncated checkpoint
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(self.teams, checkpoint_file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class Backfill():
+
+    def __init__(self, migration: Migration, checkpoint: Checkpoint, concurrency: int = 8, dry_run: bool = False):
+        # Initialize Firestore client
+        self.db = firestore.AsyncClient()
+        self.migration = migration
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self, team_ids: Optional[List[str]] = None):
+        if not team_ids:
+            team_ids = [workspace_ref.id async for workspace_ref in self.db.collection("workspaces").list_documents()]
+
+        await asyncio.gather(*(self.migrate_team(team_id) for team_id in team_ids))
+
+        totals = {key: sum(progress[key] for progress in self.checkpoint.teams.values()) for key in ("read", "written", "failed")}
+        print(f"{self.migration.name}: {len(team_ids)} teams, {totals['read']} read, {totals['written']} written, {totals['failed']} failed")
+
+    async def migrate_team(self, team_id: str):
+        progress = self.checkpoint.team(team_id)
+        if progress["done"]:
+            return
+
+        async with self._semaphore:
+            collection = self.db.collection(f"workspaces/{team_id}/{self.migration.collection}")
+            # Cursor of the last page read, the checkpoint's moves in migrate_page once the page is committed
+            cursor = progress["cursor"]
+            pending_commit = None
+            while True:
+                query = collection.order_by("__name__").limit(BATCH_SIZE)
+                if cursor:
+                    query = query.start_after({"__name__": cursor})
+                page = [doc async for doc in query.stream()]
+
+                # The previous page is committed while this one is read, then checkpointed
+                if pending_commit is not None:
+                    await pending_commit
+                    self._save_checkpoint()
+
+                if not page:
+                    break
+
+                pending_commit = asyncio.create_task(self.migrate_page(team_id, page))
+                cursor = page[-1].id
+
+                if len(page) < BATCH_SIZE:
+                    await pending_commit
+                    break
+
+            progress["done"] = True
+            self._save_checkpoint()
+            print(f"{self.migration.name}: {team_id} done, {progress['written']} of {progress['read']} documents written")
+
+    def _save_checkpoint(self):
+        # A dry run leaves the checkpoint alone, so the real run still covers every document
+        if not self.dry_run:
+            self.checkpoint.save()
+
+    async def migrate_page(self, team_id: str, page: list):
+        """
+        Transform and commit a page, then count it in the team's progress and move its cursor past
+        it. A commit that fails leaves the progress as it was.
+        """
+        writes, invalid = self.transform_page(page)
+        given_up = await self.commit(writes)
+
+        progress = self.checkpoint.team(team_id)
+        progress["read"] += len(page)
+        progress["written"] += len(writes) - given_up
+        progress["failed"] += invalid + given_up
+        progress["cursor"] = page[-1].id
+
+    def transform_page(self, page: list) -> Tuple[list, int]:
+        """
+        Returns the writes of a page and how many of its documents failed validation.
+        """
+        writes = []
+        failed = 0
+        for doc in page:
+            try:
+                fields = self.migration.transform(doc.id, doc.to_dict())
+            except ValidationError as e:
+                failed += 1
+                print(f"{self.migration.name}: skipping {doc.reference.path}, {e.error_count()} validation errors")
+                continue
+            if fields:
+                writes.append((doc.reference, fields, doc.update_time))
+        return writes, failed
+
+    async def commit(self, writes: list) -> int:
+        """
+        Commit the writes of a page, returns how many of them were given up on.
+        """
+        if self.dry_run or not writes:
+            return 0
+        batch = self.db.batch()
+        for doc_ref, fields, update_time in writes:
+            batch.update(doc_ref, self._field_updates(fields), option=self.db.write_option(last_update_time=update_time))
+        try:
+            await batch.commit()
+        except FailedPrecondition:
+            # The app wrote a document of the page since it was read and the batch wrote nothing
+            given_up = 0
+            for doc_ref, _, _ in writes:
+                if not await self.migrate_document(doc_ref):
+                    given_up += 1
+            return given_up
+        return 0
+
+    async def migrate_document(self, doc_ref) -> bool:
+        """
+        Read, transform and write a document until it is unchanged between the read and the write.
+        Returns False if it kept changing.
+        """
+        for _ in range(MAX_ATTEMPTS):
+            doc = await doc_ref.get()
+            if not doc.exists:
+                return True
+            try:
+                fields = self.migration.transform(doc.id, doc.to_dict())
+            except ValidationError as e:
+                print(f"{self.migration.name}: skipping {doc_ref.path}, {e.error_count()} validation errors")
+                return False
+            if not fields:
+                return True
+            try:
+                await doc_ref.update(self._field_updates(fields), option=self.db.write_option(last_update_time=doc.update_time))
+                return True
+            except FailedPrecondition:
+                continue
+        print(f"{self.migration.name}: skipping {doc_ref.path}, changed on every one of {MAX_ATTEMPTS} attempts")
+        return False
+
+    @staticmethod
+    def _field_updates(fields: dict) -> dict:
+        # Field names are quoted, so they are never read as nested paths
+        return {FieldPath(field).to_api_repr(): value for field, value in fields.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("migration", nargs="?", choices=sorted(MIGRATIONS))
+    parser.add_argument("--list", action="store_true", help="List the available migrations")
+    parser.add_argument("--team", action="append", dest="team_ids", help="Only migrate these teams, can be repeated")
+    parser.add_argument("--concurrency", type=int, default=8, help="Teams migrated at the same time")
+    parser.add_argument("--checkpoint", help="Checkpoint file, backfill_<migration>.json by default")
+    parser.add_argument("--dry-run", action="store_true", help="Transform documents without writing them")
+    args = parser.parse_args()
+
+    if args.list or not args.migration:
+        for registered in MIGRATIONS.values():
+            print(f"{registered.name} ({registered.collection}): {registered.description}")
+    else:
+        selected = MIGRATIONS[args.migration]
+        checkpoint = Checkpoint(args.checkpoint or f"backfill_{selected.name}.json")
+        backfill = Backfill(selected, checkpoint, concurrency=args.concurrency, dry_run=args.dry_run)
+        asyncio.run(backfill.run(args.team_ids))
@@ -0,0 +1,107 @@
+"""
+Latency of a small team's clicks while a large team floods the handlers (fair_scheduler.py).
+
+    python benchmarks/bench_fairness.py --large-requests 2000
+
+A large team fires a burst of bulk requests (e.g. Home tab opens) at once, while small teams keep
+clicking at a steady pace. Handlers are simulated with a fixed service time. The small teams' p50
+and p99 latencies are reported without load, under load through the FairScheduler, and under load
+through a single shared FIFO limit (the same capacity without fairness), for comparison. Exits with
+status 1 when the small teams' p99 under load is more than --tolerance above their p99 without load.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fair_scheduler import FairScheduler, TeamPlans, TeamQuota  # noqa: E402
+from slack_dispatcher import Priority  # noqa: E402
+
+
+SMALL_TEAMS = 5
+
+
+def build_plans() -> TeamPlans:
+    return TeamPlans(
+        {
+            "standard": TeamQuota(handlers=4, max_queued=100000),
+            "enterprise": TeamQuota(handlers=32, weight=4, max_queued=100000),
+        },
+        {"TLARGE": "enterprise"},
+    )
+
+
+async def run_scenario(run, large_requests: int, clicks: int, click_interval: float) -> list:
+    latencies = []
+
+    async def click(team_id: str):
+        start = time.perf_counter()
+        await run(team_id, Priority.INTERACTIVE)
+        latencies.append(time.perf_counter() - start)
+
+    tasks = [asyncio.create_task(run("TLARGE", Priority.BULK)) for _ in range(large_requests)]
+    for index in range(clicks):
+        tasks.append(asyncio.create_task(click(f"TSMALL{index % SMALL_TEAMS}")))
+        await asyncio.sleep(click_interval)
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def fair_runner(capacity: int, service_time: float):
+    scheduler = FairScheduler("benchmark", build_plans(), "handlers", capacity=capacity)
+
+    async def run(team_id: str, priority: Priority):
+        async with scheduler.slot(team_id, priority):
+            await asyncio.sleep(service_time)
+    return run
+
+
+def fifo_runner(capacity: int, service_time: float):
+    semaphore = asyncio.Semaphore(capacity)
+
+    async def run(team_id: str, priority: Priority):
+        async with semaphore:
+            await asyncio.sleep(service_time)
+    return run
+
+
+def summarize(latencies: list) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "p50_ms": statistics.median(ordered) * 1000,
+        "p99_ms": ordered[max(0, int(len(ordered) * 0.99) - 1)] * 1000,
+    }
+
+
+async def run(args) -> dict:
+    return {
+        "idle": summarize(await run_scenario(fair_runner(args.capacity, args.service_time), 0, args.clicks, args.click_interval)),
+        "fair": summarize(await run_scenario(fair_runner(args.capacity, args.service_time), args.large_requests, args.clicks, args.click_interval)),
+        "fifo": summarize(await run_scenario(fifo_runner(args.capacity, args.service_time), args.large_requests, args.clicks, args.click_interval)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--large-requests", type=int, default=2000, help="Requests of the large team, all at once")
+    parser.add_argument("--clicks", type=int, default=100, help="Clicks of the small teams")
+    parser.add_argument("--click-interval", type=float, default=0.01, help="Seconds between clicks")
+    parser.add_argument("--service-time", type=float, default=0.02, help="Seconds a handler runs")
+    parser.add_argument("--capacity", type=int, default=16, help="Handlers running at once")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="Allowed p99 increase under load, 2.0 = 200%%")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    for name, result in results.items():
+        print(f"{name:>5}: p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms")
+
+    limit = results["idle"]["p99_ms"] * (1 + args.tolerance)
+    if results["fair"]["p99_ms"] > limit:
+        print(f"REGRESSION small teams' p99 under load {results['fair']['p99_ms']:.2f} ms, limit {limit:.2f} ms")
+        sys.exit(1)
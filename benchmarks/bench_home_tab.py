@@ -0,0 +1,272 @@
+"""
+Render cost of the Home tab (update_home_tab_view in main.py) over synthetic polls.
+
+    python benchmarks/bench_home_tab.py --iterations 50
+    python benchmarks/bench_home_tab.py --save-baseline
+
+Every scenario renders a poll of 10, 100 or 1,000 songs with up to 5,000 votes in each phase
+(submissions, voting, results), for an admin and a regular user. The stores are replaced by
+in-memory stubs and the Slack client publishes nowhere, so the numbers measure building the view.
+
+For each scenario the time per render, the memory allocated by a render (peak, with tracemalloc)
+and the size of the published view are reported. With --save-baseline the results are written to
+the baseline file (benchmarks/baselines/home_tab.json, committed with the code); later runs compare
+against it and exit with status 1 when a scenario renders slower or allocates more than the baseline
+allows (--tolerance, plus --noise-ms for render times), when it is missing from the baseline, or when its view breaks Slack's limits.
+Runs without a baseline file fail too.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Nothing is read or written, but main creates its clients on import
+for name, value in {
+    "SLACK_CLIENT_ID": "benchmark",
+    "SLACK_CLIENT_SECRET": "benchmark",
+    "SLACK_SIGNING_SECRET": "benchmark",
+    "FIRESTORE_EMULATOR_HOST": "localhost:8080",
+    "GOOGLE_CLOUD_PROJECT": "benchmark",
+    "FIRESTORE_WATCH_ENABLED": "false",
+}.items():
+    os.environ.setdefault(name, value)
+
+import main  # noqa: E402
+from home_tab import MAX_VIEW_BLOCKS, MAX_VIEW_BYTES, block_size  # noqa: E402
+from models.poll_categories import DEFAULT_CATEGORY, PollCategory  # noqa: E402
+from models.spotify_installations import SpotifyInstallation  # noqa: E402
+from models.users import UserSummary  # noqa: E402
+from models.weekly_polls import SongInfo, VoteInfo, WeeklyPoll  # noqa: E402
+
+
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baselines", "home_tab.json")
+
+TEAM_ID = "TBENCH"
+
+SONG_COUNTS = [10, 100, 1000]
+MAX_VOTES = 5000
+PHASES = ["submissions_open", "voting_open", "closed"]
+
+
+def build_users(count: int) -> dict:
+    return {
+        f"U{index:05d}": UserSummary(
+            id=f"U{index:05d}",
+            team_id=TEAM_ID,
+            name=f"user{index}",
+            image_24=f"https://avatars.example.com/{index}_24.png",
+        )
+        for index in range(count)
+    }
+
+
+def build_poll(song_count: int, vote_count: int, status: str, users: dict) -> WeeklyPoll:
+    poll_id = WeeklyPoll.generate_poll_id()
+    user_ids = list(users)
+    songs = {
+        f"song{index}": SongInfo(
+            id=f"song{index}",
+            link=f"https://open.spotify.com/track/song{index}",
+            title=f"Song number {index}",
+            artist=f"Artist {index % 50}",
+            album=f"Album {index % 20}",
+            image_url=f"https://images.example.com/song{index}.jpg",
+            submitted_by=user_ids[index % len(user_ids)],
+        )
+        for index in range(song_count)
+    }
+    # Votes lean towards the first songs, so some songs have more voters than avatars are shown
+    votes = {
+        user_id: VoteInfo(voted_for=f"song{(index * index) % song_count}", voted_at=datetime.now(), voted_by=user_id)
+        for index, user_id in enumerate(user_ids[:vote_count])
+    }
+    poll = WeeklyPoll(poll_id=poll_id, category=DEFAULT_CATEGORY, status=status, songs=songs, votes=votes)
+    return poll.model_copy(update={"vote_counts": poll.count_votes()})
+
+
+class StubUserStore():
+
+    def __init__(self, users: dict):
+        self.users = users
+
+    async def get_user_summary(self, team_id: str, user_id: str):
+        return self.users.get(user_id)
+
+
+class StubWeeklyPollsStore():
+
+    async def get_polls(self, team_id: str, poll_ids: list) -> dict:
+        return {}
+
+
+class StubPollCategoriesStore():
+
+    async def get_active_categories(self, team_id: str) -> list:
+        return [PollCategory(id=DEFAULT_CATEGORY, name="General")]
+
+
+class StubSpotifyInstallationStore():
+
+    async def get_installation(self, team_id: str):
+        return SpotifyInstallation(user_id="U00000", access_token="benchmark", refresh_token="benchmark", expires_at=0)
+
+
+class StubSlackDispatcher():
+    """
+    Calls the client right away, without rate limiting.
+    """
+
+    async def call(self, client, method: str, team_id: str, **kwargs):
+        return await getattr(client, method)(**kwargs)
+
+
+class NoopSlackClient():
+    """
+    Keeps the last published view instead of sending it to Slack.
+    """
+
+    def __init__(self):
+        self.view = None
+
+    async def views_publish(self, user_id: str, view: dict):
+        self.view = view
+
+    async def chat_postMessage(self, channel: str, text: str):
+        raise RuntimeError(f"Publishing the view failed: {text}")
+
+
+class NoopLogger():
+
+    def error(self, message: str):
+        raise RuntimeError(message)
+
+
+def install_stubs(users: dict):
+    main.user_store = StubUserStore(users)
+    main.weekly_polls_store = StubWeeklyPollsStore()
+    main.poll_categories_store = StubPollCategoriesStore()
+    main.spotify_installation_store = StubSpotifyInstallationStore()
+    main.slack_dispatcher = StubSlackDispatcher()
+    main.cache_watcher = None
+
+
+async def render(client: NoopSlackClient, app_user: UserSummary, weekly_poll: WeeklyPoll) -> dict:
+    await main.update_home_tab_view(client, app_user, weekly_poll, NoopLogger())
+    return client.view
+
+
+async def bench_scenario(app_user: UserSummary, weekly_poll: WeeklyPoll, iterations: int) -> dict:
+    client = NoopSlackClient()
+
+    # Warm up, then time renders without tracing allocations. Like timeit, the garbage collector is
+    # off while timing, so a collection of the objects of earlier scenarios doesn't land in this one
+    view = await render(client, app_user, weekly_poll)
+    timings = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await render(client, app_user, weekly_poll)
+            timings.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    await render(client, app_user, weekly_poll)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "render_ms": statistics.median(timings) * 1000,
+        "p95_ms": sorted(timings)[int(len(timings) * 0.95) - 1] * 1000 if len(timings) > 1 else timings[0] * 1000,
+        "peak_kib": peak / 1024,
+        "blocks": len(view["blocks"]),
+        "view_bytes": sum(block_size(block) for block in view["blocks"]),
+    }
+
+
+async def run(iterations: int) -> dict:
+    users = build_users(MAX_VOTES)
+    install_stubs(users)
+
+    results = {}
+    for song_count in SONG_COUNTS:
+        vote_count = min(MAX_VOTES, song_count * 5)
+        for phase in PHASES:
+            weekly_poll = build_poll(song_count, vote_count, phase, users)
+            for is_admin in (False, True):
+                # A user who hasn't voted or submitted, so every vote button is shown
+                app_user = UserSummary(id="UVIEWER", team_id=TEAM_ID, name="viewer", is_admin=is_admin)
+                name = f"{song_count}-songs/{vote_count}-votes/{phase}/{'admin' if is_admin else 'member'}"
+                results[name] = await bench_scenario(app_user, weekly_poll, iterations)
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float, noise_ms: float = 0) -> list:
+    regressions = []
+    for name, result in results.items():
+        if result["blocks"] > MAX_VIEW_BLOCKS or result["view_bytes"] > MAX_VIEW_BYTES:
+            regressions.append(f"{name}: view exceeds Slack's limits ({result['blocks']} blocks, {result['view_bytes']} bytes)")
+
+        expected = baseline.get(name)
+        if expected is None:
+            regressions.append(f"{name}: not in the baseline, save a new one with --save-baseline")
+            continue
+        # Renders of a millisecond vary by more than the tolerance from run to run
+        if result["render_ms"] > expected["render_ms"] * (1 + tolerance) + noise_ms:
+            regressions.append(f"{name}: render_ms {result['render_ms']:.2f}, baseline {expected['render_ms']:.2f}")
+        if result["peak_kib"] > expected["peak_kib"] * (1 + tolerance):
+            regressions.append(f"{name}: peak_kib {result['peak_kib']:.2f}, baseline {expected['peak_kib']:.2f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50, help="Timed renders per scenario")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare against or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown or extra allocation, 0.25 = 25%%")
+    parser.add_argument("--noise-ms", type=float, default=1.0, help="Slowdown in ms allowed on top of the tolerance")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    elif not args.save_baseline:
+        # Without a baseline a slower render would go unnoticed
+        print(f"No baseline at {args.baseline}, save one with --save-baseline")
+        sys.exit(1)
+
+    results = asyncio.run(run(args.iterations))
+
+    for name, result in results.items():
+        expected = baseline.get(name)
+        change = f"  ({(result['render_ms'] / expected['render_ms'] - 1) * 100:+5.1f}%)" if expected else ""
+        print(
+            f"{name:>46}: {result['render_ms']:7.2f} ms  p95 {result['p95_ms']:7.2f} ms  "
+            f"{result['peak_kib']:8.1f} KiB  {result['blocks']:3d} blocks  {result['view_bytes']:6d} bytes{change}"
+        )
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        sys.exit(0)
+
+    regressions = find_regressions(results, baseline, args.tolerance, args.noise_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
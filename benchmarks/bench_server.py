@@ -0,0 +1,127 @@
+"""
+Request throughput of the aiohttp development server (main.py) against the ASGI server (asgi.py).
+
+    python benchmarks/bench_server.py --requests 5000 --concurrency 50
+
+Each server is started as a subprocess and receives signed url_verification requests on
+/slack/events, which go through request verification and Bolt's middleware without touching
+Firestore or Slack, so the numbers measure the serving stack itself.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "aiohttp": [sys.executable, "main.py"],
+    "asgi": [sys.executable, "asgi.py"],
+}
+
+SIGNING_SECRET = "benchmark-signing-secret"
+
+
+def server_env(port: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+    })
+    # Nothing is read or written, but the clients need a project to be created
+    env.setdefault("SLACK_CLIENT_ID", "benchmark")
+    env.setdefault("SLACK_CLIENT_SECRET", "benchmark")
+    env.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+    env.setdefault("GOOGLE_CLOUD_PROJECT", "benchmark")
+    return env
+
+
+def signed_request() -> tuple:
+    body = json.dumps({"type": "url_verification", "token": "benchmark", "challenge": "benchmark"})
+    timestamp = str(int(time.time()))
+    signature = hmac.new(SIGNING_SECRET.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256).hexdigest()
+    headers = {
+        "Content-Type": "application/json",
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": f"v0={signature}",
+    }
+    return body, headers
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+async def run_load(port: int, total_requests: int, concurrency: int) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    latencies = []
+    errors = 0
+    remaining = total_requests
+
+    async with aiohttp.ClientSession() as session:
+        await wait_until_ready(session, f"{base_url}/metrics")
+
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                body, headers = signed_request()
+                start = time.perf_counter()
+                async with session.post(f"{base_url}/slack/events", data=body, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": errors,
+    }
+
+
+def bench(name: str, port: int, total_requests: int, concurrency: int) -> dict:
+    server = subprocess.Popen(SERVERS[name], cwd=ROOT, env=server_env(port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return asyncio.run(run_load(port, total_requests, concurrency))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--servers", nargs="+", default=list(SERVERS), choices=list(SERVERS))
+    args = parser.parse_args()
+
+    for name in args.servers:
+        result = bench(name, args.port, args.requests, args.concurrency)
+        print(
+            f"{name:>8}: {result['requests_per_second']:8.0f} req/s  "
+            f"p50 {result['p50_ms']:6.2f} ms  p99 {result['p99_ms']:6.2f} ms  errors {result['errors']}"
+        )
@@ -0,0 +1,327 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Literal, Optional, Tuple
+
+import cachetools
+from pydantic import BaseModel
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheConfig(BaseModel):
+    """
+    Cache policy for a store.
+    When max_bytes is set the cache is bounded by the estimated size of its values instead of
+    the number of entries. Entries older than ttl may still be served by get_stale for up to
+    max_stale more seconds while they are refreshed.
+    """
+    maxsize: int = 128
+    max_bytes: Optional[int] = None
+    ttl: float = 300
+    max_stale: float = 0
+    policy: Literal['lru', 'lfu'] = 'lru'
+
+    @classmethod
+    def from_env(cls, name: str, **defaults) -> 'CacheConfig':
+        """
+        Build a config from the given defaults, overridden by environment variables such as
+        CACHE_USERS_MAXSIZE, CACHE_USERS_MAX_BYTES, CACHE_USERS_TTL and CACHE_USERS_POLICY.
+        """
+        prefix = f"CACHE_{name.upper()}_"
+        values = dict(defaults)
+        for field in cls.model_fields:
+            env_value = os.getenv(prefix + field.upper())
+            if env_value is not None:
+                values[field] = env_value
+        return cls(**values)
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Rough size in bytes of a cached value, based on its JSON representation.
+    """
+    if isinstance(value, BaseModel):
+        return len(value.model_dump_json())
+    return len(json.dumps(value, default=str))
+
+
+class _EvictionTracking:
+    """
+    Mixin for cachetools caches that reports entries dropped to make room for new ones.
+    """
+
+    def __init__(self, *args, on_evict: Callable[[], None], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        item = super().popitem()
+        self._on_evict()
+        return item
+
+
+class _LRUCache(_EvictionTracking, cachetools.LRUCache):
+    pass
+
+
+class _LFUCache(_EvictionTracking, cachetools.LFUCache):
+    pass
+
+
+class StoreCache:
+    """
+    In-memory cache used by the stores.
+    Entries are kept with the time they were stored, expire after the configured TTL and are
+    evicted following the configured LRU or LFU policy. Hits, misses, evictions and expirations
+    are counted and exported through the metrics registry.
+    Expired values are remembered until they are replaced or pushed out by newer ones, so
+    get_last_known can still serve them while their source is unavailable.
+    Entries of a previous process can be restored lazily from a snapshot with restore_lazily.
+    """
+
+    def __init__(self, name: str, config: CacheConfig):
+        self.name = name
+        self.config = config
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.restored = 0
+
+        # Keys kept up to date by an external source (e.g. a Firestore listener), they never go stale
+        self._pinned = set()
+
+        # Values of expired entries, only served by get_last_known
+        self._last_known = cachetools.LRUCache(maxsize=self.capacity)
+
+        # Keys of a snapshot not read yet, with the time they were stored, and how to read them
+        self._restorable: Dict[Hashable, float] = {}
+        self._restore: Optional[Callable[[Hashable], Optional[Any]]] = None
+
+        cache_class = _LFUCache if config.policy == 'lfu' else _LRUCache
+        if config.max_bytes:
+            self._cache = cache_class(
+                maxsize=config.max_bytes,
+                getsizeof=lambda entry: estimate_size(entry[1]),
+                on_evict=self._count_eviction,
+            )
+        else:
+            self._cache = cache_class(maxsize=config.maxsize, on_evict=self._count_eviction)
+
+        metrics.register(f"cache.{name}", self.stats)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value, fresh = self._lookup(key)
+        if not fresh:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def get_stale(self, key: Hashable) -> Tuple[Optional[Any], bool]:
+        """
+        Return the cached value and whether it is still fresh.
+        A value past its TTL but within max_stale is returned with fresh=False, the caller is
+        expected to refresh it.
+        """
+        value, fresh = self._lookup(key)
+        if value is None:
+            self.misses += 1
+        elif fresh:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return value, fresh
+
+    def get_last_known(self, key: Hashable) -> Optional[Any]:
+        """
+        Return the cached value whatever its age, for when it can't be refreshed.
+        Lookups through get_last_known aren't counted as hits or misses.
+        """
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry[1]
+        return self._last_known.get(key)
+
+    def set(self, key: Hashable, value: Any):
+        self._last_known.pop(key, None)
+        self._restorable.pop(key, None)
+        try:
+            self._cache[key] = (time.time(), value)
+        except ValueError:
+            # A single value larger than max_bytes is simply not cached
+            self._cache.pop(key, None)
+
+    def pin(self, key: Hashable):
+        self._pinned.add(key)
+
+    def unpin(self, key: Hashable):
+        self._pinned.discard(key)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        self._last_known.pop(key, None)
+        self._restorable.pop(key, None)
+        entry = self._cache.pop(key, None)
+        return entry[1] if entry else None
+
+    def pop_matching(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Drop every entry whose key matches, returns how many were dropped.
+        """
+        for key in [key for key in self._last_known.keys() if predicate(key)]:
+            self._last_known.pop(key, None)
+        for key in [key for key in self._restorable if predicate(key)]:
+            self._restorable.pop(key, None)
+        keys = [key for key in self._cache.keys() if predicate(key)]
+        for key in keys:
+            self._cache.pop(key, None)
+        return len(keys)
+
+    def clear(self):
+        self._cache.clear()
+        self._last_known.clear()
+        self._restorable.clear()
+
+    @property
+    def capacity(self) -> int:
+        """
+        Approximate number of entries the cache can hold, used to bound warm-ups.
+        """
+        return self.config.maxsize if not self.config.max_bytes else self.config.max_bytes // 512
+
+    def entries(self) -> List[Tuple[Hashable, float, Any]]:
+        """
+        (key, stored_at, value) of the entries that haven't expired, e.g. to snapshot them.
+        """
+        cutoff = time.time() - self.config.ttl - self.config.max_stale
+        entries = []
+        for key in list(self._cache):
+            # Read without touching the entries' recency
+            stored_at, value = cachetools.Cache.__getitem__(self._cache, key)
+            if stored_at >= cutoff or key in self._pinned:
+                entries.append((key, stored_at, value))
+        return entries
+
+    def restore_lazily(self, keys: Dict[Hashable, float], read: Callable[[Hashable], Optional[Any]]):
+        """
+        Make the given keys (with the time their values were stored) available from a snapshot.
+        A key's value is only read, with read(key), on its first lookup, and served for what is
+        left of its TTL counted from when it was originally stored.
+        """
+        self._restorable = {key: stored_at for key, stored_at in keys.items() if key not in self._cache}
+        self._restore = read
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._cache
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _lookup(self, key: Hashable) -> Tuple[Optional[Any], bool]:
+        entry = self._cache.get(key)
+        if entry is None and self._restorable:
+            entry = self._restore_entry(key)
+        if entry is None:
+            return None, False
+
+        stored_at, value = entry
+        if key in self._pinned:
+            return value, True
+
+        age = time.time() - stored_at
+        if age > self.config.ttl + self.config.max_stale:
+            self._expire(key)
+            return None, False
+        return value, age <= self.config.ttl
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "policy": self.config.policy,
+            "ttl": self.config.ttl,
+            "maxsize": self.config.max_bytes or self.config.maxsize,
+            "size": self._cache.currsize,
+            "entries": len(self._cache),
+            "pinned": len(self._pinned),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "restored": self.restored,
+            "restorable": len(self._restorable),
+        }
+
+    def _restore_entry(self, key: Hashable) -> Optional[Tuple[float, Any]]:
+        stored_at = self._restorable.pop(key, None)
+        if stored_at is None or time.time() - stored_at > self.config.ttl + self.config.max_stale:
+            return None
+        try:
+            value = self._restore(key)
+        except Exception as e:
+            log.error("Error restoring %s from the %s snapshot: %s", key, self.name, e)
+            return None
+        if value is None:
+            return None
+
+        entry = (stored_at, value)
+        try:
+            self._cache[key] = entry
+        except ValueError:
+            return None
+        self.restored += 1
+        return entry
+
+    def _expire(self, key: Hashable):
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self._last_known[key] = entry[1]
+        self.expirations += 1
+
+    def _count_eviction(self):
+        self.evictions += 1
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls for the same key: while a call is in flight, every other caller
+    for that key waits on the same result instead of starting its own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # Shield so a cancelled caller doesn't cancel the call other callers are waiting on
+        return await asyncio.shield(self.start(key, fn))
+
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Start the call in the background unless one is already in flight, without waiting for it.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def _finish(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # Background refreshes nobody awaits must not log "exception was never retrieved"
+        if not future.cancelled():
+            future.exception()
@@ -0,0 +1,177 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from datetime import date, datetime
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+
+import metrics
+from cache import StoreCache
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheSnapshot():
+    """
+    Snapshots of the store caches in a local SQLite file, so a restarted process starts warm. The
+    file has a single entries table, with a row per cache and key holding the time the value was
+    cached and the value.
+
+    save() writes the entries of every registered cache that haven't expired, as compressed JSON,
+    keeping the newest version of each entry when several processes share the file. load() only
+    reads which keys the snapshot holds: a value is read on the first lookup of its key, and only
+    while its TTL, counted from when it was originally cached, hasn't run out.
+
+    Caches holding credentials (Slack and Spotify installations) are left out of snapshots.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Cache name -> (cache, model of its values, None for JSON values)
+        self._caches: Dict[str, Tuple[StoreCache, Optional[Type[BaseModel]]]] = {}
+        # Only used from the event loop, for the lazy reads
+        self._reader: Optional[sqlite3.Connection] = None
+
+        self.saves = 0
+        self.saved_entries = 0
+        self.loaded_keys = 0
+        self.last_save_seconds = 0.0
+
+        metrics.register("cache_snapshot", self.stats)
+
+    def register(self, cache: StoreCache, model: Optional[Type[BaseModel]] = None):
+        """
+        Include a cache in the snapshots. Its values must be JSON data, or instances of model.
+        """
+        self._caches[cache.name] = (cache, model)
+
+    def load(self) -> int:
+        """
+        Make the snapshot's entries available to the caches, returns how many keys it holds.
+        """
+        if not os.path.exists(self.path):
+            return 0
+
+        try:
+            self._reader = sqlite3.connect(self.path)
+            loaded = 0
+            for name, (cache, model) in self._caches.items():
+                cutoff = time.time() - cache.config.ttl - cache.config.max_stale
+                rows = self._reader.execute("SELECT key, stored_at FROM entries WHERE cache = ? AND stored_at >= ?", (name, cutoff)).fetchall()
+                cache.restore_lazily({self._decode_key(key): stored_at for key, stored_at in rows}, functools.partial(self._read, name, model))
+                loaded += len(rows)
+        except sqlite3.Error as e:
+            # A missing table or a damaged file only means a cold start
+            log.error("Error loading the cache snapshot %s: %s", self.path, e)
+            return 0
+
+        self.loaded_keys = loaded
+        log.info("Loaded %d cache entries from %s", loaded, self.path)
+        return loaded
+
+    async def save(self) -> int:
+        """
+        Write the entries of the registered caches, returns how many were written.
+        Entries are collected on the event loop, then encoded and written in a worker thread.
+        """
+        start = time.perf_counter()
+        entries = [
+            (name, model, key, stored_at, value)
+            for name, (cache, model) in self._caches.items()
+            for key, stored_at, value in cache.entries()
+        ]
+        cutoffs = [(name, time.time() - cache.config.ttl - cache.config.max_stale) for name, (cache, _) in self._caches.items()]
+        saved = await asyncio.to_thread(self._write, entries, cutoffs)
+
+        self.saves += 1
+        self.saved_entries = saved
+        self.last_save_seconds = time.perf_counter() - start
+        return saved
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except Exception as e:
+                log.error("Error saving the cache snapshot %s: %s", self.path, e)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def stats(self) -> dict:
+        return {
+            "saves": self.saves,
+            "saved_entries": self.saved_entries,
+            "last_save_seconds": self.last_save_seconds,
+            "loaded_keys": self.loaded_keys,
+        }
+
+    def _read(self, name: str, model: Optional[Type[BaseModel]], key: Hashable) -> Optional[Any]:
+        if self._reader is None:
+            return None
+        row = self._reader.execute("SELECT value FROM entries WHERE cache = ? AND key = ?", (name, self._encode_key(key))).fetchone()
+        if row is None:
+            return None
+        data = zlib.decompress(row[0])
+        return model.model_validate_json(data) if model is not None else json.loads(data)
+
+    def _write(self, entries: List[tuple], cutoffs: List[Tuple[str, float]]) -> int:
+        rows = [
+            (name, self._encode_key(key), stored_at, self._encode_value(value, model))
+            for name, model, key, stored_at, value in entries
+        ]
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "cache TEXT NOT NULL, key TEXT NOT NULL, stored_at REAL NOT NULL, value BLOB NOT NULL, "
+                    "PRIMARY KEY (cache, key))"
+                )
+                # Other processes may have written newer versions of the same entries
+                connection.executemany(
+                    "INSERT INTO entries (cache, key, stored_at, value) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (cache, key) DO UPDATE SET stored_at = excluded.stored_at, value = excluded.value "
+                    "WHERE excluded.stored_at > entries.stored_at",
+                    rows,
+                )
+                connection.executemany("DELETE FROM entries WHERE cache = ? AND stored_at < ?", cutoffs)
+        finally:
+            connection.close()
+        return len(rows)
+
+    @staticmethod
+    def _encode_value(value: Any, model: Optional[Type[BaseModel]]) -> bytes:
+        if isinstance(value, BaseModel):
+            data = value.model_dump_json()
+        else:
+            data = json.dumps(value, default=_json_default, separators=(",", ":"))
+        return zlib.compress(data.encode())
+
+    @staticmethod
+    def _encode_key(key: Hashable) -> str:
+        return json.dumps(key)
+
+    @staticmethod
+    def _decode_key(key: str) -> Hashable:
+        # Tuple keys come back from JSON as lists
+        decoded = json.loads(key)
+        return tuple(decoded) if isinstance(decoded, list) else decoded
+
+
+def _json_default(value: Any) -> Any:
+    # Firestore documents hold datetimes, the models parse them back from ISO strings
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from google.cloud import firestore
+
+from spotify_installation_store import SlackSpotifyInstallationStore
+from weekly_polls_store import SlackMusicWeeklyPollsStore
+
+
+class _TeamWatch:
+
+    def __init__(self, team_id: str):
+        self.team_id = team_id
+        self.last_seen = time.time()
+        # poll_id -> watch
+        self.poll_watches = {}
+        self.installation_watch = None
+
+
+class FirestoreCacheWatcher():
+    """
+    Keeps the poll and Spotify installation caches hot with Firestore real-time listeners.
+
+    Active teams get an on_snapshot watch on the weekly_polls/{poll_id} documents of their current
+    polls, one per active category, and on their spotify installation document, and every change is pushed straight into the store caches.
+    Watched entries are pinned, so reads are memory lookups that stay consistent across nodes.
+
+    At most max_teams teams are watched at once (least recently active teams are detached first)
+    and teams without activity for idle_timeout seconds are detached by run().
+    Firestore only supports listeners on the sync client, so callbacks arrive on a background thread
+    and are handed over to the event loop. Like every Firestore client, it honors
+    FIRESTORE_EMULATOR_HOST, so it can be exercised against the emulator.
+    """
+
+    def __init__(
+        self,
+        weekly_polls_store: SlackMusicWeeklyPollsStore,
+        spotify_installation_store: SlackSpotifyInstallationStore,
+        max_teams: int = 100,
+        idle_timeout: float = 900,
+        db: Optional[firestore.Client] = None,
+    ):
+        self.db = db or firestore.Client()
+        self.weekly_polls_store = weekly_polls_store
+        self.spotify_installation_store = spotify_installation_store
+        self.max_teams = max_teams
+        self.idle_timeout = idle_timeout
+
+        # team_id -> _TeamWatch, ordered from least to most recently active
+        self._watches: "OrderedDict[str, _TeamWatch]" = OrderedDict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def touch(self, team_id: str, poll_ids: List[str]):
+        """
+        Mark a team as active, watching exactly the given polls of it.
+        Must be called from the event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+
+        team_watch = self._watches.get(team_id)
+        if team_watch is None:
+            team_watch = self._attach(team_id)
+            self._watches[team_id] = team_watch
+            while len(self._watches) > self.max_teams:
+                self.detach(next(iter(self._watches)))
+
+        # A new week started or the team's categories changed, move the poll watches
+        for poll_id in [poll_id for poll_id in team_watch.poll_watches if poll_id not in poll_ids]:
+            self._unwatch_poll(team_watch, poll_id)
+        for poll_id in poll_ids:
+            if poll_id not in team_watch.poll_watches:
+                self._watch_poll(team_watch, poll_id)
+
+        team_watch.last_seen = time.time()
+        self._watches.move_to_end(team_id)
+
+    def detach(self, team_id: str):
+        team_watch = self._watches.pop(team_id, None)
+        if team_watch is None:
+            return
+
+        for poll_id in list(team_watch.poll_watches):
+            self._unwatch_poll(team_watch, poll_id)
+
+        if team_watch.installation_watch is not None:
+            team_watch.installation_watch.unsubscribe()
+        self.spotify_installation_store.unpin(team_id)
+
+    def detach_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        for team_id in [team_id for team_id, team_watch in self._watches.items() if team_watch.last_seen < cutoff]:
+            self.detach(team_id)
+
+    async def run(self, interval: float = 60):
+        """
+        Periodically detach the watches of idle teams.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.detach_idle()
+
+    def close(self):
+        for team_id in list(self._watches):
+            self.detach(team_id)
+
+    def stats(self) -> dict:
+        return {
+            "watched_teams": len(self._watches),
+            "watched_polls": sum(len(team_watch.poll_watches) for team_watch in self._watches.values()),
+        }
+
+    def _attach(self, team_id: str) -> _TeamWatch:
+        team_watch = _TeamWatch(team_id)
+
+        installation_ref = self.db.collection("workspaces").document(team_id).collection('spotify_installations').document('spotify_installation')
+        team_watch.installation_watch = installation_ref.on_snapshot(
+            lambda docs, changes, read_time: self._dispatch(self.spotify_installation_store.apply_snapshot, team_id, self._snapshot_data(docs))
+        )
+        self.spotify_installation_store.pin(team_id)
+
+        return team_watch
+
+    def _watch_poll(self, team_watch: _TeamWatch, poll_id: str):
+        team_id = team_watch.team_id
+        poll_ref = self.db.collection(f"workspaces/{team_id}/weekly_polls").document(poll_id)
+        team_watch.poll_watches[poll_id] = poll_ref.on_snapshot(
+            lambda docs, changes, read_time: self._dispatch(self.weekly_polls_store.apply_snapshot, team_id, poll_id, self._snapshot_data(docs))
+        )
+        self.weekly_polls_store.pin(team_id, poll_id)
+
+    def _unwatch_poll(self, team_watch: _TeamWatch, poll_id: str):
+        team_watch.poll_watches.pop(poll_id).unsubscribe()
+        self.weekly_polls_store.unpin(team_watch.team_id, poll_id)
+
+    def _dispatch(self, callback, *args):
+        # Called from the listener thread, the caches are only touched from the event loop
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    @staticmethod
+    def _snapshot_data(docs) -> Optional[dict]:
+        if docs and docs[0].exists:
+            return docs[0].to_dict()
+        return None
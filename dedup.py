@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import cachetools
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+import metrics
+from resilience import CircuitBreaker
+
+
+log = logging.getLogger(__name__)
+
+class FirestoreDedupBackend():
+    """
+    Shares claimed request keys between processes through Firestore.
+    # /slack_request_claims/{key}
+    create() fails if the document exists, so exactly one process wins each key. Set a Firestore TTL
+    policy on expires_at to have old claims deleted.
+    """
+
+    def __init__(self):
+        # Initialize Firestore client
+        self.db = firestore.AsyncClient()
+
+    async def claim(self, key: str, ttl: float) -> bool:
+        doc_ref = self.db.collection("slack_request_claims").document(key.replace("/", "_"))
+        try:
+            await doc_ref.create({
+                "claimed_at": firestore.SERVER_TIMESTAMP,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+            })
+        except AlreadyExists:
+            return False
+        return True
+
+
+class RequestDeduplicator():
+    """
+    Drops requests Slack delivers more than once before any handler work is done.
+
+    Events are keyed by event_id, so retries sent with X-Slack-Retry-Num are recognized, and
+    interactions by what identifies a single click or submission. Keys are remembered in memory for
+    ttl seconds and, with a shared backend, claimed across processes.
+
+    The backend is called in front of every request, through the breaker when one is given and
+    within backend_timeout seconds. When it is slow or unavailable only the in-memory check applies.
+    The breaker should be the dedup's own: a deadline this short can be missed while Firestore is
+    merely slow, which mustn't open the breaker of the stores.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 600,
+        maxsize: int = 10000,
+        backend: Optional[FirestoreDedupBackend] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        backend_timeout: float = 1.0,
+    ):
+        self.ttl = ttl
+        self.backend = backend
+        self.breaker = breaker
+        self.backend_timeout = backend_timeout
+        self._seen = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+
+        self.duplicates = 0
+        self.backend_errors = 0
+
+        metrics.register("request_dedup", self.stats)
+
+    @staticmethod
+    def build_key(body: dict) -> Optional[str]:
+        if body.get("event_id"):
+            return f"event:{body['event_id']}"
+
+        user_id = (body.get("user") or {}).get("id", "")
+        if body.get("type") == "block_actions" and body.get("actions"):
+            return f"action:{user_id}:{body['actions'][0].get('action_ts')}"
+        if body.get("type") == "view_submission" and body.get("view"):
+            return f"view:{user_id}:{body['view'].get('id')}:{body['view'].get('hash')}"
+        if body.get("command") and body.get("trigger_id"):
+            return f"command:{body['trigger_id']}"
+        return None
+
+    async def claim(self, body: dict) -> bool:
+        """
+        Whether this is the first delivery of the request, False for duplicates.
+        """
+        key = self.build_key(body)
+        if key is None:
+            return True
+
+        if key in self._seen:
+            self.duplicates += 1
+            return False
+        self._seen[key] = True
+
+        if self.backend is not None and not await self._claim_shared(key):
+            self.duplicates += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {"remembered": len(self._seen), "duplicates": self.duplicates, "backend_errors": self.backend_errors}
+
+    async def _claim_shared(self, key: str) -> bool:
+        try:
+            if self.breaker is not None:
+                return await self.breaker.call_within(self.backend_timeout, self.backend.claim, key, self.ttl)
+            return await asyncio.wait_for(self.backend.claim(key, self.ttl), self.backend_timeout)
+        except Exception as e:
+            # A duplicate getting through is better than holding up every request
+            self.backend_errors += 1
+            log.warning("Skipping the shared dedup check of %s: %s", key, e)
+            return True
@@ -0,0 +1,330 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import heapq
+import inspect
+import itertools
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+import metrics
+from slack_dispatcher import Priority
+
+
+log = logging.getLogger(__name__)
+
+# Team of the handler being run, so the calls it makes are scheduled as that team's
+current_team_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_team_id", default=None)
+
+DEFAULT_PLAN = "standard"
+
+# Quotas of each plan, overridden by environment variables such as TEAM_QUOTA_ENTERPRISE_HANDLERS
+PLAN_DEFAULTS = {
+    "free": {"handlers": 2, "outbound": 2, "weight": 1, "max_queued": 50},
+    "standard": {"handlers": 4, "outbound": 4, "weight": 1, "max_queued": 100},
+    "enterprise": {"handlers": 16, "outbound": 8, "weight": 4, "max_queued": 500},
+}
+
+# Teams listed in the queue depth metric, the ones with the most queued requests first
+MAX_REPORTED_TEAMS = 20
+
+
+class TeamQuota(BaseModel):
+    """
+    Limits of the teams on a plan.
+    handlers and outbound are how many of a team's handlers and of its outbound Slack and Spotify
+    calls may run at once, weight is the team's share of the slots when teams compete for them,
+    and max_queued how many of its requests may wait before new bulk ones are shed.
+    """
+    handlers: int = 4
+    outbound: int = 4
+    weight: float = 1
+    max_queued: int = 100
+
+    @classmethod
+    def from_env(cls, plan: str, **defaults) -> 'TeamQuota':
+        """
+        Build a quota from the given defaults, overridden by environment variables such as
+        TEAM_QUOTA_FREE_HANDLERS, TEAM_QUOTA_FREE_OUTBOUND, TEAM_QUOTA_FREE_WEIGHT and TEAM_QUOTA_FREE_MAX_QUEUED.
+        """
+        prefix = f"TEAM_QUOTA_{plan.upper()}_"
+        values = dict(defaults)
+        for field in cls.model_fields:
+            env_value = os.getenv(prefix + field.upper())
+            if env_value is not None:
+                values[field] = env_value
+        return cls(**values)
+
+
+class TeamPlans():
+    """
+    Plan of each team and the quota of each plan. Teams not listed are on the default plan.
+    """
+
+    def __init__(self, quotas: Dict[str, TeamQuota], team_plans: Dict[str, str], default_plan: str = DEFAULT_PLAN):
+        self.quotas = quotas
+        self.team_plans = team_plans
+        self.default_plan = default_plan
+
+    def plan(self, team_id: str) -> str:
+        plan = self.team_plans.get(team_id, self.default_plan)
+        return plan if plan in self.quotas else self.default_plan
+
+    def quota(self, team_id: str) -> TeamQuota:
+        return self.quotas[self.plan(team_id)]
+
+    @classmethod
+    def from_env(cls) -> 'TeamPlans':
+        """
+        Plans from TEAM_PLANS, e.g. "T0123=enterprise,T0456=free", and TEAM_PLAN_DEFAULT.
+        """
+        quotas = {plan: TeamQuota.from_env(plan, **defaults) for plan, defaults in PLAN_DEFAULTS.items()}
+        team_plans = {}
+        for item in os.getenv("TEAM_PLANS", "").split(","):
+            if "=" in item:
+                team_id, plan = item.split("=", 1)
+                if plan.strip() not in quotas:
+                    log.warning("Unknown plan %s for team %s, using the default plan", plan.strip(), team_id.strip())
+                team_plans[team_id.strip()] = plan.strip()
+        default_plan = os.getenv("TEAM_PLAN_DEFAULT", DEFAULT_PLAN)
+        return cls(quotas, team_plans, default_plan if default_plan in quotas else DEFAULT_PLAN)
+
+
+def team_id_of(body: dict) -> Optional[str]:
+    """
+    Team a Slack request comes from, for events, commands, actions and view submissions.
+    """
+    user = body.get("user")
+    if isinstance(user, dict) and user.get("team_id"):
+        return user["team_id"]
+    return body.get("team_id") or (body.get("team") or {}).get("id")
+
+
+class _TeamQueue():
+
+    def __init__(self, quota: TeamQuota):
+        self.quota = quota
+        self.running = 0
+        # Virtual time at which the team's last slot finishes
+        self.finish_tag = 0.0
+        # heap of (priority, sequence, future)
+        self.waiters: List[Tuple[Priority, int, asyncio.Future]] = []
+
+
+class FairScheduler():
+    """
+    Weighted fair queuing of the work of the teams sharing the process, e.g. running handlers or
+    making outbound calls.
+
+    At most capacity pieces of work run at once, and at most the limit of its plan (the handlers or
+    outbound field of its quota) per team. When work has to wait, the next free slot goes to the
+    waiting team with the lowest virtual start time (start-time fair queuing): a team's virtual time
+    advances by 1/weight with each slot it gets, so a team that has been quiet is served before one
+    that keeps the slots busy, and a large workspace under load can't starve the clicks of small
+    ones. Within a team, interactive work goes ahead of bulk work.
+    """
+
+    def __init__(self, name: str, plans: TeamPlans, limit: str, capacity: int = 64):
+        self.name = name
+        self.plans = plans
+        self.limit = limit
+        self.capacity = capacity
+
+        # Only teams with work running or waiting, a team coming back starts at the current virtual time
+        self._teams: Dict[str, _TeamQueue] = {}
+        self._virtual_time = 0.0
+        self._running = 0
+        self._sequence = itertools.count()
+
+        self.granted = 0
+        self.queued = 0
+        self.shed = 0
+
+        metrics.register(f"fair_scheduler.{name}", self.stats)
+
+    async def acquire(self, team_id: str, priority: Priority = Priority.BULK, shed: bool = False) -> bool:
+        """
+        Wait for a slot of the team, it must be given back with release().
+        With shed=True, returns False instead when the team already has max_queued requests waiting.
+        """
+        team = self._team(team_id)
+        # Work only waits while every slot is taken or the team is at its limit
+        if not team.waiters and self._running < self.capacity and team.running < self._limit(team):
+            self._grant(team)
+            return True
+
+        if shed and len(team.waiters) >= team.quota.max_queued:
+            self.shed += 1
+            self._forget(team_id)
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(team.waiters, entry)
+        self.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted as the waiter was cancelled
+                self.release(team_id)
+            elif entry in team.waiters:
+                team.waiters.remove(entry)
+                heapq.heapify(team.waiters)
+                self._forget(team_id)
+            raise
+        return True
+
+    def release(self, team_id: str):
+        team = self._teams[team_id]
+        team.running -= 1
+        self._running -= 1
+        self._dispatch()
+        self._forget(team_id)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, team_id: Optional[str] = None, priority: Priority = Priority.BULK):
+        """
+        Hold a slot of the team for the duration of the block, where it is the current team.
+        team_id defaults to the team of the handler being run, work without a team (e.g. background
+        jobs) isn't scheduled.
+        """
+        team_id = team_id or current_team_id.get()
+        if team_id is None:
+            yield
+            return
+
+        await self.acquire(team_id, priority)
+        token = current_team_id.set(team_id)
+        try:
+            yield
+        finally:
+            current_team_id.reset(token)
+            self.release(team_id)
+
+    def handler(self, priority: Priority = Priority.BULK):
+        """
+        Decorator running a Bolt listener in a slot of its team.
+
+        The request is acknowledged before waiting for the slot, so queued requests don't miss
+        Slack's 3 second deadline, and the listener's own ack() does nothing. Listeners that
+        acknowledge with a response (e.g. view submission errors) should hold a slot() after
+        acknowledging instead. Bulk requests are dropped when the team has too many queued.
+        """
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            async def wrapper(**kwargs):
+                ack = kwargs.get("ack")
+                if ack is not None:
+                    await ack()
+                    kwargs["ack"] = _acknowledged
+
+                body = kwargs.get("body")
+                team_id = team_id_of(body) if body else None
+                if team_id is None:
+                    return await fn(**kwargs)
+
+                if not await self.acquire(team_id, priority, shed=priority == Priority.BULK):
+                    log.warning("Shedding %s, too many requests queued", fn.__name__, extra={"handler": fn.__name__, "team_id": team_id})
+                    return
+
+                token = current_team_id.set(team_id)
+                try:
+                    return await fn(**kwargs)
+                finally:
+                    current_team_id.reset(token)
+                    self.release(team_id)
+            return wrapper
+        return decorator
+
+    def stats(self) -> dict:
+        depths = sorted(((len(team.waiters), team_id) for team_id, team in self._teams.items() if team.waiters), reverse=True)
+        return {
+            "running": self._running,
+            "capacity": self.capacity,
+            "queued_now": sum(depth for depth, _ in depths),
+            "granted": self.granted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "queue_depth": {team_id: depth for depth, team_id in depths[:MAX_REPORTED_TEAMS]},
+        }
+
+    def _team(self, team_id: str) -> _TeamQueue:
+        team = self._teams.get(team_id)
+        if team is None:
+            team = _TeamQueue(self.plans.quota(team_id))
+            self._teams[team_id] = team
+        return team
+
+    def _forget(self, team_id: str):
+        team = self._teams.get(team_id)
+        if team is not None and team.running == 0 and not team.waiters:
+            del self._teams[team_id]
+
+    def _limit(self, team: _TeamQueue) -> int:
+        return getattr(team.quota, self.limit)
+
+    def _grant(self, team: _TeamQueue):
+        start_tag = max(team.finish_tag, self._virtual_time)
+        team.finish_tag = start_tag + 1 / team.quota.weight
+        self._virtual_time = start_tag
+        team.running += 1
+        self._running += 1
+        self.granted += 1
+
+    def _dispatch(self):
+        while self._running < self.capacity:
+            next_team = None
+            next_tag = None
+            for team in self._teams.values():
+                # Drop waiters cancelled before they were served
+                while team.waiters and team.waiters[0][2].done():
+                    heapq.heappop(team.waiters)
+                if not team.waiters or team.running >= self._limit(team):
+                    continue
+                start_tag = max(team.finish_tag, self._virtual_time)
+                if next_tag is None or start_tag < next_tag:
+                    next_team, next_tag = team, start_tag
+            if next_team is None:
+                return
+
+            _, _, future = heapq.heappop(next_team.waiters)
+            self._grant(next_team)
+            future.set_result(None)
+
+
+class Scheduled():
+    """
+    Proxy holding a slot of the current team for every call to a client's coroutine methods,
+    e.g. a Guarded Spotify client. Calls made outside of a scheduled handler aren't scheduled.
+    """
+
+    def __init__(self, target: Any, scheduler: FairScheduler, priority: Priority = Priority.INTERACTIVE):
+        self._target = target
+        self._scheduler = scheduler
+        self._priority = priority
+        self._methods: Dict[str, Callable] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        method = self._methods.get(name)
+        if method is not None:
+            return method
+
+        attribute = getattr(self._target, name)
+        if name.startswith("_") or not inspect.iscoroutinefunction(attribute):
+            return attribute
+
+        async def method(*args, **kwargs):
+            async with self._scheduler.slot(priority=self._priority):
+                return await attribute(*args, **kwargs)
+
+        self._methods[name] = method
+        return method
+
+
+async def _acknowledged(*args, **kwargs):
+    pass
@@ -0,0 +1,539 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from models.poll_categories import PollCategory
+from models.spotify_installations import SpotifyInstallation
+from models.users import UserSummary
+from models.weekly_polls import WeeklyPoll, SongInfo, VoteInfo
+
+
+# Slack limits for a Home tab view
+MAX_VIEW_BLOCKS = 100
+MAX_CONTEXT_ELEMENTS = 10
+# Slack doesn't publish an exact byte limit for views, stay well under what it accepts
+MAX_VIEW_BYTES = 100_000
+
+# Avatars shown per song, leaving room in the context block for "+N more" and the vote count
+MAX_AVATARS = MAX_CONTEXT_ELEMENTS - 2
+
+# Songs listed per page of the Home tab
+SONGS_PER_PAGE = 20
+
+
+class BlockBudget():
+    """
+    Collects blocks while keeping track of how many blocks and bytes are left.
+    """
+
+    def __init__(self, max_blocks: int, max_bytes: int):
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.blocks = []
+        self.used_bytes = 0
+
+    def add(self, *blocks: dict) -> bool:
+        """
+        Add the blocks if they all fit, returns whether they were added.
+        """
+        size = sum(block_size(block) for block in blocks)
+        if len(self.blocks) + len(blocks) > self.max_blocks or self.used_bytes + size > self.max_bytes:
+            return False
+        self.blocks.extend(blocks)
+        self.used_bytes += size
+        return True
+
+
+def block_size(block: dict) -> int:
+    return len(json.dumps(block))
+
+
+async def build_home_view(
+    app_user: UserSummary,
+    weekly_poll: WeeklyPoll,
+    user_lookup: Callable[[str], Awaitable[UserSummary]],
+    spotify_installation: Optional[SpotifyInstallation] = None,
+    offset: int = 0,
+    categories: Optional[List[PollCategory]] = None,
+    category_polls: Optional[Dict[str, WeeklyPoll]] = None,
+    degraded: bool = False,
+) -> dict:
+    """
+    Build the Home tab view of a user for the given poll.
+    Songs are listed SONGS_PER_PAGE at a time starting at offset, and the whole view is kept within
+    Slack's block and size limits: when the budget runs out the list ends with "Show more".
+    user_lookup resolves voters for their avatars, spotify_installation is only used for admins.
+    With several categories, the view starts with a switcher between their polls, category_polls
+    being the current poll of each category (by category ID) that exists already.
+    The category of the poll shown is kept in the view's private_metadata for the actions.
+    A degraded view was built from cached data while Firestore is unavailable, and says so.
+    """
+    header_blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*Welcome to your _App's Home tab_* :tada:"
+            }
+        },
+        *(build_category_blocks(weekly_poll, categories, category_polls or {}) if categories and len(categories) > 1 else []),
+        *([build_degraded_notice_block()] if degraded else []),
+        {
+            "type": "divider"
+        },
+    ]
+    admin_blocks = build_admin_blocks(app_user, weekly_poll, spotify_installation) if app_user.is_admin else []
+
+    # Keep one block for the pagination buttons
+    reserved_blocks = header_blocks + admin_blocks
+    budget = BlockBudget(
+        max_blocks=MAX_VIEW_BLOCKS - len(reserved_blocks) - 1,
+        max_bytes=MAX_VIEW_BYTES - sum(block_size(block) for block in reserved_blocks) - 1000,
+    )
+
+    if weekly_poll.status == "submissions_open":
+        next_offset = build_submission_blocks(budget, app_user, weekly_poll, offset)
+    elif weekly_poll.status == "voting_open":
+        next_offset = await build_voting_blocks(budget, app_user, weekly_poll, user_lookup, offset)
+    else:
+        build_results_blocks(budget, weekly_poll)
+        next_offset = None
+
+    pagination_blocks = []
+    if offset > 0 or next_offset is not None:
+        pagination_blocks.append(build_pagination_block(offset, next_offset))
+
+    return {
+        "type": "home",
+        "callback_id": "home_view",
+        "private_metadata": weekly_poll.category,
+        "blocks": [
+            *header_blocks,
+            *budget.blocks,
+            *pagination_blocks,
+            *admin_blocks,
+        ]
+    }
+
+
+def build_unavailable_view() -> dict:
+    """
+    Home tab for when nothing about the user's poll is cached and Firestore is unavailable.
+    """
+    return {
+        "type": "home",
+        "callback_id": "home_view",
+        "blocks": [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "*Welcome to your _App's Home tab_* :tada:"
+                }
+            },
+            build_degraded_notice_block(),
+        ]
+    }
+
+
+def build_degraded_notice_block() -> dict:
+    return {
+        "type": "context",
+        "elements": [
+            {
+                "type": "mrkdwn",
+                "text": ":warning: We're having trouble loading the latest poll data, showing what we last knew. Please try again in a minute."
+            }
+        ]
+    }
+
+
+def build_category_blocks(weekly_poll: WeeklyPoll, categories: List[PollCategory], category_polls: Dict[str, WeeklyPoll]) -> List[dict]:
+    """
+    A button per category to switch between their polls, and where each poll stands.
+    """
+    # Actions blocks hold up to 25 elements
+    buttons = []
+    for category in categories[:25]:
+        button = {
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": category.name[:75]
+            },
+            "value": category.id,
+            "action_id": f"home_select_category_{category.id}",
+        }
+        if category.id == weekly_poll.category:
+            button["style"] = "primary"
+        buttons.append(button)
+
+    status_elements = []
+    for category in categories[:MAX_CONTEXT_ELEMENTS]:
+        poll = category_polls.get(category.id)
+        if poll is None:
+            status = "not started"
+        else:
+            status = f"{poll.status.replace('_', ' ')}, {len(poll.songs)} songs"
+        status_elements.append({
+            "type": "mrkdwn",
+            "text": f"*{category.name}*: {status}"
+        })
+
+    return [
+        {
+            "type": "actions",
+            "elements": buttons
+        },
+        {
+            "type": "context",
+            "elements": status_elements
+        },
+    ]
+
+
+def build_submission_blocks(budget: BlockBudget, app_user: UserSummary, weekly_poll: WeeklyPoll, offset: int) -> Optional[int]:
+    """
+    Submission form and the submissions so far.
+    Returns the offset of the next page of songs, or None if every song was listed.
+    """
+    # Show the submission form if the user hasn't submitted a song yet
+    if not user_has_submitted_song(app_user, weekly_poll):
+        budget.add(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "*Submit your song for this week's poll!*"
+                }
+            },
+            {
+                "dispatch_action": True,
+                "type": "input",
+                "element": {
+                    "type": "plain_text_input",
+                    "action_id": "submitted_song"
+                },
+                "label": {
+                    "type": "plain_text",
+                    "text": "Submit your song here:",
+                    "emoji": True
+                }
+            },
+        )
+    else:
+        budget.add({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*You have already submitted a song for this week's poll!*"
+            }
+        })
+
+    # Show the submissions so far
+    submissions = get_poll_submissions(weekly_poll)
+
+    budget.add({
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "*Submissions so far:*"
+        }
+    })
+
+    if len(submissions) == 0:
+        budget.add({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "No submissions yet."
+            }
+        })
+        return None
+
+    page = submissions[offset:offset + SONGS_PER_PAGE]
+    for (index, song_info) in enumerate(page):
+        added = budget.add({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f":musical_note: *{song_info.title}\n{song_info.artist}{song_badges(song_info)}"
+            }
+        })
+        if not added:
+            return offset + index
+
+    return offset + len(page) if offset + len(page) < len(submissions) else None
+
+
+async def build_voting_blocks(
+    budget: BlockBudget,
+    app_user: UserSummary,
+    weekly_poll: WeeklyPoll,
+    user_lookup: Callable[[str], Awaitable[UserSummary]],
+    offset: int,
+) -> Optional[int]:
+    """
+    Voting buttons with the avatars of each song's voters.
+    Returns the offset of the next page of songs, or None if every song was listed.
+    """
+    # Show the voting form if the user hasn't voted yet
+    has_voted = user_has_voted(app_user, weekly_poll)
+    budget.add(
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*Vote for your favorite song!*" if not has_voted else "*You have already voted for this week's poll!*"
+            }
+        },
+        {
+            "type": "divider"
+        },
+    )
+
+    voting_options = get_voting_options(weekly_poll)
+    page = voting_options[offset:offset + SONGS_PER_PAGE]
+
+    # Sharded polls only carry their vote counts, their votes aren't loaded
+    votes_count = weekly_poll.count_votes()
+
+    # Group the votes by song once, and only look up the voters whose avatars are shown
+    voters_by_song: Dict[str, List[str]] = defaultdict(list)
+    for vote in get_vote_information(weekly_poll):
+        voters_by_song[vote.voted_for].append(vote.voted_by)
+
+    shown_voters = {voter for song in page for voter in voters_by_song[song.id][:MAX_AVATARS]}
+    voters = dict(zip(shown_voters, await asyncio.gather(*(user_lookup(voter) for voter in shown_voters))))
+
+    for (page_index, option) in enumerate(page):
+        index = offset + page_index
+
+        vote_block = {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"{index}. *{option.title}*\n{option.artist}{song_badges(option)}"
+            }
+        }
+
+        if not has_voted:
+            vote_block["accessory"] = {
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "emoji": True,
+                    "text": f"Vote for {index}"
+                },
+                "value": option.id,
+                "action_id": "vote"
+            }
+
+        song_voters = voters_by_song[option.id]
+        vote_count = votes_count.get(option.id, 0)
+        context_elements = [
+            {
+                "type": "image",
+                "image_url": voters[voter].image_24,
+                "alt_text": voters[voter].name
+            }
+            # Voters only known by ID while Firestore is unavailable have no avatar
+            for voter in song_voters[:MAX_AVATARS] if voters[voter].image_24
+        ]
+        if len(song_voters) > MAX_AVATARS:
+            context_elements.append({
+                "type": "plain_text",
+                "text": f"+{len(song_voters) - MAX_AVATARS} more"
+            })
+        context_elements.append({
+            "type": "plain_text",
+            "emoji": True,
+            "text": f"{vote_count} vote" + ("s" if vote_count != 1 else "")
+        })
+
+        if not budget.add(vote_block, {"type": "context", "elements": context_elements}):
+            return index
+
+    return offset + len(page) if offset + len(page) < len(voting_options) else None
+
+
+def build_results_blocks(budget: BlockBudget, weekly_poll: WeeklyPoll):
+    # Show the results
+    budget.add({
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "*Poll Results:*"
+        }
+    })
+
+    # Songs withdrawn after they got votes aren't ranked
+    sorted_votes = sorted(
+        [(song_id, vote_count) for (song_id, vote_count) in weekly_poll.count_votes().items() if song_id in weekly_poll.songs],
+        key=lambda x: x[1],
+        reverse=True,
+    )
+
+    for (index, (song_id, vote_count)) in enumerate(sorted_votes[:3]):
+        song_info = weekly_poll.songs[song_id]
+        budget.add({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f":trophy: *{index + 1}.* {song_info.title}\n{song_info.artist}\nVotes: {vote_count}"
+            }
+        })
+
+    # TODO: Show the playlist link
+
+
+def build_pagination_block(offset: int, next_offset: Optional[int]) -> dict:
+    elements = []
+    if offset > 0:
+        elements.append({
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": "Back to top"
+            },
+            "value": "0",
+            "action_id": "home_page_first",
+        })
+    if next_offset is not None:
+        elements.append({
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": "Show more"
+            },
+            "value": str(next_offset),
+            "action_id": "home_page_next",
+        })
+    return {
+        "type": "actions",
+        "elements": elements
+    }
+
+
+def build_admin_blocks(app_user: UserSummary, weekly_poll: WeeklyPoll, spotify_installation: Optional[SpotifyInstallation]) -> List[dict]:
+    # Show admin controls
+    admin_blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "*Admin Controls:*"
+            }
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Change Poll Status"
+                    },
+                    "action_id": "change_poll_status",
+                }
+            ]
+        },
+    ]
+
+    if spotify_installation is None:
+        # install spotify button
+        admin_blocks.append({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "Install Spotify to create playlists"
+            },
+            "accessory": {
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "text": "Install Spotify"
+                },
+                "action_id": "install_spotify",
+            }
+        })
+
+    else:
+        # show playlist link
+        admin_blocks.append({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"Spotify Installation found."
+            },
+            "accessory": {
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "text": "Uninstall Spotify"
+                },
+                "action_id": "uninstall_spotify",
+            }
+        })
+
+    if user_has_submitted_song(app_user, weekly_poll):
+        admin_blocks.append({
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Unsubmit Song"
+                    },
+                    "action_id": "unsubmit_song",
+                }
+            ]
+        })
+
+    if user_has_voted(app_user, weekly_poll):
+        admin_blocks.append({
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Unvote"
+                    },
+                    "action_id": "unvote",
+                }
+            ]
+        })
+
+    return admin_blocks
+
+
+# Helper functions
+def song_badges(song_info: SongInfo) -> str:
+    """
+    Tempo and genre badges of an enriched song, on their own line, or nothing.
+    """
+    features = song_info.features
+    if features is None:
+        return ""
+    badges = [f"`{genre}`" for genre in features.genres[:2]]
+    if features.tempo:
+        badges.append(f"`{features.tempo} BPM`")
+    return "\n" + " ".join(badges) if badges else ""
+
+def user_has_submitted_song(user: UserSummary, poll: WeeklyPoll) -> bool:
+    return user.slack_music_config.has_submitted(poll.poll_id)
+
+def user_has_voted(user: UserSummary, poll: WeeklyPoll) -> bool:
+    return user.slack_music_config.has_voted(poll.poll_id)
+
+def get_poll_submissions(weekly_poll: WeeklyPoll) -> List[SongInfo]:
+    return list(weekly_poll.songs.values())
+
+def get_voting_options(weekly_poll: WeeklyPoll) -> List[SongInfo]:
+    return list(weekly_poll.songs.values())
+
+def get_vote_information(weekly_poll: WeeklyPoll) -> List[VoteInfo]:
+    return list(weekly_poll.votes.values())
@@ -1,42 +1,65 @@
 import functools
+import os
+import cachetools
 from google.cloud import firestore
-from typing import Optional
+from typing import Optional, Tuple
 from slack_sdk.oauth.installation_store.async_installation_store import AsyncInstallationStore
-from slack_sdk.oauth.installation_store.models import Installation
-import cachetools
+from slack_sdk.oauth.installation_store.models import Bot, Installation
+from cache import CacheConfig, StoreCache
 
 
+# Installations read to find a workspace's latest bot installation, newest first
+MAX_LEGACY_INSTALLATIONS = 20
+
 
 class SlackMusicInstallationStore(AsyncInstallationStore):
-    def __init__(self):
+    """
+    # /installations/{enterprise_id}-{team_id}-{user_id}
+    One document per installing user.
+    # /bot_installations/{enterprise_id}-{team_id}
+    The latest installation with a bot token of each workspace or org, written on every save, so
+    authorizing a request is a single point read.
+    """
+
+    def __init__(self, cache_config: Optional[CacheConfig] = None):
         # Initialize Firestore client
         self.db = firestore.AsyncClient()
 
-        self.cache = cachetools.TTLCache(maxsize=128, ttl=300)
+        self.cache = StoreCache("installations", cache_config or CacheConfig.from_env("installations", maxsize=256, ttl=300))
+
+        # Lookups that found no installation, so Bolt's per-user lookup isn't a read on every event.
+        # Kept only a few seconds, since other processes don't see the save of a new installation.
+        self._misses = cachetools.TTLCache(maxsize=1024, ttl=float(os.getenv("INSTALLATION_MISS_TTL", "5")))
 
     async def async_save(self, installation: Installation):
         """
         Save the installation object in Firestore.
         If an installation with the same enterprise_id, team_id, and user_id exists, it will be updated.
+        Installations with a bot token also become the workspace's latest bot installation.
         Also update the cache after saving to Firestore.
         """
-        doc_id = f"{installation.enterprise_id}-{installation.team_id}-{installation.user_id}"
+        installation_json = installation.to_dict()
         installation_data = {
             "enterprise_id": installation.enterprise_id,
             "team_id": installation.team_id,
             "user_id": installation.user_id,
-            "installation_data": installation.to_dict(),  # Assuming Installation has a to_dict() method
+            "installation_data": installation_json,
             "is_enterprise_install": installation.is_enterprise_install,
             "created_at": firestore.SERVER_TIMESTAMP,
             "updated_at": firestore.SERVER_TIMESTAMP,
         }
-        
-        # Save the installation data into Firestore
-        await self.db.collection("installations").document(doc_id).set(installation_data)
-        
-        # Update cache with the latest installation (store as JSON)
-        cache_key = self._build_cache_key(installation.enterprise_id, installation.team_id, installation.user_id)
-        self._add_to_cache(cache_key, installation)
+
+        batch = self.db.batch()
+        batch.set(self._installation_ref(installation.enterprise_id, installation.team_id, installation.user_id), installation_data)
+        if installation.bot_token:
+            batch.set(self._bot_installation_ref(installation.enterprise_id, installation.team_id), installation_data)
+        await batch.commit()
+
+        self._add_to_cache(self._build_cache_key(installation.enterprise_id, installation.team_id, installation.user_id), installation_json)
+        self._misses.pop(self._build_cache_key(installation.enterprise_id, installation.team_id, installation.user_id), None)
+        if installation.bot_token:
+            self._add_to_cache(self._build_cache_key(installation.enterprise_id, installation.team_id, None), installation_json)
+            self._misses.pop(self._build_cache_key(installation.enterprise_id, installation.team_id, None), None)
 
     async def async_find_installation(
         self,
@@ -48,72 +71,144 @@ class SlackMusicInstallationStore(AsyncInstallationStore):
     ) -> Optional[Installation]:
         """
         Find an installation by enterprise_id, team_id, and optionally user_id.
-        If user_id is absent, this method returns the latest installation for the given enterprise/team.
-        Use an in-memory LRU cache to store and retrieve installations in JSON format.
+        If user_id is absent, this method returns the latest bot installation for the given enterprise/team.
+        Returns None when there is no such installation, which Bolt expects.
         """
-        # Step 1: Try to get installation from cache (JSON)
+        # Org-wide installations are saved without a team and shared by every workspace of the org
+        if is_enterprise_install:
+            team_id = None
+
         cache_key = self._build_cache_key(enterprise_id, team_id, user_id)
+        if cache_key in self._misses:
+            return None
         cached_json = self._get_from_cache(cache_key)
-        if cached_json:
-            # Parse cached JSON back to Installation object
+        if cached_json is not None:
             return self.to_installation(cached_json)
 
         if user_id:
             # Case 1: Find installation with specific user_id
-            doc_id = f"{enterprise_id}-{team_id}-{user_id}"
-            doc_ref = self.db.collection("installations").document(doc_id)
-            doc = await doc_ref.get()
+            doc = await self._installation_ref(enterprise_id, team_id, user_id).get()
+        else:
+            # Case 2: The latest bot installation of the workspace/org if user_id is not provided
+            doc = await self._bot_installation_ref(enterprise_id, team_id).get()
+            if not doc.exists:
+                doc = await self._find_latest_installation(enterprise_id, team_id)
 
-            if doc.exists:
-                data = doc.to_dict()
-                installation_json = data["installation_data"]
+        if doc is None or not doc.exists:
+            self._misses[cache_key] = True
+            return None
 
-                # Cache the JSON before returning
-                self._add_to_cache(cache_key, installation_json)
-                return self.to_installation(installation_json)
-            else:
-                raise ValueError(f"Installation {doc_id} not found")
+        installation_json = doc.to_dict()["installation_data"]
+        self._add_to_cache(cache_key, installation_json)
+        return self.to_installation(installation_json)
 
-        else:
-            # Case 2: Find the latest installation in the workspace/org if user_id is not provided
-            query = (
-                self.db.collection("installations")
-                .where(field_path="enterprise_id", op_string="==", value=enterprise_id)  # Filter by enterprise_id
-                .where(field_path="team_id", op_string="==", value=team_id)  # Filter by team_id
-                .order_by("created_at", direction=firestore.Query.DESCENDING)  # Order by latest
-                .limit(1)  # Get the latest installation
-            )
-            docs = query.stream()  # This is an async generator, no await here
-
-            # Process the result
-            async for doc in docs:
-                data = doc.to_dict()
-                latest_installation_json = data["installation_data"]
-                # Cache the JSON before returning
-                self._add_to_cache(cache_key, latest_installation_json)
-                return self.to_installation(latest_installation_json)
-
-            raise ValueError("No installation found for the workspace")
+    async def async_find_bot(
+        self,
+        *,
+        enterprise_id: Optional[str],
+        team_id: Optional[str],
+        is_enterprise_install: Optional[bool] = False,
+    ) -> Optional[Bot]:
+        """
+        Find the bot of the latest installation of the workspace/org.
+        """
+        installation = await self.async_find_installation(
+            enterprise_id=enterprise_id,
+            team_id=team_id,
+            is_enterprise_install=is_enterprise_install,
+        )
+        if installation is None or not installation.bot_token:
+            return None
+        return installation.to_bot()
+
+    async def async_delete_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str]) -> None:
+        """
+        Delete the latest bot installation of the workspace/org, e.g. when its bot token is revoked.
+        """
+        await self._bot_installation_ref(enterprise_id, team_id).delete()
+        self.cache.pop(self._build_cache_key(enterprise_id, team_id, None))
+
+    async def async_delete_installation(
+        self,
+        *,
+        enterprise_id: Optional[str],
+        team_id: Optional[str],
+        user_id: Optional[str] = None,
+    ) -> None:
+        """
+        Delete the installation of a user, or every installation of the workspace/org if user_id is absent.
+        """
+        if user_id:
+            await self._installation_ref(enterprise_id, team_id, user_id).delete()
+            self.cache.pop(self._build_cache_key(enterprise_id, team_id, user_id))
+            return
+
+        query = (
+            self.db.collection("installations")
+            .where(field_path="enterprise_id", op_string="==", value=enterprise_id)
+            .where(field_path="team_id", op_string="==", value=team_id)
+        )
+        batch = self.db.batch()
+        batch_size = 0
+        async for doc in query.stream():
+            batch.delete(doc.reference)
+            batch_size += 1
+            # Firestore batches are limited to 500 writes
+            if batch_size == 500:
+                await batch.commit()
+                batch = self.db.batch()
+                batch_size = 0
+        batch.delete(self._bot_installation_ref(enterprise_id, team_id))
+        await batch.commit()
+
+        self.cache.pop_matching(lambda key: key[:2] == (enterprise_id, team_id))
+
+    async def _find_latest_installation(self, enterprise_id: Optional[str], team_id: Optional[str]):
+        """
+        Ordered query for workspaces installed before bot installation documents existed.
+        Only installations with a bot token count, the latest one is written as the workspace's bot
+        installation, so it runs once per workspace.
+        """
+        query = (
+            self.db.collection("installations")
+            .where(field_path="enterprise_id", op_string="==", value=enterprise_id)  # Filter by enterprise_id
+            .where(field_path="team_id", op_string="==", value=team_id)  # Filter by team_id
+            .order_by("created_at", direction=firestore.Query.DESCENDING)  # Order by latest
+            .limit(MAX_LEGACY_INSTALLATIONS)
+        )
+        async for doc in query.stream():
+            if doc.to_dict()["installation_data"].get("bot_token"):
+                await self._bot_installation_ref(enterprise_id, team_id).set(doc.to_dict())
+                return doc
+        return None
+
+    def _installation_ref(self, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str]):
+        # Document IDs predate the cache key fix and keep the "None" of missing IDs, so existing installations are found
+        return self.db.collection("installations").document(f"{enterprise_id}-{team_id}-{user_id}")
+
+    def _bot_installation_ref(self, enterprise_id: Optional[str], team_id: Optional[str]):
+        return self.db.collection("bot_installations").document(f"{enterprise_id or ''}-{team_id or ''}")
 
     def to_installation(self, data: dict) -> Installation:
         return Installation(**data)
 
     ### Cache Layer ###
 
-    def _get_from_cache(self, cache_key: str) -> Optional[dict]:
+    def _get_from_cache(self, cache_key: Tuple) -> Optional[dict]:
         """
-        Retrieve an installation's JSON data from the in-memory cache using cachetools.TTLCache.
+        Retrieve an installation's JSON data from the in-memory cache.
         """
         return self.cache.get(cache_key)
 
-    def _add_to_cache(self, cache_key: str, installation_json: dict):
+    def _add_to_cache(self, cache_key: Tuple, installation_json: dict):
         """
-        Add an installation's JSON data to the in-memory cache using cachetools.TTLCache.
+        Add an installation's JSON data to the in-memory cache.
         """
-        self.cache[cache_key] = installation_json
+        self.cache.set(cache_key, installation_json)
 
-    def _build_cache_key(self, enterprise_id: str, team_id: str, user_id: Optional[str]) -> str:
+    def _build_cache_key(self, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str]) -> Tuple:
         """
         Build a cache key based on enterprise_id, team_id, and optionally user_id.
+        A tuple, so missing IDs stay None instead of becoming the string "None".
         """
-        return f"{enterprise_id}-{team_id}-{user_id if user_id else 'latest'}"
\ No newline at end of file
+        return (enterprise_id, team_id, user_id)
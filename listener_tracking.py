@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import weakref
+from typing import Optional
+
+from slack_bolt.listener.async_listener_completion_handler import AsyncListenerCompletionHandler
+from slack_bolt.listener.async_listener_start_handler import AsyncListenerStartHandler
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_bolt.response import BoltResponse
+
+
+log = logging.getLogger(__name__)
+
+
+class ListenerTracker():
+    """
+    Keeps track of the listeners a Bolt app is running, through its listener start and completion
+    handlers.
+
+    Unless the app processes requests before responding, Bolt returns the response as soon as the
+    listener calls ack() and the listener carries on in a task of its own. The servers use the
+    tracker to wait for the listener of a request (Socket Mode keeps each shard in order this way)
+    or for every listener on shutdown, without tracking any other task.
+    """
+
+    def __init__(self, app):
+        self._running: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+
+        runner = app.listener_runner
+        runner.listener_start_handler = _TrackingStartHandler(self, runner.listener_start_handler)
+        runner.listener_completion_handler = _TrackingCompletionHandler(self, runner.listener_completion_handler)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for task in self._running if not task.done())
+
+    async def wait_for(self, request: AsyncBoltRequest, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the listener of a dispatched request to finish, returns False on timeout.
+        """
+        # Listeners acknowledged by Bolt itself (events) are only started after dispatch returns
+        await asyncio.sleep(0)
+        task = request.context.get("listener_task")
+        if task is None or task.done() or task is asyncio.current_task():
+            return True
+
+        _, pending = await asyncio.wait({task}, timeout=timeout)
+        return not pending
+
+    async def drain(self, timeout: float):
+        """
+        Wait up to timeout seconds for every running listener.
+        """
+        pending = [task for task in self._running if not task.done() and task is not asyncio.current_task()]
+        if pending:
+            _, still_pending = await asyncio.wait(pending, timeout=timeout)
+            if still_pending:
+                log.warning("Shutting down with %d listeners still running", len(still_pending))
+
+    def _started(self, request: AsyncBoltRequest):
+        task = asyncio.current_task()
+        self._running.add(task)
+        request.context["listener_task"] = task
+
+    def _completed(self):
+        self._running.discard(asyncio.current_task())
+
+
+class _TrackingStartHandler(AsyncListenerStartHandler):
+
+    def __init__(self, tracker: ListenerTracker, handler: AsyncListenerStartHandler):
+        self.tracker = tracker
+        self.handler = handler
+
+    async def handle(self, request: AsyncBoltRequest, response: Optional[BoltResponse]):
+        self.tracker._started(request)
+        await self.handler.handle(request=request, response=response)
+
+
+class _TrackingCompletionHandler(AsyncListenerCompletionHandler):
+
+    def __init__(self, tracker: ListenerTracker, handler: AsyncListenerCompletionHandler):
+        self.tracker = tracker
+        self.handler = handler
+
+    async def handle(self, request: AsyncBoltRequest, response: Optional[BoltResponse]):
+        try:
+            await self.handler.handle(request=request, response=response)
+        finally:
+            self.tracker._completed()
@@ -4,23 +4,53 @@ from slack_bolt.oauth.async_oauth_flow import AsyncOAuthFlow
 from slack_bolt.oauth.async_callback_options import DefaultAsyncCallbackOptions
 from slack_sdk.oauth.installation_store.models import Installation
 from slack_bolt.async_app import AsyncApp
-from typing import Optional, List
+from slack_bolt.response import BoltResponse
+from typing import Optional, List, Tuple
 from installation_store import SlackMusicInstallationStore
 from user_store import SlackMusicUserStore
-from models.users import User
+from models.users import User, UserSummary
 from weekly_polls_store import SlackMusicWeeklyPollsStore
 from models.weekly_polls import WeeklyPoll, SongInfo, VoteInfo
 from spotify_installation_store import SlackSpotifyInstallationStore
+from song_index_store import SlackMusicSongIndexStore
+from poll_categories_store import SlackMusicPollCategoriesStore
+from models.poll_categories import PollCategory
+import metrics
+from slack_dispatcher import SlackDispatcher, Priority, is_rate_limited
+from home_tab import build_home_view, build_unavailable_view
+from spotify_links import SpotifyLink, extract_spotify_links
+from dedup import RequestDeduplicator, FirestoreDedupBackend
+from submission_throttle import SubmissionThrottle, FirestoreThrottleBackend, DUPLICATE, THROTTLED
+from unit_of_work import UnitOfWork
+from resilience import CircuitBreaker, DependencyUnavailable, Guarded
+from song_enrichment import SongEnricher
+from fair_scheduler import FairScheduler, Scheduled, TeamPlans
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+import asyncio
 import re
 from datetime import datetime
 from dotenv import load_dotenv
 import requests
 from requests.auth import HTTPBasicAuth
 import json
+import logging
+from structured_logging import setup_logging
 load_dotenv()
 
+# JSON logs written by a background thread, every entry point imports main so they all get it
+setup_logging()
+log = logging.getLogger("slack_music")
 
-APP_HOST = 'https://darri.ngrok.app'
+
+APP_HOST = os.getenv("APP_HOST", 'https://darri.ngrok.app')
+
+PORT = int(os.getenv("PORT", "3000"))
+
+# New polls spread their votes over this many counter shards, 0 keeps votes in the poll document
+VOTE_SHARDS = int(os.getenv("VOTE_SHARDS", "0"))
+
+# Seconds between roll-ups of the counter shards into vote_counts
+VOTE_SUMMARY_INTERVAL = float(os.getenv("VOTE_SUMMARY_INTERVAL", "5"))
 
 oauth_settings = AsyncOAuthSettings(
     client_id=os.environ["SLACK_CLIENT_ID"],
@@ -39,30 +69,106 @@ app = AsyncApp(
     oauth_flow=oauth_flow
 )
 
-user_store = SlackMusicUserStore()
-weekly_polls_store = SlackMusicWeeklyPollsStore()
+# Deletes installations when a workspace uninstalls the app or revokes its tokens
+app.enable_token_revocation_listeners()
+
+# Store calls get a deadline and stop waiting on Firestore once it keeps failing
+firestore_breaker = CircuitBreaker(
+    "firestore",
+    timeout=float(os.getenv("FIRESTORE_TIMEOUT", "5")),
+    failure_threshold=int(os.getenv("FIRESTORE_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("FIRESTORE_BREAKER_RESET", "30")),
+    ignored_exceptions=(AlreadyExists, FailedPrecondition),
+)
+
+# Warm-ups and background loops run longer than a handler's deadline
+user_store = Guarded(SlackMusicUserStore(), firestore_breaker, unguarded=["warm_up"])
+weekly_polls_store = Guarded(SlackMusicWeeklyPollsStore(), firestore_breaker, unguarded=["run_summarizer", "summarize_pending"])
+
+spotify_installation_store = Guarded(SlackSpotifyInstallationStore(), firestore_breaker)
+
+song_index_store = Guarded(SlackMusicSongIndexStore(), firestore_breaker)
+
+poll_categories_store = Guarded(SlackMusicPollCategoriesStore(), firestore_breaker)
+
+metrics.register("write_behind", user_store.write_behind.stats)
+
+# Handlers and outbound calls are queued fairly between teams, with per-plan concurrency limits
+team_plans = TeamPlans.from_env()
+handler_scheduler = FairScheduler("handlers", team_plans, "handlers", capacity=int(os.getenv("HANDLER_CONCURRENCY", "64")))
+outbound_scheduler = FairScheduler("outbound", team_plans, "outbound", capacity=int(os.getenv("OUTBOUND_CONCURRENCY", "32")))
+
+# Every outbound Slack Web API call goes through the dispatcher, which rate limits per team and tier
+slack_dispatcher = SlackDispatcher(scheduler=outbound_scheduler)
+
+# Optional Firestore listeners keeping the poll and Spotify installation caches hot
+cache_watcher = None
+if os.getenv("FIRESTORE_WATCH_ENABLED", "false").lower() == "true":
+    from cache_watcher import FirestoreCacheWatcher
+    cache_watcher = FirestoreCacheWatcher(
+        weekly_polls_store,
+        spotify_installation_store,
+        max_teams=int(os.getenv("FIRESTORE_WATCH_MAX_TEAMS", "100")),
+        idle_timeout=float(os.getenv("FIRESTORE_WATCH_IDLE_TIMEOUT", "900")),
+    )
+    metrics.register("cache_watcher", cache_watcher.stats)
+
 
-spotify_installation_store = SlackSpotifyInstallationStore()
+# Drops Slack retries and duplicate deliveries, optionally shared between processes through Firestore.
+# Its claims have a breaker of their own, so their short deadline can't open the one of the stores
+request_dedup_breaker = CircuitBreaker(
+    "request_dedup",
+    timeout=float(os.getenv("REQUEST_DEDUP_TIMEOUT", "1")),
+    failure_threshold=int(os.getenv("FIRESTORE_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("FIRESTORE_BREAKER_RESET", "30")),
+)
+request_deduplicator = RequestDeduplicator(
+    ttl=float(os.getenv("REQUEST_DEDUP_TTL", "600")),
+    backend=FirestoreDedupBackend() if os.getenv("REQUEST_DEDUP_BACKEND") == "firestore" else None,
+    breaker=request_dedup_breaker,
+    backend_timeout=request_dedup_breaker.timeout,
+)
+
+# Song submissions allowed per minute for each user and each team, checked before calling Spotify.
+# Like the dedup claims, the shared budget has a breaker of its own
+submission_throttle_breaker = CircuitBreaker(
+    "submission_throttle",
+    timeout=float(os.getenv("SUBMISSION_THROTTLE_TIMEOUT", "1")),
+    failure_threshold=int(os.getenv("FIRESTORE_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("FIRESTORE_BREAKER_RESET", "30")),
+)
+submission_throttle = SubmissionThrottle(
+    user_rate=float(os.getenv("SUBMISSION_USER_RATE", "6")),
+    team_rate=float(os.getenv("SUBMISSION_TEAM_RATE", "60")),
+    backend=FirestoreThrottleBackend() if os.getenv("SUBMISSION_THROTTLE_BACKEND") == "firestore" else None,
+    breaker=submission_throttle_breaker,
+    backend_timeout=submission_throttle_breaker.timeout,
+)
 
 
 from aiohttp import web
 import base64
 
+@app.middleware
+async def drop_duplicate_requests(body, next, logger):
+    if not await request_deduplicator.claim(body):
+        logger.info("Dropping duplicate delivery of %s", RequestDeduplicator.build_key(body))
+        # Acknowledge so Slack stops retrying
+        return BoltResponse(status=200, body="")
+    return await next()
+
 @app.event("team_access_granted")
 async def team_access_granted(client, event, logger):
-    print("team access granted")
-    print("setup things here")
+    log.info("Team access granted", extra={"handler": "team_access_granted"})
 
 @app.event("team_join")
 async def team_joined(client, event, logger):
-    print("team joined")
-    print("setup things here")
+    log.info("Team joined", extra={"handler": "team_join"})
 
 # New functionality
 @app.event("app_installed")
 async def app_installed(client, event, logger):
-  print("app installed")
-  print("setup things here")
+  log.info("App installed", extra={"handler": "app_installed"})
 
 @app.event("app_mention")
 async def event_test(body, say, logger):
@@ -73,390 +179,292 @@ async def command(ack, body, respond):
     await ack()
     await respond(f"Hi <@{body['user_id']}>!")
 
-async def get_or_create_user(client, team_id: str, user_id: str) -> User:
-    app_user = await user_store.get_user(team_id, user_id)
-    if app_user is None:
-        slack_user_response = await client.users_info(user=user_id)
-        app_user = User(**slack_user_response.data['user'])
-        await user_store.save_user(team_id, user_id, app_user)
-    return app_user
-
-async def get_or_create_weekly_poll(team_id: str, poll_id: str):
-    weekly_pool = await weekly_polls_store.get_poll(team_id, poll_id)
-    if weekly_pool is None:
-        weekly_pool = WeeklyPoll.generate_new_weekly_poll(poll_id)
-        await weekly_polls_store.save_poll(team_id, weekly_pool)
-    return weekly_pool
-
-
-async def update_home_tab_view(client, app_user: User, weekly_poll: WeeklyPoll, logger):
-    # Check the status of the poll
-    poll_status = weekly_poll.status  # Assuming status is an attribute of weekly_poll
-
-    view_blocks = []
-
-    if poll_status == "submissions_open":
-        # Show the submission form if the user hasn't submitted a song yet
-        if not await user_has_submitted_song(app_user, weekly_poll):
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Submit your song for this week's poll!*"
-                }
-            })
-            view_blocks.append({
-                "dispatch_action": True,
-                "type": "input",
-                "element": {
-                    "type": "plain_text_input",
-                    "action_id": "submitted_song"
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": "Submit your song here:",
-                    "emoji": True
-                }
-            })
-        else:
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*You have already submitted a song for this week's poll!*"
-                }
-            })
-        
-        # Show the submissions so far
-        submissions = await get_poll_submissions(weekly_poll)
-
-        print("submissions:", submissions)
-
-        view_blocks.append({
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "*Submissions so far:*"
-            }
-        })
-
-        if len(submissions) == 0:
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "No submissions yet."
-                }
-            })
+@app.command("/poll-categories")
+@handler_scheduler.handler(Priority.INTERACTIVE)
+async def poll_categories_command(ack, body, client, respond):
+    await ack()
 
+    team_id = body["team_id"]
+    subcommand, _, name = body.get("text", "").strip().partition(" ")
+    name = name.strip()
+
+    if subcommand in ("add", "remove"):
+        app_user = await get_or_create_user(client, team_id, body["user_id"])
+        if not app_user.is_admin:
+            await respond("Only admins can change the poll categories.")
+            return
+        if not PollCategory.slugify(name):
+            await respond(f"Usage: /poll-categories {subcommand} <name>")
+            return
+
+    if subcommand == "add":
+        category = await poll_categories_store.add_category(team_id, name)
+        await respond(f"Added the *{category.name}* category, its poll starts this week.")
+    elif subcommand == "remove":
+        if await poll_categories_store.remove_category(team_id, PollCategory.slugify(name)):
+            await respond(f"Removed the *{name}* category, its past polls are kept.")
         else:
-            for song_info in submissions:
-                view_blocks.append({
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f":musical_note: *{song_info.title}\n{song_info.artist}"
-                    }
-                })
-# give me a backslash: \
-    elif poll_status == "voting_open":
-        # Show the voting form if the user hasn't voted yet
-
-        if not await user_has_voted(app_user):
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*Vote for your favorite song!*"
-                }
-            })
-        else:
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "*You have already voted for this week's poll!*"
-                }
-            })
+            await respond(f"There is no \"{name}\" category to remove.")
+    else:
+        categories = await poll_categories_store.get_active_categories(team_id)
+        lines = [f":musical_note: *{category.name}* (`{category.id}`)" for category in categories]
+        await respond("\n".join(["Poll categories:", *lines, "Usage: /poll-categories [add|remove <name>]"]))
 
-        view_blocks.append({
-            "type": "divider"
-        })
+@app.command("/search-songs")
+@handler_scheduler.handler(Priority.INTERACTIVE)
+async def search_songs_command(ack, body, respond):
+    await ack()
 
-        # Add voting options (example)
-        voting_options = await get_voting_options(weekly_poll)
+    query = body.get("text", "").strip()
+    if not query:
+        await respond("Usage: /search-songs <title or artist>")
+        return
 
-        vote_info = await get_vote_information(weekly_poll)
+    results = await song_index_store.search(body["team_id"], query)
+    if not results:
+        await respond(f"No past submissions match \"{query}\".")
+        return
 
-        for (index, option) in enumerate(voting_options):
+    lines = []
+    for entry in results:
+        line = f":musical_note: *{entry.title}* - {entry.artist} (submitted in {', '.join(entry.submitted_in)})"
+        if entry.won_in:
+            line += f" :trophy: won in {', '.join(entry.won_in)}"
+        lines.append(line)
+    await respond("\n".join(lines))
 
-            vote_block = {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"{index}. *{option.title}*\n{option.artist}"
-                }
-            }
+async def get_or_create_user(client, team_id: str, user_id: str) -> UserSummary:
+    app_user = await user_store.get_user_summary(team_id, user_id)
+    if app_user is None:
+        slack_user_response = await slack_dispatcher.call(client, "users_info", team_id, user=user_id)
+        slack_user = User(**slack_user_response.data['user'])
+        await user_store.save_user(team_id, user_id, slack_user)
+        app_user = slack_user.to_summary()
+    return app_user
 
-            if not await user_has_voted(app_user):
-                vote_block["accessory"] = {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "emoji": True,
-                        "text": f"Vote for {index}"
-                    },
-                    "value": option.id,
-                    "action_id": "vote"
-                }
-
-            view_blocks.append(vote_block)
-
-            voted_for_this_song_avatars = []
-            for vote in vote_info:
-                if vote.voted_for == option.id:
-                    user = await get_or_create_user(client, app_user.team_id, vote.voted_by)
-                    voted_for_this_song_avatars.append({
-                        "type": "image",
-                        "image_url": user.profile.image_24,
-                        "alt_text": user.name
-                    })    
-
-            view_blocks.append({
-                "type": "context",
-                "elements": [
-                    *voted_for_this_song_avatars,
-                    {
-                        "type": "plain_text",
-                        "emoji": True,
-                        "text": f"{len(voted_for_this_song_avatars)} vote" + ("s" if len(voted_for_this_song_avatars) > 1 or len(voted_for_this_song_avatars) == 0 else "")
-                    }
-                ]
-            })
-
-    elif poll_status == "closed":
-        # Show the results
-        view_blocks.append({
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "*Poll Results:*"
-            }
-        })
+def log_payload(handler: str, body: dict):
+    """
+    Log a request's payload at DEBUG level, redacted and formatted on the logging thread.
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    user = body.get("user") or {}
+    log.debug("%s payload: %s", handler, body, extra={"handler": handler, "team_id": user.get("team_id"), "user_id": user.get("id")})
 
-        voting_options = await get_voting_options(weekly_poll)
+def get_selected_category(body: dict) -> Optional[str]:
+    """
+    Category of the poll the Home tab showed when the action was taken.
+    """
+    return (body.get("view") or {}).get("private_metadata") or None
 
-        vote_info = await get_vote_information(weekly_poll)
+async def get_or_create_weekly_poll(team_id: str, category_id: Optional[str] = None) -> WeeklyPoll:
+    """
+    This week's poll of a category, the general one if the category isn't active.
+    """
+    category = await poll_categories_store.get_active_category(team_id, category_id)
+    poll_id = WeeklyPoll.generate_poll_id(category.id)
+    return await weekly_polls_store.get_or_create_poll(
+        team_id,
+        poll_id,
+        lambda: WeeklyPoll.generate_new_weekly_poll(poll_id, category=category.id, vote_shards=VOTE_SHARDS),
+    )
 
-        votes_count = {}
-        for vote in vote_info:
-            if vote.voted_for in votes_count:
-                votes_count[vote.voted_for] += 1
-            else:
-                votes_count[vote.voted_for] = 1
-        
-        sorted_votes = sorted(votes_count.items(), key=lambda x: x[1], reverse=True)
 
-        for (index, (song_id, vote_count)) in enumerate(sorted_votes[:3]):
-            song_info = weekly_poll.songs[song_id]
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f":trophy: *{index + 1}.* {song_info.title}\n{song_info.artist}\nVotes: {vote_count}"
-                }
-            })
-        
-        # TODO: Show the playlist link
+async def update_home_tab_view(client, app_user: UserSummary, weekly_poll: WeeklyPoll, logger, offset: int = 0, degraded: bool = False):
+    """
+    Render and publish the Home tab of a user for the given poll.
+    When Firestore is unavailable, or degraded is set, the view is rendered from cached data.
+    """
+    team_id = app_user.team_id
+    categories = None
+    if not degraded:
+        try:
+            spotify_installation = None
+            if app_user.is_admin:
+                spotify_installation = await spotify_installation_store.get_installation(team_id)
+
+            # This week's poll of every active category, in one batched read
+            categories = await poll_categories_store.get_active_categories(team_id)
+            poll_ids = {category.id: WeeklyPoll.generate_poll_id(category.id) for category in categories}
+            polls_by_id = await weekly_polls_store.get_polls(team_id, [poll_id for poll_id in poll_ids.values() if poll_id != weekly_poll.poll_id])
+        except DependencyUnavailable as e:
+            logger.warning("Rendering a degraded home tab view: %s", e)
+            degraded = True
+
+    if degraded:
+        spotify_installation = spotify_installation_store.get_last_known_installation(team_id) if app_user.is_admin else None
+        categories = poll_categories_store.get_last_known_active_categories(team_id)
+        poll_ids = {category.id: WeeklyPoll.generate_poll_id(category.id) for category in categories}
+        polls_by_id = weekly_polls_store.get_last_known_polls(team_id, [poll_id for poll_id in poll_ids.values() if poll_id != weekly_poll.poll_id])
+
+    polls_by_id[weekly_poll.poll_id] = weekly_poll
+    category_polls = {category_id: polls_by_id[poll_id] for category_id, poll_id in poll_ids.items() if poll_id in polls_by_id}
+
+    if cache_watcher is not None and not degraded:
+        cache_watcher.touch(team_id, list(polls_by_id))
+
+    view = await build_home_view(
+        app_user,
+        weekly_poll,
+        lambda voter_id: get_voter(client, team_id, voter_id, degraded),
+        spotify_installation=spotify_installation,
+        offset=offset,
+        categories=categories,
+        category_polls=category_polls,
+        degraded=degraded,
+    )
+    await publish_home_view(client, team_id, app_user.id, view, logger)
 
 
-        
+async def get_voter(client, team_id: str, voter_id: str, degraded: bool) -> UserSummary:
+    """
+    A voter shown on the Home tab, only known by ID when Firestore is unavailable and they aren't cached.
+    """
+    if not degraded:
+        try:
+            return await get_or_create_user(client, team_id, voter_id)
+        except DependencyUnavailable:
+            pass
+    return user_store.get_last_known_user_summary(team_id, voter_id) or UserSummary(id=voter_id, team_id=team_id, name=voter_id)
 
-    if app_user.is_admin:
-        # Show admin controls
-        view_blocks.append({
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "*Admin Controls:*"
-            }
-        })
-        view_blocks.append({
-            "type": "actions",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Change Poll Status"
-                    },
-                    "action_id": "change_poll_status",
-                }
-            ]
-        })
-
-        spotify_installation = await spotify_installation_store.get_installation(app_user.team_id)
-
-        print("spotify installation:", spotify_installation)
-
-        if spotify_installation is None:
-            # install spotify button
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "Install Spotify to create playlists"
-                },
-                "accessory": {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Install Spotify"
-                    },
-                    "action_id": "install_spotify",
-                }
-            })
 
-        else:
-            # show playlist link
-            view_blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"Spotify Installation found."
-                },
-                "accessory": {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Uninstall Spotify"
-                    },
-                    "action_id": "uninstall_spotify",
-                }
-            })
-
-        if await user_has_submitted_song(app_user, weekly_poll):
-            view_blocks.append({
-                "type": "actions",
-                "elements": [
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Unsubmit Song"
-                        },
-                        "action_id": "unsubmit_song",
-                    }
-                ]
-            })
-        
-        if await user_has_voted(app_user):
-            view_blocks.append({
-                "type": "actions",
-                "elements": [
-                    {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Unvote"
-                        },
-                        "action_id": "unvote",
-                    }
-                ]
-            })
+async def publish_degraded_home_tab(client, team_id: str, user_id: str, category_id: Optional[str], logger):
+    """
+    Publish the Home tab from cached data only, for when Firestore is unavailable.
+    """
+    app_user = user_store.get_last_known_user_summary(team_id, user_id) or UserSummary(id=user_id, team_id=team_id, name=user_id)
+    categories = poll_categories_store.get_last_known_active_categories(team_id)
+    category = next((category for category in categories if category.id == category_id), categories[0])
+    poll_id = WeeklyPoll.generate_poll_id(category.id)
+    weekly_poll = weekly_polls_store.get_last_known_polls(team_id, [poll_id]).get(poll_id)
+
+    if weekly_poll is None:
+        await publish_home_view(client, team_id, user_id, build_unavailable_view(), logger)
+        return
+    await update_home_tab_view(client, app_user, weekly_poll, logger, degraded=True)
 
 
+async def publish_home_view(client, team_id: str, user_id: str, view: dict, logger):
     # Publish the view to the Home tab
     try:
-        await client.views_publish(
-            user_id=app_user.id,
-            view={
-                "type": "home",
-                "callback_id": "home_view",
-                "blocks": [
-                    {
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": "*Welcome to your _App's Home tab_* :tada:"
-                        }
-                    },
-                    {
-                        "type": "divider"
-                    },
-                    *view_blocks,  # Include the dynamically generated blocks here
-                ]
-            }
+        await slack_dispatcher.call(
+            client,
+            "views_publish",
+            team_id,
+            user_id=user_id,
+            view=view,
         )
 
     except Exception as e:
-        logger.error(f"Error publishing home tab view: {str(e)}")
+        logger.error("Error publishing home tab view: %s", e)
+        if is_rate_limited(e):
+            # Still rate limited after the retries, a DM would only add to the problem
+            return
         try:
-            await client.chat_postMessage(
-                channel=app_user.id,
+            await slack_dispatcher.call(
+                client,
+                "chat_postMessage",
+                team_id,
+                channel=user_id,
                 text="Error publishing home tab view. Please try again later.: " + str(e)
             )
         except Exception as e:
-            logger.error(f"Error sending error message: {str(e)}")
+            logger.error("Error sending error message: %s", e)
+
+
+@app.error
+async def handle_errors(error, body, client, logger):
+    """
+    Handlers failing because Firestore is unavailable leave the user a Home tab built from cached
+    data, and the ones failing because Spotify is unavailable tell the user to try again later.
+    """
+    if not isinstance(error, DependencyUnavailable):
+        logger.exception("Error handling request: %s", error)
+        return
+
+    logger.warning("Dependency unavailable: %s", error)
+    body = body or {}
+    user = body.get("user")
+    if isinstance(user, dict) and user.get("team_id"):
+        team_id, user_id = user["team_id"], user["id"]
+    elif body.get("event", {}).get("type") == "app_home_opened":
+        team_id, user_id = body["team_id"], body["event"]["user"]
+    else:
+        return
+
+    if error.dependency == spotify_breaker.name:
+        try:
+            await slack_dispatcher.call(
+                client,
+                "chat_postMessage",
+                team_id,
+                channel=user_id,
+                text="Spotify isn't responding right now, please try again in a minute.",
+            )
+        except Exception as e:
+            logger.error("Error sending error message: %s", e)
+        return
+
+    await publish_degraded_home_tab(client, team_id, user_id, get_selected_category(body.get("event") or body), logger)
 
 @app.event("app_home_opened")
-async def update_home_tab(client, event, logger):
+@handler_scheduler.handler(Priority.BULK)
+async def update_home_tab(client, event, body, logger):
     if event.get("tab") != "home":
         return
-    
-    print("app home opened")
 
     team_id = event["view"]['team_id']
     user_id = event["user"]
+    log.info("Home tab opened", extra={"handler": "app_home_opened", "team_id": team_id, "user_id": user_id})
 
-    app_user = await get_or_create_user(client, team_id, user_id)  # type: User
-    poll_id = WeeklyPoll.generate_poll_id()
-    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, poll_id)
+    app_user = await get_or_create_user(client, team_id, user_id)  # type: UserSummary
+    # The Home tab keeps showing the category the user picked last
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(event))
 
-    print("got user:", app_user.id)
-    print("got weekly poll:", weekly_poll.poll_id)
+    log.debug("Showing poll %s to %s", weekly_poll.poll_id, app_user.id, extra={"handler": "app_home_opened"})
 
     await update_home_tab_view(client, app_user, weekly_poll, logger)
 
-# Helper functions (to be defined)
-async def user_has_submitted_song(user: User, poll: WeeklyPoll):
-    # Logic to check if the user has submitted a song
-    return user.slack_music_config.submitted
+@app.action("home_page_next")
+@app.action("home_page_first")
+@handler_scheduler.handler(Priority.INTERACTIVE)
+async def handle_home_page(ack, body, client, logger):
+    await ack()
+
+    team_id = body["user"]["team_id"]
+
+    user_id = body["user"]["id"]
+
+    offset = int(body["actions"][0]["value"])
+
+    app_user = await get_or_create_user(client, team_id, user_id)
+
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(body))
+
+    await update_home_tab_view(client, app_user, weekly_poll, logger, offset=offset)
 
-async def user_has_voted(user: User):
-    # Logic to check if the user has voted
-    return user.slack_music_config.voted
+@app.action(re.compile("^home_select_category_"))
+@handler_scheduler.handler(Priority.INTERACTIVE)
+async def handle_select_category(ack, body, client, logger):
+    await ack()
+
+    team_id = body["user"]["team_id"]
+
+    user_id = body["user"]["id"]
 
-async def get_poll_submissions(weekly_poll: WeeklyPoll) -> List[SongInfo]:
-    # Logic to retrieve submissions for the poll
-    return weekly_poll.songs.values()
+    app_user = await get_or_create_user(client, team_id, user_id)
 
-async def get_voting_options(weekly_poll: WeeklyPoll) -> List[SongInfo]:
-    # Logic to retrieve voting options for the poll
-    return weekly_poll.songs.values()  # Assuming songs is a dictionary of SongInfo 
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, body["actions"][0]["value"])
 
-async def get_vote_information(weekly_poll: WeeklyPoll) -> Optional[VoteInfo]:
-    # Logic to retrieve vote information for the poll
-    return weekly_poll.votes.values()
+    await update_home_tab_view(client, app_user, weekly_poll, logger)
 
 @app.action("click_me_button")
 async def handle_some_action(ack, body, logger):
     await ack()
-    logger.info(body)
-    print("button clicked")
-
-def is_spotify_track_link(input_string):
-    # Regular expression to match the Spotify track URL
-    pattern = r"^https://open\.spotify\.com/track/([a-zA-Z0-9]{22})(\?si=[a-zA-Z0-9]+)?$"
-    match = re.match(pattern, input_string)
-    
-    # If a match is found, return the track ID (first capture group)
-    if match:
-        return match.group(1)  # The track ID is captured here
-    return None
+    log_payload("click_me_button", body)
 
 # Function to open an error modal
-async def show_error_modal(client, trigger_id, error_message, title="Error", close_message="Close"):
+async def show_error_modal(client, team_id, trigger_id, error_message, title="Error", close_message="Close"):
     error_view = {
         "type": "modal",
         "title": {"type": "plain_text", "text": title},
@@ -468,13 +476,14 @@ async def show_error_modal(client, trigger_id, error_message, title="Error", clo
             }
         ]
     }
-    await client.views_open(trigger_id=trigger_id, view=error_view)
+    # trigger_ids expire after 3 seconds, so modals skip ahead of bulk calls
+    await slack_dispatcher.call(client, "views_open", team_id, priority=Priority.INTERACTIVE, trigger_id=trigger_id, view=error_view)
 
 @app.action("change_poll_status")
+@handler_scheduler.handler(Priority.INTERACTIVE)
 async def handle_change_poll_status(ack, body, client, logger):
     await ack()
-    logger.info(body)
-    print("change poll status")
+    log_payload("change_poll_status", body)
 
     team_id = body["user"]["team_id"]
 
@@ -482,16 +491,14 @@ async def handle_change_poll_status(ack, body, client, logger):
 
     trigger_id = body["trigger_id"]
 
-    app_user = await get_or_create_user(client, team_id, user_id)  # type: User
+    app_user = await get_or_create_user(client, team_id, user_id)  # type: UserSummary
     
 
-    poll_id = WeeklyPoll.generate_poll_id()
-
-    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, poll_id)
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(body))
 
     if not app_user.is_admin:
-        print("User is not an admin")
-        await show_error_modal(client, trigger_id, "You do not have permission to change the poll status.", title="Permission Denied", close_message="Got it!")
+        log.info("User is not an admin", extra={"handler": "change_poll_status", "team_id": team_id, "user_id": user_id})
+        await show_error_modal(client, team_id, trigger_id, "You do not have permission to change the poll status.", title="Permission Denied", close_message="Got it!")
         return
     
     # Logic to change the poll status
@@ -504,19 +511,42 @@ async def handle_change_poll_status(ack, body, client, logger):
 
     elif weekly_poll.status == "voting_open":
         weekly_poll.status = "closed"
-    
+
+        if weekly_poll.vote_shards:
+            weekly_poll.vote_counts = await weekly_polls_store.summarize_votes(app_user.team_id, weekly_poll.poll_id)
+
     elif weekly_poll.status == "closed":
         weekly_poll.status = "submissions_open"
 
-    await weekly_polls_store.save_poll(app_user.team_id, weekly_poll)
+    async with UnitOfWork(weekly_polls_store.db, breaker=firestore_breaker) as unit:
+        weekly_polls_store.stage_status(unit, app_user.team_id, weekly_poll)
+
+    if weekly_poll.status == "closed":
+        await record_poll_winner(app_user.team_id, weekly_poll)
 
     await update_home_tab_view(client, app_user, weekly_poll, logger)
 
+async def record_poll_winner(team_id: str, weekly_poll: WeeklyPoll):
+    """
+    Remember the winner of a closed poll, so it can't be submitted again in a later week.
+    Like the results view, only songs still in the poll can win. The poll is closed whether or
+    not the index write succeeds.
+    """
+    votes_count = {song_id: count for song_id, count in weekly_poll.count_votes().items() if song_id in weekly_poll.songs}
+    if not votes_count:
+        return
+
+    winner_id = max(votes_count, key=votes_count.get)
+    try:
+        await song_index_store.record_winner(team_id, weekly_poll.poll_id, weekly_poll.songs[winner_id])
+    except Exception as e:
+        log.error("Error recording the winner of %s: %s", weekly_poll.poll_id, e, extra={"team_id": team_id})
+
 @app.action("unsubmit_song")
+@handler_scheduler.handler(Priority.INTERACTIVE)
 async def handle_unsubmit_song(ack, body, client, logger):
     await ack()
-    logger.info(body)
-    print("unsubmit song")
+    log_payload("unsubmit_song", body)
 
     team_id = body["user"]["team_id"]
 
@@ -526,27 +556,35 @@ async def handle_unsubmit_song(ack, body, client, logger):
 
     app_user = await get_or_create_user(client, team_id, user_id)
 
-    poll_id = WeeklyPoll.generate_poll_id()
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(body))
 
-    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, poll_id)
-
-    if not app_user.slack_music_config.submitted:
-        print("User has not submitted a song")
-        await show_error_modal(client, trigger_id, "You have not submitted a song yet.", title="Not Submitted", close_message="Got it!")
+    if not app_user.slack_music_config.has_submitted(weekly_poll.poll_id):
+        log.info("User has not submitted a song", extra={"handler": "unsubmit_song", "team_id": team_id, "user_id": user_id})
+        await show_error_modal(client, team_id, trigger_id, "You have not submitted a song yet.", title="Not Submitted", close_message="Got it!")
         await update_home_tab_view(client, app_user, weekly_poll, logger)
         return
 
-    app_user.slack_music_config.submitted = False
+    # The user's songs leave the poll and the index together with the user's flag
+    submitted_song_ids = [song_id for song_id, song in weekly_poll.songs.items() if song.submitted_by == user_id]
+
+    app_user = app_user.with_music_config(
+        submitted_polls=[poll_id for poll_id in app_user.slack_music_config.submitted_polls if poll_id != weekly_poll.poll_id],
+        submissions=[song_id for song_id in app_user.slack_music_config.submissions if song_id not in submitted_song_ids],
+    )
 
-    await user_store.save_user(team_id, user_id, app_user)
+    async with UnitOfWork(weekly_polls_store.db, breaker=firestore_breaker) as unit:
+        for song_id in submitted_song_ids:
+            weekly_polls_store.stage_remove_song(unit, team_id, weekly_poll, song_id)
+            await song_index_store.stage_remove_submission(unit, team_id, weekly_poll.poll_id, song_id)
+        user_store.stage_music_config(unit, team_id, user_id, app_user)
 
     await update_home_tab_view(client, app_user, weekly_poll, logger)
 
 @app.action("install_spotify")
+@handler_scheduler.handler(Priority.INTERACTIVE)
 async def handle_install_spotify(ack, body, client, logger):
     await ack()
-    logger.info(body)
-    print("unsubmit song")
+    log_payload("install_spotify", body)
 
     team_id = body["user"]["team_id"]
 
@@ -559,18 +597,21 @@ async def handle_install_spotify(ack, body, client, logger):
     spotify_install_link = general_spotify_client.get_install_link(team_id, user_id)
 
     try:
-        await client.chat_postMessage(
+        await slack_dispatcher.call(
+            client,
+            "chat_postMessage",
+            team_id,
             channel=app_user.id,
             text=f"Click [here]({spotify_install_link}) to install Spotify"
         )
     except Exception as e:
-        logger.error(f"Error sending Spotify install link: {str(e)}")
+        logger.error("Error sending Spotify install link: %s", e)
 
 @app.action("unvote")
+@handler_scheduler.handler(Priority.INTERACTIVE)
 async def handle_unvote(ack, body, client, logger):
     await ack()
-    logger.info(body)
-    print("unvote")
+    log_payload("unvote", body)
 
     team_id = body["user"]["team_id"]
 
@@ -580,19 +621,25 @@ async def handle_unvote(ack, body, client, logger):
 
     app_user = await get_or_create_user(client, team_id, user_id)
 
-    poll_id = WeeklyPoll.generate_poll_id()
-
-    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, poll_id)
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(body))
 
-    if not app_user.slack_music_config.voted:
-        print("User has not voted")
-        await show_error_modal(client, trigger_id, "You have not voted yet.", title="Not Voted", close_message="Got it!")
+    if not app_user.slack_music_config.has_voted(weekly_poll.poll_id):
+        log.info("User has not voted", extra={"handler": "unvote", "team_id": team_id, "user_id": user_id})
+        await show_error_modal(client, team_id, trigger_id, "You have not voted yet.", title="Not Voted", close_message="Got it!")
         await update_home_tab_view(client, app_user, weekly_poll, logger)
         return
 
-    app_user.slack_music_config.voted = False
+    app_user = app_user.with_music_config(
+        voted_polls=[poll_id for poll_id in app_user.slack_music_config.voted_polls if poll_id != weekly_poll.poll_id],
+    )
 
-    await user_store.save_user(team_id, user_id, app_user)
+    # The vote is removed from the poll in the same commit as the user's flag
+    try:
+        async with UnitOfWork(weekly_polls_store.db, breaker=firestore_breaker) as unit:
+            await weekly_polls_store.stage_retract_vote(unit, team_id, weekly_poll, user_id)
+            user_store.stage_music_config(unit, team_id, user_id, app_user)
+    except FailedPrecondition:
+        log.info("Vote was already retracted", extra={"handler": "unvote", "team_id": team_id, "user_id": user_id})
 
     await update_home_tab_view(client, app_user, weekly_poll, logger)
 
@@ -603,16 +650,26 @@ class SpotifyClient:
     REDIRECT_URI = f'{APP_HOST}{REDIRECT_ENDPOINT}'  # Make sure this URI is whitelisted in your Spotify app settings
     SCOPES = 'playlist-modify-public,playlist-modify-private'
 
+    # Seconds before a Spotify request is given up, calls running in worker threads can't be cancelled
+    REQUEST_TIMEOUT = 10
+
     def __init__(self, client_id, client_secret):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.access_token = self.get_access_token()
+        self._access_token = None
+
+    @property
+    def access_token(self):
+        # Fetched on first use, so importing the app doesn't call Spotify
+        if self._access_token is None:
+            self._access_token = self.get_access_token()
+        return self._access_token
 
     def get_access_token(self):
         # Logic to retrieve the access token
         url = "https://accounts.spotify.com/api/token"
         payload = {'grant_type': 'client_credentials'}
-        response = requests.post(url, data=payload, auth=HTTPBasicAuth(self.client_id, self.client_secret))
+        response = requests.post(url, data=payload, auth=HTTPBasicAuth(self.client_id, self.client_secret), timeout=self.REQUEST_TIMEOUT)
         response_data = response.json()
         return response_data['access_token']
 
@@ -628,7 +685,7 @@ class SpotifyClient:
             "Authorization": generate_auth_header(self.client_id, self.client_secret)
         }
         
-        response = requests.post('https://accounts.spotify.com/api/token', data=payload, headers=headers)
+        response = requests.post('https://accounts.spotify.com/api/token', data=payload, headers=headers, timeout=self.REQUEST_TIMEOUT)
 
         if response.status_code == 200:
             return response.json()  # Successful token response
@@ -639,9 +696,68 @@ class SpotifyClient:
         # Logic to retrieve song information from the Spotify API
         url = f"https://api.spotify.com/v1/tracks/{track_id}"
         headers = {'Authorization': f'Bearer {self.access_token}'}
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=self.REQUEST_TIMEOUT)
         response_data = response.json()
         return response_data
+
+    # Spotify's limit of IDs per /tracks request
+    MAX_TRACKS_PER_REQUEST = 50
+
+    def get_tracks(self, track_ids: List[str]) -> List[dict]:
+        # Several tracks per request, in the order of track_ids
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        tracks = []
+        for start in range(0, len(track_ids), self.MAX_TRACKS_PER_REQUEST):
+            ids = ",".join(track_ids[start:start + self.MAX_TRACKS_PER_REQUEST])
+            response = requests.get("https://api.spotify.com/v1/tracks", params={"ids": ids}, headers=headers, timeout=self.REQUEST_TIMEOUT)
+            tracks.extend(track for track in response.json().get('tracks', []) if track)
+        return tracks
+
+    # Spotify's limits of IDs per /audio-features and /artists request
+    MAX_AUDIO_FEATURES_PER_REQUEST = 100
+    MAX_ARTISTS_PER_REQUEST = 50
+
+    def get_audio_features(self, track_ids: List[str]) -> List[dict]:
+        # Audio features of several tracks per request, tracks without features are left out
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        audio_features = []
+        for start in range(0, len(track_ids), self.MAX_AUDIO_FEATURES_PER_REQUEST):
+            ids = ",".join(track_ids[start:start + self.MAX_AUDIO_FEATURES_PER_REQUEST])
+            response = requests.get("https://api.spotify.com/v1/audio-features", params={"ids": ids}, headers=headers, timeout=self.REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                # Not every Spotify app has access to audio features, the songs still get their genres
+                log.warning("Error getting audio features: %s", response.status_code)
+                continue
+            audio_features.extend(features for features in response.json().get('audio_features', []) if features)
+        return audio_features
+
+    def get_artists(self, artist_ids: List[str]) -> List[dict]:
+        # Several artists per request, with their genres
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        artists = []
+        for start in range(0, len(artist_ids), self.MAX_ARTISTS_PER_REQUEST):
+            ids = ",".join(artist_ids[start:start + self.MAX_ARTISTS_PER_REQUEST])
+            response = requests.get("https://api.spotify.com/v1/artists", params={"ids": ids}, headers=headers, timeout=self.REQUEST_TIMEOUT)
+            artists.extend(artist for artist in response.json().get('artists', []) if artist)
+        return artists
+
+    def get_album_tracks(self, album_id: str) -> List[dict]:
+        # First 50 tracks of an album in one request
+        url = f"https://api.spotify.com/v1/albums/{album_id}/tracks"
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        response = requests.get(url, params={"limit": 50}, headers=headers, timeout=self.REQUEST_TIMEOUT)
+        return response.json().get('items', [])
+
+    def get_playlist_tracks(self, playlist_id: str) -> List[dict]:
+        # First 100 tracks of a playlist in one request, with only the fields we use
+        url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        params = {"limit": 100, "fields": "items(track(id,name,type,artists(name)))"}
+        response = requests.get(url, params=params, headers=headers, timeout=self.REQUEST_TIMEOUT)
+        return [
+            item['track'] for item in response.json().get('items', [])
+            if item.get('track') and item['track'].get('id') and item['track'].get('type', 'track') == 'track'
+        ]
     
     def get_install_link(self, team_id: str, user_id: str):
 
@@ -671,6 +787,36 @@ SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET", None)
 
 general_spotify_client = SpotifyClient(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
 
+# The Spotify calls of the handlers, run in worker threads with a deadline and a circuit breaker
+spotify_breaker = CircuitBreaker(
+    "spotify",
+    timeout=float(os.getenv("SPOTIFY_TIMEOUT", "15")),
+    failure_threshold=int(os.getenv("SPOTIFY_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("SPOTIFY_BREAKER_RESET", "60")),
+)
+# Calls made by a handler also hold an outbound slot of its team, the enricher's batches don't
+spotify_api = Scheduled(Guarded(general_spotify_client, spotify_breaker, blocking=True), outbound_scheduler)
+
+# Audio features and genres of submitted songs, looked up in batches in the background
+song_enricher = SongEnricher(
+    spotify_api,
+    weekly_polls_store,
+    interval=float(os.getenv("SONG_ENRICHMENT_INTERVAL", "10")),
+)
+
+# Optional snapshots of the store caches in a local SQLite file, so restarts and deploys start warm.
+# The installation caches hold tokens and are never written to disk.
+cache_snapshot = None
+if os.getenv("CACHE_SNAPSHOT_PATH"):
+    from cache_snapshot import CacheSnapshot
+    cache_snapshot = CacheSnapshot(os.environ["CACHE_SNAPSHOT_PATH"])
+    cache_snapshot.register(user_store.cache, UserSummary)
+    cache_snapshot.register(weekly_polls_store.cache)
+    cache_snapshot.register(poll_categories_store.cache)
+    cache_snapshot.register(song_index_store.cache)
+    cache_snapshot.register(song_enricher.features_cache)
+    cache_snapshot.register(song_enricher.genres_cache)
+
 
 def generate_auth_header(client_id, client_secret):
     """
@@ -696,7 +842,7 @@ def handle_token_exchange(code):
         "Authorization": generate_auth_header(general_spotify_client.client_id, general_spotify_client.client_secret)
     }
     
-    response = requests.post('https://accounts.spotify.com/api/token', data=payload, headers=headers)
+    response = requests.post('https://accounts.spotify.com/api/token', data=payload, headers=headers, timeout=SpotifyClient.REQUEST_TIMEOUT)
 
     if response.status_code == 200:
         return response.json()  # Successful token response
@@ -705,28 +851,27 @@ def handle_token_exchange(code):
 
 
 async def install_spotify_callback(_req: web.Request):
+    status, text = await complete_spotify_install(_req.query.get("code"), _req.query.get("state"))
+    return web.Response(text=text, status=status)
 
-    print("install spotify callback")
-
-    code = _req.query.get("code")
 
-    state = _req.query.get("state")
-
-    print("code:", code)
-    print("state:", state)
+async def complete_spotify_install(code: Optional[str], state: Optional[str]) -> Tuple[int, str]:
+    """
+    Handle the Spotify OAuth redirect, independent of the web framework serving it.
+    Returns the HTTP status and text of the response.
+    """
+    log.info("Spotify install callback", extra={"handler": "spotify_install"})
 
     if code is None:
-        return web.Response(text="Error: Missing code parameter", status=400)
+        return 400, "Error: Missing code parameter"
     
     if state is None:
-        return web.Response(text="Error: Missing state parameter", status=400)
+        return 400, "Error: Missing state parameter"
     
-    token_response = general_spotify_client.token_exchange(code)
+    token_response = await spotify_api.token_exchange(code)
 
     if "error" in token_response:
-        return web.Response(text=f"Error: {token_response['error']}", status=400)
-
-    print("token response:", token_response)
+        return 400, f"Error: {token_response['error']}"
 
     state_decoded = base64.b64decode(state).decode("utf-8")
 
@@ -736,9 +881,7 @@ async def install_spotify_callback(_req: web.Request):
 
     user_id = state_data["user_id"]
 
-    print("team_id:", team_id)
-
-    print("user_id:", user_id)
+    log.info("Spotify installed", extra={"handler": "spotify_install", "team_id": team_id, "user_id": user_id})
 
     access_token = token_response['access_token']
     refresh_token = token_response['refresh_token']
@@ -746,15 +889,193 @@ async def install_spotify_callback(_req: web.Request):
 
     await spotify_installation_store.save_installation(team_id, user_id, access_token, refresh_token, expires_in)
 
-    return web.Response(text="Spotify installed successfully")
+    return 200, "Spotify installed successfully"
+
+async def metrics_endpoint(_req: web.Request):
+    return web.json_response(metrics.collect())
+
+
+async def warm_up_caches():
+    """
+    Preload the users and the current polls of the teams listed in CACHE_WARMUP_TEAM_IDS,
+    so the first requests after a restart are served from memory.
+    """
+    team_ids = [team_id.strip() for team_id in os.getenv("CACHE_WARMUP_TEAM_IDS", "").split(",") if team_id.strip()]
+    for team_id in team_ids:
+        try:
+            categories = await poll_categories_store.get_active_categories(team_id)
+            users_loaded, _ = await asyncio.gather(
+                user_store.warm_up(team_id),
+                weekly_polls_store.get_polls(team_id, [WeeklyPoll.generate_poll_id(category.id) for category in categories]),
+            )
+            log.info("Warmed up caches for %s: %d users", team_id, users_loaded)
+        except Exception as e:
+            log.error("Error warming up caches for %s: %s", team_id, e)
+
+
+# Tasks running for the lifetime of the process
+background_tasks: List[asyncio.Task] = []
+
+
+async def start_background_services():
+    """
+    Start everything that runs next to the handlers, whichever server mode runs the app.
+    """
+    if cache_snapshot is not None:
+        cache_snapshot.load()
+        background_tasks.append(asyncio.create_task(cache_snapshot.run(float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "60")))))
+    await warm_up_caches()
+    if cache_watcher is not None:
+        background_tasks.append(asyncio.create_task(cache_watcher.run()))
+    user_store.write_behind.start()
+    background_tasks.append(asyncio.create_task(weekly_polls_store.run_summarizer(VOTE_SUMMARY_INTERVAL)))
+    background_tasks.append(asyncio.create_task(song_enricher.run()))
+
+
+async def stop_background_services():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await weekly_polls_store.summarize_pending()
+    if cache_watcher is not None:
+        cache_watcher.close()
+    await user_store.write_behind.close()
+    if cache_snapshot is not None:
+        try:
+            await cache_snapshot.save()
+        except Exception as e:
+            log.error("Error saving the cache snapshot: %s", e)
+        cache_snapshot.close()
+
+
+async def on_web_app_startup(_app: web.Application):
+    await start_background_services()
+
+
+async def on_web_app_cleanup(_app: web.Application):
+    await stop_background_services()
+
+web_app = app.web_app(port=PORT)
+web_app.add_routes([
+    web.get(SpotifyClient.REDIRECT_ENDPOINT, install_spotify_callback),
+    web.get("/metrics", metrics_endpoint),
+])
+web_app.on_startup.append(on_web_app_startup)
+web_app.on_cleanup.append(on_web_app_cleanup)
+
+
+async def expand_spotify_links(links: List[SpotifyLink]) -> List[dict]:
+    """
+    Tracks ({id, name, artists}) of the given links, in order and without duplicates.
+    Albums and playlists take one Spotify call each, and all single tracks share one batched call.
+    """
+    track_ids = [link.id for link in links if link.kind == "track"]
+    tracks_by_id = {track['id']: track for track in await spotify_api.get_tracks(track_ids)} if track_ids else {}
+
+    tracks = []
+    for link in links:
+        if link.kind == "track":
+            link_tracks = [tracks_by_id[link.id]] if link.id in tracks_by_id else []
+        elif link.kind == "album":
+            link_tracks = await spotify_api.get_album_tracks(link.id)
+        else:
+            link_tracks = await spotify_api.get_playlist_tracks(link.id)
+        tracks.extend(link_tracks)
+
+    unique_tracks = {}
+    for track in tracks:
+        unique_tracks.setdefault(track['id'], track)
+    return list(unique_tracks.values())
+
+
+def build_song_picker_modal(tracks: List[dict], category_id: str) -> dict:
+    options = [
+        {
+            "text": {
+                "type": "plain_text",
+                # Option texts are limited to 75 characters
+                "text": f"{track['name']} - {', '.join(artist['name'] for artist in track['artists'])}"[:75],
+            },
+            "value": track['id'],
+        }
+        # Select menus are limited to 100 options
+        for track in tracks[:100]
+    ]
+    return {
+        "type": "modal",
+        "callback_id": "pick_submitted_song",
+        "private_metadata": category_id,
+        "title": {"type": "plain_text", "text": "Pick your song"},
+        "submit": {"type": "plain_text", "text": "Submit"},
+        "close": {"type": "plain_text", "text": "Cancel"},
+        "blocks": [
+            {
+                "type": "input",
+                "block_id": "picked_song",
+                "label": {"type": "plain_text", "text": "Your link has several songs, which one do you submit?"},
+                "element": {
+                    "type": "static_select",
+                    "action_id": "picked_song",
+                    "options": options,
+                },
+            }
+        ]
+    }
+
+
+async def validate_song_submission(team_id: str, weekly_poll: WeeklyPoll, track_id: str) -> Optional[str]:
+    """
+    Returns an error message if the track can't be submitted to the poll, None otherwise.
+    """
+    if track_id in weekly_poll.songs:
+        return "This song has already been submitted to this week's poll."
+
+    # A single indexed lookup tells whether the song won an earlier poll
+    index_entry = await song_index_store.get_entry(team_id, track_id)
+    if index_entry is not None and index_entry.won_in:
+        return f"This song already won the {index_entry.won_in[-1]} poll."
+
+    return None
+
+
+async def submit_song(client, app_user: UserSummary, weekly_poll: WeeklyPoll, track_id: str, logger) -> Optional[str]:
+    """
+    Add a track to the poll on behalf of the user.
+    Returns an error message if the track can't be submitted, None on success.
+    """
+    team_id = app_user.team_id
+
+    error_message = await validate_song_submission(team_id, weekly_poll, track_id)
+    if error_message is not None:
+        return error_message
+
+    # Add the song to the weekly poll
+
+    song_info = await get_song_info(app_user.id, track_id)
+
+    # Save the submitted song to the user's profile
+    app_user = app_user.with_music_config(
+        submitted_polls=[*app_user.slack_music_config.submitted_polls, weekly_poll.poll_id],
+        submissions=[*app_user.slack_music_config.submissions, track_id],
+    )
 
-web_app = app.web_app()
-web_app.add_routes([web.get(SpotifyClient.REDIRECT_ENDPOINT, install_spotify_callback)])
+    # The poll, the song index and the user are written in one commit
+    async with UnitOfWork(weekly_polls_store.db, breaker=firestore_breaker) as unit:
+        weekly_polls_store.stage_song(unit, team_id, weekly_poll, song_info)
+        await song_index_store.stage_submission(unit, team_id, weekly_poll.poll_id, song_info)
+        user_store.stage_music_config(unit, team_id, app_user.id, app_user)
+
+    # Features and genres are added in the background, the submission doesn't wait for Spotify
+    song_enricher.enqueue(team_id, weekly_poll.poll_id, song_info)
+
+    # Update the Home tab view
+    await update_home_tab_view(client, app_user, weekly_poll, logger)
+    return None
 
 
 async def get_song_info(user_id: str, track_id: str) -> SongInfo:
     # Logic to retrieve song information from the Spotify API
-    track_data = general_spotify_client.get_song_info(track_id)
+    track_data = await spotify_api.get_song_info(track_id)
     return SongInfo(
         id=track_id,
         link=f"https://open.spotify.com/track/{track_id}",
@@ -762,11 +1083,13 @@ async def get_song_info(user_id: str, track_id: str) -> SongInfo:
         artist=", ".join(artist['name'] for artist in track_data['artists']),
         album=track_data['album']['name'],
         image_url=track_data['album']['images'][0]['url'] if track_data['album']['images'] else None,
-        submitted_by=user_id
+        submitted_by=user_id,
+        artist_ids=[artist['id'] for artist in track_data['artists'] if artist.get('id')],
     )
 
 # Define the action handler with a regular expression to match dynamic action IDs
 @app.action("vote")
+@handler_scheduler.handler(Priority.INTERACTIVE)
 async def handle_vote_action(ack, body, client, logger):
     # Acknowledge the action
     await ack()
@@ -779,38 +1102,41 @@ async def handle_vote_action(ack, body, client, logger):
 
     app_user = await get_or_create_user(client, team_id, user_id)
 
-    poll_id = WeeklyPoll.generate_poll_id()
-
-    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, poll_id)
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(body))
 
-    if app_user.slack_music_config.voted:
-        print("User has already voted")
-        await show_error_modal(client, body["trigger_id"], "You have already voted.", title="Already Voted", close_message="Got it!")
+    if app_user.slack_music_config.has_voted(weekly_poll.poll_id):
+        log.info("User has already voted", extra={"handler": "vote", "team_id": team_id, "user_id": user_id})
+        await show_error_modal(client, team_id, body["trigger_id"], "You have already voted.", title="Already Voted", close_message="Got it!")
         await update_home_tab_view(client, app_user, weekly_poll, logger)
         return
 
-    # Cast the vote
-    weekly_poll.votes[user_id] = VoteInfo(
-        voted_for=song_id,
-        voted_at=datetime.now(),
-        voted_by=user_id
+    app_user = app_user.with_music_config(
+        voted_polls=[*app_user.slack_music_config.voted_polls, weekly_poll.poll_id],
     )
 
-    await weekly_polls_store.save_poll(app_user.team_id, weekly_poll)
-
-    app_user.slack_music_config.voted = True
-
-    await user_store.save_user(team_id, user_id, app_user)
+    # Cast the vote, committed together with the user's flag
+    try:
+        async with UnitOfWork(weekly_polls_store.db, breaker=firestore_breaker) as unit:
+            weekly_polls_store.stage_vote(unit, app_user.team_id, weekly_poll, VoteInfo(
+                voted_for=song_id,
+                voted_at=datetime.now(),
+                voted_by=user_id
+            ))
+            user_store.stage_music_config(unit, team_id, user_id, app_user)
+    except AlreadyExists:
+        # The vote is in the poll already, only the user's flag was behind
+        log.info("User has already voted", extra={"handler": "vote", "team_id": team_id, "user_id": user_id})
+        await user_store.save_music_config(team_id, user_id, app_user)
 
     await update_home_tab_view(client, app_user, weekly_poll, logger)
 
 
 @app.action("submitted_song")
+@handler_scheduler.handler(Priority.INTERACTIVE)
 async def handle_submitted_song(ack, body, client, logger):
 
     await ack()
-    logger.info(body)
-    print("song submitted")
+    log_payload("submitted_song", body)
 
     team_id = body["user"]["team_id"]
 
@@ -818,52 +1144,115 @@ async def handle_submitted_song(ack, body, client, logger):
 
     trigger_id = body["trigger_id"]
 
-    app_user = await get_or_create_user(client, team_id, user_id) # type: User
+    submitted_song = body["actions"][0]["value"]
+
+    # Repeated pastes and noisy workspaces are turned away before any Spotify or Firestore work
+    admission = await submission_throttle.admit(team_id, user_id, submitted_song.strip())
+    if admission == DUPLICATE:
+        log.info("Dropping duplicate song submission", extra={"handler": "submitted_song", "team_id": team_id, "user_id": user_id})
+        return
+    if admission == THROTTLED:
+        await show_error_modal(client, team_id, trigger_id, "Too many songs are being submitted, please try again in a minute.", title="Slow Down", close_message="Got it!")
+        return
+
+    try:
+        await process_submitted_song(client, team_id, user_id, trigger_id, submitted_song, get_selected_category(body), logger)
+    finally:
+        submission_throttle.done(team_id, user_id)
+
 
-    poll_id = WeeklyPoll.generate_poll_id()
+async def process_submitted_song(client, team_id: str, user_id: str, trigger_id: str, submitted_song: str, category_id: Optional[str], logger):
+    app_user = await get_or_create_user(client, team_id, user_id) # type: UserSummary
 
-    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, poll_id)
+    weekly_poll = await get_or_create_weekly_poll(app_user.team_id, category_id)
 
-    if app_user.slack_music_config.submitted:
-        print("User has already submitted a song")
-        await show_error_modal(client, trigger_id, "You have already submitted a song for this week's poll.", title="Already Submitted", close_message="Got it!")
+    if app_user.slack_music_config.has_submitted(weekly_poll.poll_id):
+        log.info("User has already submitted a song", extra={"handler": "submitted_song", "team_id": team_id, "user_id": user_id})
+        await show_error_modal(client, team_id, trigger_id, "You have already submitted a song for this week's poll.", title="Already Submitted", close_message="Got it!")
         await update_home_tab_view(client, app_user, weekly_poll, logger)
+        return
 
-    submitted_song = body["actions"][0]["value"]
+    log.debug("User submitted %r", submitted_song, extra={"handler": "submitted_song", "team_id": team_id, "user_id": user_id})
 
-    print("User submitted song:", submitted_song)
+    # Find every Spotify track, album or playlist link in the submitted text
 
-    # Check if the submitted song is a valid Spotify track link
+    links = extract_spotify_links(submitted_song)
+
+    if not links:
+        log.info("Invalid Spotify link", extra={"handler": "submitted_song", "team_id": team_id, "user_id": user_id})
+        await show_error_modal(client, team_id, trigger_id, "Please submit a valid Spotify track, album or playlist link.", title="Invalid Link", close_message="Got it!")
+        return
 
-    track_id = is_spotify_track_link(submitted_song)
+    if len(links) == 1 and links[0].kind == "track":
+        track_ids = [links[0].id]
+    else:
+        tracks = [track for track in await expand_spotify_links(links) if track['id'] not in weekly_poll.songs]
+        if len(tracks) > 1:
+            # Let the user pick which of the songs to submit
+            await slack_dispatcher.call(
+                client,
+                "views_open",
+                team_id,
+                priority=Priority.INTERACTIVE,
+                trigger_id=trigger_id,
+                view=build_song_picker_modal(tracks, weekly_poll.category),
+            )
+            return
+        track_ids = [track['id'] for track in tracks]
 
-    if track_id is None:
-        print("Invalid Spotify track link")
-        await show_error_modal(client, trigger_id, "Please submit a valid Spotify track link.", title="Invalid Link", close_message="Got it!")
+    if not track_ids:
+        await show_error_modal(client, team_id, trigger_id, "Every song of this link has already been submitted this week.", title="Duplicate Song", close_message="Got it!")
         return
 
-    print("Spotify track ID:", track_id)
+    log.debug("Submitting track %s", track_ids[0], extra={"handler": "submitted_song", "team_id": team_id, "user_id": user_id})
 
-    # Add the song to the weekly poll
+    error_message = await submit_song(client, app_user, weekly_poll, track_ids[0], logger)
+    if error_message is not None:
+        await show_error_modal(client, team_id, trigger_id, error_message, title="Can't Submit Song", close_message="Got it!")
 
-    song_info = await get_song_info(app_user.id, track_id)
 
-    playlist = await get_weekly_playlist(weekly_poll)
+@app.view("pick_submitted_song")
+async def handle_picked_song(ack, body, client, logger):
+    team_id = body["user"]["team_id"]
 
-    weekly_poll.songs[track_id] = song_info
+    user_id = body["user"]["id"]
 
-    await weekly_polls_store.save_poll(app_user.team_id, weekly_poll)
+    track_id = body["view"]["state"]["values"]["picked_song"]["picked_song"]["selected_option"]["value"]
 
-    # Save the submitted song to the user's profile
-    app_user.slack_music_config.submitted = True
-    app_user.slack_music_config.submissions.append(track_id)
+    admission = await submission_throttle.admit(team_id, user_id, track_id)
+    if admission == DUPLICATE:
+        await ack()
+        return
+    if admission == THROTTLED:
+        await ack(response_action="errors", errors={"picked_song": "Too many songs are being submitted, please try again in a minute."})
+        return
 
-    await user_store.save_user(team_id, user_id, app_user)
+    try:
+        app_user = await get_or_create_user(client, team_id, user_id)
 
-    # Update the Home tab view
-    await update_home_tab_view(client, app_user, weekly_poll, logger)
+        weekly_poll = await get_or_create_weekly_poll(app_user.team_id, get_selected_category(body))
+
+        if app_user.slack_music_config.has_submitted(weekly_poll.poll_id):
+            await ack(response_action="errors", errors={"picked_song": "You have already submitted a song for this week's poll."})
+            return
+
+        # Validate before acknowledging so errors show in the modal, the submission itself happens after
+        error_message = await validate_song_submission(team_id, weekly_poll, track_id)
+        if error_message is not None:
+            await ack(response_action="errors", errors={"picked_song": error_message})
+            return
+
+        await ack()
+
+        # Acknowledged with the validation result, so the submission waits for a slot only now
+        async with handler_scheduler.slot(team_id, Priority.INTERACTIVE):
+            error_message = await submit_song(client, app_user, weekly_poll, track_id, logger)
+        if error_message is not None:
+            logger.error("Error submitting picked song %s: %s", track_id, error_message)
+    finally:
+        submission_throttle.done(team_id, user_id)
 
 
 
 if __name__ == "__main__":
-    app.start(3000)
+    app.start(PORT)
@@ -0,0 +1,24 @@
+from typing import Callable, Dict
+
+
+# name -> callable returning a flat dict of counters/gauges
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, collector: Callable[[], dict]):
+    """
+    Register a metrics collector under the given name.
+    Registering the same name again replaces the previous collector.
+    """
+    _collectors[name] = collector
+
+
+def unregister(name: str):
+    _collectors.pop(name, None)
+
+
+def collect() -> Dict[str, dict]:
+    """
+    Snapshot every registered collector, this is what the /metrics route exports.
+    """
+    return {name: collector() for name, collector in _collectors.items()}
@@ -0,0 +1,31 @@
+import re
+from pydantic import BaseModel
+from typing import Dict, List
+from datetime import datetime
+
+# Category of the polls teams had before categories existed, it always runs
+DEFAULT_CATEGORY = 'general'
+
+
+class PollCategory(BaseModel):
+    id: str  # Slug of the name, part of the poll IDs of the category
+    name: str
+    active: bool = True
+    created_at: datetime = datetime.now()
+
+    @classmethod
+    def slugify(cls, name: str) -> str:
+        # "Focus Music" -> "focus-music"
+        return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+
+class PollCategories(BaseModel):
+    categories: Dict[str, PollCategory] = {}  # Category ID to PollCategory mapping
+
+    def active_categories(self) -> List[PollCategory]:
+        """
+        The categories running polls, general first and the others in the order they were added.
+        """
+        general = self.categories.get(DEFAULT_CATEGORY) or PollCategory(id=DEFAULT_CATEGORY, name="General")
+        others = [category for category in self.categories.values() if category.active and category.id != DEFAULT_CATEGORY]
+        return [general, *sorted(others, key=lambda category: category.created_at)]
@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+from typing import List
+from datetime import datetime
+
+
+class SongIndexEntry(BaseModel):
+    track_id: str
+    title: str
+    artist: str
+    normalized_title: str
+    artist_keys: List[str] = []  # Normalized names of every artist of the track
+    search_prefixes: List[str] = []  # Prefixes of every word of the title and artists
+    submitted_in: List[str] = []  # Poll IDs the track was submitted to
+    won_in: List[str] = []  # Poll IDs the track won
+    first_submitted_by: str
+    last_submitted_at: datetime = datetime.now()
@@ -1,5 +1,10 @@
-from pydantic import BaseModel
-from typing import Optional, List, Union
+from pydantic import BaseModel, ConfigDict, model_validator
+from typing import Any, ClassVar, Optional, List, Union
+from models.weekly_polls import WeeklyPoll
+
+
+# Flags of a single poll in documents saved before participation was tracked per poll -> field replacing them
+LEGACY_PARTICIPATION_FLAGS = {"voted": "voted_polls", "submitted": "submitted_polls"}
 
 class Profile(BaseModel):
     title: str
@@ -29,11 +34,33 @@ class Profile(BaseModel):
 
 class SlackMusicConfig(BaseModel):
     enabled: bool = True
-    voted: bool = False
     vote_count: int = 0
     votes: List[str] = []
-    submitted: bool = False
     submissions: List[str] = []
+    voted_polls: List[str] = []  # Poll IDs the user voted in
+    submitted_polls: List[str] = []  # Poll IDs the user submitted a song to
+
+    @model_validator(mode='before')
+    @classmethod
+    def upgrade_legacy_flags(cls, data: Any) -> Any:
+        """
+        Documents saved before participation was tracked per poll have voted and submitted flags
+        for the week's general poll instead. They count as that poll's until the
+        participation_polls backfill replaces them (python backfill.py participation_polls).
+        """
+        if not isinstance(data, dict):
+            return data
+        data = dict(data)
+        for flag, field in LEGACY_PARTICIPATION_FLAGS.items():
+            if data.pop(flag, False) and field not in data:
+                data[field] = [WeeklyPoll.generate_poll_id()]
+        return data
+
+    def has_voted(self, poll_id: str) -> bool:
+        return poll_id in self.voted_polls
+
+    def has_submitted(self, poll_id: str) -> bool:
+        return poll_id in self.submitted_polls
 
 class User(BaseModel):
     id: str
@@ -58,6 +85,53 @@ class User(BaseModel):
     who_can_share_contact_card: str
     slack_music_config: SlackMusicConfig = SlackMusicConfig()
 
+    def to_summary(self) -> 'UserSummary':
+        return UserSummary(
+            id=self.id,
+            team_id=self.team_id,
+            name=self.name,
+            is_admin=self.is_admin,
+            image_24=self.profile.image_24,
+            slack_music_config=self.slack_music_config,
+        )
+
+
+class UserSummary(BaseModel):
+    """
+    Compact, immutable projection of a User with only the fields the Home tab needs.
+    This is what the user store caches; the full Slack profile is loaded only on demand.
+    """
+    model_config = ConfigDict(frozen=True)
+
+    # Firestore field paths needed to build a summary from a users document
+    FIELD_PATHS: ClassVar[List[str]] = ["id", "team_id", "name", "is_admin", "profile.image_24", "slack_music_config"]
+
+    id: str
+    team_id: str
+    name: str
+    is_admin: bool = False
+    image_24: str = ""
+    slack_music_config: SlackMusicConfig = SlackMusicConfig()
+
+    @classmethod
+    def from_document(cls, data: dict) -> 'UserSummary':
+        # Users documents keep the avatar nested inside the Slack profile
+        return cls(
+            id=data["id"],
+            team_id=data["team_id"],
+            name=data["name"],
+            is_admin=data.get("is_admin", False),
+            image_24=data.get("profile", {}).get("image_24", ""),
+            slack_music_config=data.get("slack_music_config", {}),
+        )
+
+    def with_music_config(self, **changes) -> 'UserSummary':
+        """
+        Return a copy of this summary with the given slack_music_config fields changed.
+        """
+        music_config = self.slack_music_config.model_copy(update=changes)
+        return self.model_copy(update={"slack_music_config": music_config})
+
 
 class SlackUserResponse(BaseModel):
     ok: bool
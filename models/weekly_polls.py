@@ -28,6 +28,14 @@ class VoteInfo(BaseModel):
     voted_at: datetime
     voted_by: str
 
+class SongFeatures(BaseModel):
+    # Filled in by the background enrichment, numbers rounded to keep poll documents small
+    tempo: Optional[int] = None  # Beats per minute
+    energy: Optional[float] = None  # 0 to 1
+    danceability: Optional[float] = None  # 0 to 1
+    valence: Optional[float] = None  # 0 to 1, how positive the song sounds
+    genres: List[str] = []  # Top genres of the song's artists
+
 class SongInfo(BaseModel):
     id: str
     link: str
@@ -36,6 +44,8 @@ class SongInfo(BaseModel):
     album: str
     image_url: Optional[str] = None
     submitted_by: str
+    artist_ids: List[str] = []  # Spotify IDs of the artists, used to look up genres
+    features: Optional[SongFeatures] = None  # None until the song is enriched
 
 class WeeklyPoll(BaseModel):
     poll_id: str  # Identifier for the week's poll
@@ -48,16 +58,32 @@ class WeeklyPoll(BaseModel):
     vote_counts: Dict[str, int] = {} # Example: {"song_id_1": 5, "song_id_2": 3}
     playlist_id: Optional[str] = None  # ID of the playlist where the songs are added
     playlist_url: Optional[HttpUrl] = None  # URL of the playlist where the songs are added
+    vote_shards: int = 0 # Number of vote counter shards, 0 keeps the votes in the votes map of the poll document
+
+    def count_votes(self) -> Dict[str, int]:
+        # Song ID to number of votes
+        if self.vote_shards:
+            # Sharded votes are stored in a subcollection and rolled up into vote_counts
+            return dict(self.vote_counts)
+        votes_count = {}
+        for vote in self.votes.values():
+            votes_count[vote.voted_for] = votes_count.get(vote.voted_for, 0) + 1
+        return votes_count
 
     @classmethod
-    def generate_poll_id(cls):
+    def generate_poll_id(cls, category: str = 'general'):
         # identifier of current week (2024-03-1 for example) where 1 is the umber of the week during the month
-        return datetime.now().strftime('%Y-%m-%W')
+        week = datetime.now().strftime('%Y-%m-%W')
+        # General polls keep the bare week as ID, so polls from before categories are still found
+        if category == 'general':
+            return week
+        return f"{week}-{category}"
 
     @classmethod
-    def generate_new_weekly_poll(cls, poll_id: str, category: str = 'general') -> 'WeeklyPoll':
+    def generate_new_weekly_poll(cls, poll_id: str, category: str = 'general', vote_shards: int = 0) -> 'WeeklyPoll':
         return cls(
             poll_id=poll_id,
             category=category,
+            vote_shards=vote_shards,
         )
 
@@ -0,0 +1,220 @@
+"""
+Export poll analytics across teams.
+
+    python poll_analytics.py --output-dir exports [--team T123 ...] [--format csv|parquet] [--votes]
+
+Weekly polls are streamed page by page with cursor pagination, each page is turned into columnar
+NumPy arrays of votes (poll, song, voter, timestamp) and aggregated with vectorized operations, and
+the results are appended to the output files, so memory stays bounded by the page size however many
+polls there are. Writes:
+  poll_summary    one row per poll: submissions, votes, voters, team members and turnout
+  vote_distribution    one row per poll and song: votes and share of the poll's votes
+  votes    (with --votes) one row per vote
+Parquet output needs pyarrow.
+"""
+import argparse
+import asyncio
+import csv
+import os
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+import numpy as np
+from google.cloud import firestore
+
+
+class _CsvTableWriter():
+
+    def __init__(self, path: str):
+        self._file = open(f"{path}.csv", "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._header_written = False
+
+    def write(self, columns: Dict[str, np.ndarray]):
+        if not self._header_written:
+            self._writer.writerow(columns.keys())
+            self._header_written = True
+        self._writer.writerows(zip(*(column.tolist() for column in columns.values())))
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetTableWriter():
+
+    def __init__(self, path: str):
+        import pyarrow  # Optional dependency, only needed for Parquet output
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self._path = f"{path}.parquet"
+        self._writer = None
+
+    def write(self, columns: Dict[str, np.ndarray]):
+        # Each page becomes a row group
+        table = self._pyarrow.table({name: self._pyarrow.array(column) for name, column in columns.items()})
+        if self._writer is None:
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def to_epoch_seconds(value) -> float:
+    # Votes saved through the models hold ISO strings, but Firestore timestamps come back as datetimes
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+
+class PollAnalyticsExporter():
+
+    def __init__(self, output_dir: str, output_format: str = "csv", page_size: int = 200, include_votes: bool = False):
+        # Initialize Firestore client
+        self.db = firestore.AsyncClient()
+        self.page_size = page_size
+        self.include_votes = include_votes
+
+        os.makedirs(output_dir, exist_ok=True)
+        writer_class = _ParquetTableWriter if output_format == "parquet" else _CsvTableWriter
+        self.summary_writer = writer_class(os.path.join(output_dir, "poll_summary"))
+        self.distribution_writer = writer_class(os.path.join(output_dir, "vote_distribution"))
+        self.votes_writer = writer_class(os.path.join(output_dir, "votes")) if include_votes else None
+
+        # team_id -> number of users, counted once per team
+        self._team_sizes: Dict[str, int] = {}
+
+    async def export(self, team_ids: Optional[List[str]] = None) -> int:
+        exported = 0
+        try:
+            async for page in self.stream_polls(team_ids):
+                await self.export_page(page)
+                exported += len(page)
+                print(f"exported {exported} polls")
+        finally:
+            for writer in (self.summary_writer, self.distribution_writer, self.votes_writer):
+                if writer is not None:
+                    writer.close()
+        return exported
+
+    async def stream_polls(self, team_ids: Optional[List[str]] = None) -> AsyncIterator[list]:
+        """
+        Pages of poll document snapshots, using cursors so no page is read twice.
+        """
+        if team_ids:
+            queries = [self.db.collection(f"workspaces/{team_id}/weekly_polls") for team_id in team_ids]
+        else:
+            queries = [self.db.collection_group("weekly_polls")]
+
+        for base_query in queries:
+            last_doc = None
+            while True:
+                query = base_query.order_by("__name__").limit(self.page_size)
+                if last_doc is not None:
+                    query = query.start_after(last_doc)
+                page = [doc async for doc in query.stream()]
+                if not page:
+                    break
+                yield page
+                last_doc = page[-1]
+                if len(page) < self.page_size:
+                    break
+
+    async def export_page(self, page: list):
+        # workspaces/{team_id}/weekly_polls/{poll_id}
+        team_ids = np.array([doc.reference.parent.parent.id for doc in page])
+        poll_ids = np.array([doc.id for doc in page])
+        polls = [doc.to_dict() for doc in page]
+
+        # Columnar votes of the whole page, songs and voters encoded as integer codes
+        vote_poll_index = []
+        vote_songs = []
+        vote_voters = []
+        vote_times = []
+        for poll_index, (doc, poll) in enumerate(zip(page, polls)):
+            for voter_id, vote in (await self._poll_votes(doc, poll)).items():
+                vote_poll_index.append(poll_index)
+                vote_songs.append(vote["voted_for"])
+                vote_voters.append(vote.get("voted_by", voter_id))
+                vote_times.append(to_epoch_seconds(vote["voted_at"]))
+
+        vote_poll_index = np.array(vote_poll_index, dtype=np.int64)
+        song_ids, song_codes = np.unique(np.array(vote_songs, dtype=str), return_inverse=True)
+        voter_ids, voter_codes = np.unique(np.array(vote_voters, dtype=str), return_inverse=True)
+        vote_times = np.array(vote_times, dtype=np.float64)
+
+        n_polls = len(polls)
+        submissions = np.array([len(poll.get("songs") or {}) for poll in polls], dtype=np.int64)
+        votes = np.bincount(vote_poll_index, minlength=n_polls)
+
+        # Distinct voters per poll, from the distinct (poll, voter) pairs
+        poll_voter_pairs = np.unique(vote_poll_index * max(len(voter_ids), 1) + voter_codes)
+        voters = np.bincount(poll_voter_pairs // max(len(voter_ids), 1), minlength=n_polls)
+
+        team_sizes = np.array([await self._team_size(team_id) for team_id in team_ids], dtype=np.int64)
+        turnout = np.divide(voters, team_sizes, out=np.zeros(n_polls), where=team_sizes > 0)
+
+        self.summary_writer.write({
+            "team_id": team_ids,
+            "poll_id": poll_ids,
+            "category": np.array([poll.get("category", "") for poll in polls]),
+            "status": np.array([poll.get("status", "") for poll in polls]),
+            "submissions": submissions,
+            "votes": votes,
+            "voters": voters,
+            "team_members": team_sizes,
+            "turnout": np.round(turnout, 4),
+        })
+
+        if len(vote_poll_index) == 0:
+            return
+
+        # Votes per (poll, song) and each song's share of its poll's votes
+        pair_keys, pair_counts = np.unique(vote_poll_index * len(song_ids) + song_codes, return_counts=True)
+        pair_polls = pair_keys // len(song_ids)
+        pair_songs = pair_keys % len(song_ids)
+        self.distribution_writer.write({
+            "team_id": team_ids[pair_polls],
+            "poll_id": poll_ids[pair_polls],
+            "song_id": song_ids[pair_songs],
+            "votes": pair_counts,
+            "share": np.round(pair_counts / votes[pair_polls], 4),
+        })
+
+        if self.votes_writer is not None:
+            self.votes_writer.write({
+                "team_id": team_ids[vote_poll_index],
+                "poll_id": poll_ids[vote_poll_index],
+                "song_id": song_ids[song_codes],
+                "voter_id": voter_ids[voter_codes],
+                "voted_at": vote_times,
+            })
+
+    async def _poll_votes(self, doc, poll: dict) -> dict:
+        """
+        Votes of a poll by voter, read from the votes subcollection for sharded polls.
+        """
+        if poll.get("vote_shards"):
+            return {vote_doc.id: vote_doc.to_dict() async for vote_doc in doc.reference.collection("votes").stream()}
+        return poll.get("votes") or {}
+
+    async def _team_size(self, team_id: str) -> int:
+        if team_id not in self._team_sizes:
+            # Aggregation query, Firestore counts the users without sending them
+            result = await self.db.collection(f"workspaces/{team_id}/users").count().get()
+            self._team_sizes[team_id] = int(result[0][0].value)
+        return self._team_sizes[team_id]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output-dir", default="exports")
+    parser.add_argument("--team", action="append", dest="team_ids", help="Only export these teams, can be repeated")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--votes", action="store_true", help="Also export one row per vote")
+    args = parser.parse_args()
+
+    exporter = PollAnalyticsExporter(args.output_dir, output_format=args.format, page_size=args.page_size, include_votes=args.votes)
+    asyncio.run(exporter.export(args.team_ids))
@@ -0,0 +1,96 @@
+from google.cloud import firestore
+from typing import List, Optional
+from datetime import datetime
+from cache import CacheConfig, StoreCache
+from models.poll_categories import DEFAULT_CATEGORY, PollCategories, PollCategory
+
+
+class SlackMusicPollCategoriesStore():
+    """
+    Registry of the poll categories of each team.
+    # /workspaces/{team_id}/settings/poll_categories
+    Every active category runs its own poll each week.
+    """
+
+    def __init__(self, cache_config: Optional[CacheConfig] = None):
+        # Initialize Firestore client
+        self.db = firestore.AsyncClient()
+
+        # Read on every Home tab render and rarely changed
+        self.cache = StoreCache("poll_categories", cache_config or CacheConfig.from_env("poll_categories", maxsize=512, ttl=300))
+
+    async def get_categories(self, team_id: str) -> PollCategories:
+        cache_key = self._build_cache_key(team_id)
+        cached_categories = self._get_from_cache(cache_key)
+        if cached_categories is not None:
+            return PollCategories(**cached_categories)
+
+        doc = await self._doc_ref(team_id).get()
+        categories_data = doc.to_dict() if doc.exists else {}
+        self._add_to_cache(cache_key, categories_data)
+        return PollCategories(**categories_data)
+
+    async def get_active_categories(self, team_id: str) -> List[PollCategory]:
+        return (await self.get_categories(team_id)).active_categories()
+
+    async def get_active_category(self, team_id: str, category_id: Optional[str]) -> PollCategory:
+        """
+        The given category if it is active, the general category otherwise.
+        """
+        active_categories = await self.get_active_categories(team_id)
+        for category in active_categories:
+            if category.id == category_id:
+                return category
+        return active_categories[0]
+
+    def get_last_known_active_categories(self, team_id: str) -> List[PollCategory]:
+        """
+        The active categories from the cached registry, however old, without reading Firestore.
+        Only the general category if the registry isn't cached.
+        """
+        categories_data = self.cache.get_last_known(self._build_cache_key(team_id))
+        return PollCategories(**(categories_data or {})).active_categories()
+
+    async def add_category(self, team_id: str, name: str) -> PollCategory:
+        """
+        Add a category, or reactivate it if it was removed.
+        """
+        category = PollCategory(id=PollCategory.slugify(name), name=name, created_at=datetime.now())
+        await self._doc_ref(team_id).set({"categories": {category.id: category.model_dump(mode='json')}}, merge=True)
+        self.cache.pop(self._build_cache_key(team_id))
+        return category
+
+    async def remove_category(self, team_id: str, category_id: str) -> bool:
+        """
+        Stop running polls for a category, its past polls are kept.
+        Returns False for unknown categories and the general category, which can't be removed.
+        """
+        categories = await self.get_categories(team_id)
+        if category_id == DEFAULT_CATEGORY or category_id not in categories.categories:
+            return False
+        await self._doc_ref(team_id).set({"categories": {category_id: {"active": False}}}, merge=True)
+        self.cache.pop(self._build_cache_key(team_id))
+        return True
+
+    def _doc_ref(self, team_id: str):
+        return self.db.collection(f"workspaces/{team_id}/settings").document("poll_categories")
+
+    ### Cache Layer ###
+
+    def _get_from_cache(self, cache_key: str) -> Optional[dict]:
+        """
+        Retrieve a team's category registry from the in-memory cache.
+        """
+        return self.cache.get(cache_key)
+
+    def _add_to_cache(self, cache_key: str, categories_data: dict):
+        """
+        Add a team's category registry to the in-memory cache.
+        """
+        self.cache.set(cache_key, categories_data)
+
+    def _build_cache_key(self, team_id: str) -> str:
+        """
+        Build a cache key based on team_id.
+        """
+        return f"poll-categories-{team_id}"
@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import inspect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple, Type
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class DependencyUnavailable(Exception):
+    """
+    A call to a dependency was turned away by its circuit breaker or missed its deadline.
+    """
+
+    def __init__(self, dependency: str, message: str):
+        super().__init__(f"{dependency}: {message}")
+        self.dependency = dependency
+
+
+class CircuitOpenError(DependencyUnavailable):
+    pass
+
+
+class DeadlineExceeded(DependencyUnavailable):
+    pass
+
+
+class CircuitBreaker():
+    """
+    Deadline and circuit breaker for the calls to one dependency, e.g. Firestore or Spotify.
+
+    Every call must finish within timeout seconds. After failure_threshold consecutive failures
+    (timeouts or errors) the breaker opens and calls fail right away with CircuitOpenError, so
+    handlers don't pile up waiting on a dependency that is down. After reset_timeout seconds a
+    single call is let through: the breaker closes if it succeeds and opens again if it fails.
+    Exceptions in ignored_exceptions are outcomes rather than failures (e.g. a precondition that
+    doesn't hold) and count as successes.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 5,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        ignored_exceptions: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ignored_exceptions = ignored_exceptions
+
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.opened = 0
+
+        metrics.register(f"circuit_breaker.{name}", self.stats)
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Await fn(*args, **kwargs) within the deadline, unless the breaker is open.
+        """
+        return await self.call_within(self.timeout, fn, *args, **kwargs)
+
+    async def call_within(self, timeout: float, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Like call, with a deadline of its own, e.g. for calls made before a request is acknowledged.
+        """
+        state = self.state
+        if state == self.OPEN or (state == self.HALF_OPEN and self._probing):
+            self.rejected += 1
+            raise CircuitOpenError(self.name, "circuit breaker is open")
+
+        probe = state == self.HALF_OPEN
+        if probe:
+            self._probing = True
+        self.calls += 1
+        try:
+            result = await asyncio.wait_for(fn(*args, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._record_failure()
+            raise DeadlineExceeded(self.name, f"no response within {timeout}s")
+        except self.ignored_exceptions:
+            self._record_success()
+            raise
+        except Exception:
+            self._record_failure()
+            raise
+        finally:
+            if probe:
+                self._probing = False
+        self._record_success()
+        return result
+
+    async def call_blocking(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run a blocking fn(*args, **kwargs) in a worker thread, within the deadline.
+        A call past its deadline is abandoned, not interrupted, so blocking calls need their own
+        timeouts too.
+        """
+        return await self.call(asyncio.to_thread, fn, *args, **kwargs)
+
+    def stats(self) -> dict:
+        state = self.state
+        return {
+            "state": state,
+            "open": state != self.CLOSED,
+            "consecutive_failures": self._consecutive_failures,
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "opened": self.opened,
+        }
+
+    def _record_success(self):
+        self._consecutive_failures = 0
+        if self._opened_at is not None:
+            log.info("Circuit breaker %s closed", self.name)
+        self._opened_at = None
+
+    def _record_failure(self):
+        self.failures += 1
+        self._consecutive_failures += 1
+        if self._opened_at is not None or self._consecutive_failures >= self.failure_threshold:
+            if self._opened_at is None:
+                self.opened += 1
+                log.warning("Circuit breaker %s opened after %d failures", self.name, self._consecutive_failures)
+            self._opened_at = time.monotonic()
+
+
+class Guarded():
+    """
+    Proxy running the calls to a store or client through a circuit breaker.
+
+    Coroutine methods are awaited through the breaker, and with blocking=True every other method
+    is run in a worker thread through it, which turns a blocking client into an async one.
+    Other attributes, and the methods named in unguarded (e.g. long-running background loops),
+    are passed through as they are.
+    """
+
+    def __init__(self, target: Any, breaker: CircuitBreaker, blocking: bool = False, unguarded: Iterable[str] = ()):
+        self._target = target
+        self._breaker = breaker
+        self._blocking = blocking
+        self._unguarded = set(unguarded)
+        self._methods: Dict[str, Callable] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        method = self._methods.get(name)
+        if method is not None:
+            return method
+
+        attribute = getattr(self._target, name)
+        if name.startswith("_") or name in self._unguarded:
+            return attribute
+        if inspect.iscoroutinefunction(attribute):
+            method = functools.partial(self._breaker.call, attribute)
+        elif self._blocking and inspect.ismethod(attribute):
+            method = functools.partial(self._breaker.call_blocking, attribute)
+        else:
+            return attribute
+
+        self._methods[name] = method
+        return method
@@ -0,0 +1,236 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import random
+import time
+from enum import IntEnum
+from typing import Dict, Tuple
+
+import cachetools
+from slack_sdk.errors import SlackApiError
+
+import metrics
+
+
+class Priority(IntEnum):
+    # Responses to a user's click, e.g. opening a modal with the click's trigger_id
+    INTERACTIVE = 0
+    # Everything else, e.g. Home tab refreshes and DMs
+    BULK = 1
+
+
+# Requests per minute allowed by each Slack rate limit tier, per team
+TIER_RATES = {
+    "tier1": 1,
+    "tier2": 20,
+    "tier3": 50,
+    "tier4": 100,
+    # chat.postMessage allows roughly one message per second per channel
+    "special": 60,
+}
+
+# Web API client method -> rate limit tier
+METHOD_TIERS = {
+    "views_open": "tier4",
+    "views_push": "tier4",
+    "views_update": "tier4",
+    "views_publish": "tier4",
+    "users_info": "tier4",
+    "chat_postMessage": "special",
+}
+
+
+class TokenBucket():
+    """
+    Token bucket handing out tokens to waiters in priority order.
+    The bucket can be paused, e.g. for the Retry-After of a rate limited response.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        # Tokens added per second and maximum tokens kept
+        self.rate = rate
+        self.capacity = capacity
+
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+        # heap of (priority, sequence, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._pump = None
+
+    async def acquire(self, priority: Priority = Priority.BULK):
+        self._refill()
+        if not self._waiters and self._available() == 0:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run())
+        await future
+
+    def try_acquire(self) -> bool:
+        """
+        Take a token if one is available right now, without waiting.
+        """
+        self._refill()
+        if self._waiters or self._available() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    def release(self):
+        """
+        Give back a token taken with try_acquire that ended up unused.
+        """
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def _run(self):
+        try:
+            while self._waiters:
+                _, _, future = self._waiters[0]
+                if future.done():
+                    # The waiter was cancelled
+                    heapq.heappop(self._waiters)
+                    continue
+
+                self._refill()
+                delay = self._available()
+                if delay > 0:
+                    # Sleep then look at the heap again, a higher priority waiter may have arrived
+                    await asyncio.sleep(delay)
+                    continue
+
+                self.tokens -= 1
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+        finally:
+            self._pump = None
+
+    def _available(self) -> float:
+        """
+        Seconds until a token can be taken, 0 when one can be taken now.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class SlackDispatcher():
+    """
+    Central dispatcher for outbound Slack Web API calls.
+
+    Calls are rate limited with a token bucket per team and rate limit tier, interactive calls are
+    served ahead of bulk ones, and rate limited (429) or failing (5xx) calls are retried with jitter,
+    honoring Slack's Retry-After header for every call sharing the bucket. With a scheduler (a
+    FairScheduler), each call also holds an outbound slot of its team while it is in flight.
+    """
+
+    def __init__(self, max_retries: int = 3, base_backoff: float = 1.0, max_buckets: int = 10000, scheduler=None):
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.scheduler = scheduler
+
+        # (team_id, tier) -> TokenBucket, idle teams are dropped first
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = cachetools.LRUCache(maxsize=max_buckets)
+
+        self.calls = 0
+        self.rate_limited = 0
+        self.retries = 0
+
+        metrics.register("slack_dispatcher", self.stats)
+
+    async def call(self, client, method: str, team_id: str, priority: Priority = Priority.BULK, **kwargs):
+        """
+        Call a Web API client method, e.g. call(client, "views_publish", team_id, user_id=..., view=...).
+        """
+        bucket = self._bucket(team_id, METHOD_TIERS.get(method, "tier3"))
+        attempt = 0
+        while True:
+            await bucket.acquire(priority)
+            self.calls += 1
+            try:
+                async with self._slot(team_id, priority):
+                    return await getattr(client, method)(**kwargs)
+            except SlackApiError as e:
+                status = e.response.status_code
+                if status == 429:
+                    self.rate_limited += 1
+                    retry_after = retry_after_seconds(e.response.headers, self.base_backoff)
+                    # Everyone sharing the bucket waits, not only this call
+                    bucket.pause(retry_after)
+                    delay = retry_after
+                elif status >= 500:
+                    delay = self.base_backoff * 2 ** attempt
+                else:
+                    raise
+
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                # Jitter so callers paused together don't all come back at the same moment
+                await asyncio.sleep(delay + random.uniform(0, self.base_backoff))
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "queued": sum(bucket.queue_depth for bucket in self._buckets.values()),
+        }
+
+    def _slot(self, team_id: str, priority: Priority):
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(team_id, priority)
+
+    def _bucket(self, team_id: str, tier: str) -> TokenBucket:
+        key = (team_id, tier)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = TIER_RATES[tier] / 60
+            # Allow short bursts of up to 10 seconds worth of calls
+            bucket = TokenBucket(rate=rate, capacity=max(1, rate * 10))
+            self._buckets[key] = bucket
+        return bucket
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, SlackApiError) and error.response.status_code == 429
+
+
+def retry_after_seconds(headers, default: float) -> float:
+    """
+    Retry-After of a response, header names are compared case-insensitively since they are
+    passed through as the server sent them (often "retry-after").
+    """
+    for name, value in (headers or {}).items():
+        if name.lower() == "retry-after":
+            # Some clients give each header as a list of values
+            if isinstance(value, (list, tuple)):
+                value = value[0] if value else None
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return default
+    return default
@@ -0,0 +1,142 @@
+"""
+Socket Mode entry point, an alternative to the HTTP server of main.py that needs no public ingress.
+
+    SLACK_APP_TOKEN=xapp-... python socket_mode.py
+
+Events are spread across SOCKET_MODE_SHARDS worker tasks, sharded by team_id. A worker acknowledges
+each request as soon as its listener calls ack(), then waits for the listener to finish before taking
+the shard's next request, so each team's events are handled in the order they arrive while different
+shards run concurrently. A listener running longer than SOCKET_MODE_LISTENER_TIMEOUT seconds stops
+holding up its shard.
+SOCKET_MODE_PROCESSES > 1 starts that many processes, each with its own Socket Mode connection
+(Slack allows up to 10 per app and balances events across them), so ordering per team then only
+holds within a connection.
+The Spotify install callback still needs the HTTP server of main.py.
+"""
+import asyncio
+import multiprocessing
+import os
+import zlib
+from time import time
+from typing import List, Optional
+
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.adapter.socket_mode.async_internals import send_async_response
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_sdk.socket_mode.async_client import AsyncBaseSocketModeClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+
+import metrics
+from listener_tracking import ListenerTracker
+from structured_logging import setup_logging
+
+
+def get_team_id(payload: dict) -> Optional[str]:
+    """
+    Team of a Socket Mode payload, for events, interactions and slash commands.
+    """
+    if payload.get("team_id"):
+        return payload["team_id"]
+    if isinstance(payload.get("team"), dict) and payload["team"].get("id"):
+        return payload["team"]["id"]
+    if isinstance(payload.get("user"), dict) and payload["user"].get("team_id"):
+        return payload["user"]["team_id"]
+    return payload.get("enterprise_id")
+
+
+class ShardedSocketModeHandler(AsyncSocketModeHandler):
+    """
+    Socket Mode handler dispatching requests to worker tasks sharded by team_id.
+    """
+
+    def __init__(self, app, app_token: str, shards: int = 4, queue_size: int = 1000, listener_timeout: float = 60, **kwargs):
+        super().__init__(app, app_token, **kwargs)
+        self.shards = shards
+        self.listener_timeout = listener_timeout
+        self.listeners = ListenerTracker(app)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._workers: List[asyncio.Task] = []
+
+        metrics.register("socket_mode", self.stats)
+
+    def shard_for(self, payload: dict) -> int:
+        team_id = get_team_id(payload) or ""
+        # crc32 rather than hash() so the shard of a team doesn't change between runs
+        return zlib.crc32(team_id.encode("utf-8")) % self.shards
+
+    async def handle(self, client: AsyncBaseSocketModeClient, req: SocketModeRequest) -> None:
+        # Blocks when the shard's queue is full, which slows down reading from the connection
+        await self._queues[self.shard_for(req.payload)].put((client, req, time()))
+
+    async def start_async(self):
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+        await super().start_async()
+
+    async def close_async(self, drain_timeout: float = 10):
+        """
+        Stop reading new requests, let the workers finish what is queued, then close.
+        """
+        await self.disconnect_async()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            self.app.logger.warning("Closing with Socket Mode requests still queued")
+        for worker in self._workers:
+            worker.cancel()
+        await super().close_async()
+
+    def stats(self) -> dict:
+        return {f"shard_{index}_queued": queue.qsize() for index, queue in enumerate(self._queues)}
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            client, req, start_time = await queue.get()
+            try:
+                bolt_req = AsyncBoltRequest(mode="socket_mode", body=req.payload)
+                bolt_resp = await self.app.async_dispatch(bolt_req)
+                await send_async_response(client, req, bolt_resp, start_time)
+                # Acknowledged, but the shard's next request waits until the listener is done
+                if not await self.listeners.wait_for(bolt_req, self.listener_timeout):
+                    self.app.logger.warning("Socket Mode listener still running after %ss, moving on", self.listener_timeout)
+            except Exception as e:
+                self.app.logger.exception(f"Error processing Socket Mode request: {str(e)}")
+            finally:
+                queue.task_done()
+
+
+async def run(shards: int):
+    # Imported here so each process builds its own app, stores and clients
+    from main import app, start_background_services, stop_background_services
+
+    handler = ShardedSocketModeHandler(
+        app,
+        os.environ["SLACK_APP_TOKEN"],
+        shards=shards,
+        listener_timeout=float(os.getenv("SOCKET_MODE_LISTENER_TIMEOUT", "60")),
+    )
+    await start_background_services()
+    try:
+        await handler.start_async()
+    finally:
+        await handler.close_async()
+        await stop_background_services()
+
+
+def run_process(shards: int):
+    asyncio.run(run(shards))
+
+
+if __name__ == "__main__":
+    setup_logging()
+
+    shards = int(os.getenv("SOCKET_MODE_SHARDS", "4"))
+    processes = int(os.getenv("SOCKET_MODE_PROCESSES", "1"))
+
+    if processes <= 1:
+        run_process(shards)
+    else:
+        workers = [multiprocessing.Process(target=run_process, args=(shards,)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
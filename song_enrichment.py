@@ -0,0 +1,208 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import FailedPrecondition
+
+import metrics
+from cache import CacheConfig, StoreCache
+from models.weekly_polls import SongFeatures, SongInfo
+from weekly_polls_store import SlackMusicWeeklyPollsStore
+
+
+log = logging.getLogger(__name__)
+
+# Genres kept per song, from its artists
+MAX_GENRES = 3
+
+# Rounds a song is retried after Spotify or Firestore errors before it is left unenriched
+MAX_ATTEMPTS = 3
+
+
+class SongEnricher():
+    """
+    Adds audio features (tempo, energy, danceability, valence) and artist genres to submitted songs,
+    in the background.
+
+    Submissions only enqueue their song. Every interval seconds the queued songs of all teams are
+    resolved together: tracks with batched /audio-features calls (100 IDs per request) and their
+    artists with batched /artists calls (50 IDs per request), both skipped for tracks and artists
+    already cached. The compact result is then stored on the song in its poll, where the Home tab
+    finds it without calling Spotify.
+
+    spotify_client is the app's SpotifyClient wrapped in a Guarded proxy, whose blocking calls are
+    awaited in worker threads.
+    """
+
+    def __init__(
+        self,
+        spotify_client,
+        weekly_polls_store: SlackMusicWeeklyPollsStore,
+        interval: float = 10,
+        features_cache_config: Optional[CacheConfig] = None,
+        genres_cache_config: Optional[CacheConfig] = None,
+    ):
+        self.spotify_client = spotify_client
+        self.weekly_polls_store = weekly_polls_store
+        self.interval = interval
+
+        # Track ID -> SongFeatures data, the same song is often submitted by several teams
+        self.features_cache = StoreCache("song_features", features_cache_config or CacheConfig.from_env("song_features", maxsize=10000, ttl=7 * 24 * 3600))
+        # Artist ID -> genres, they change rarely
+        self.genres_cache = StoreCache("artist_genres", genres_cache_config or CacheConfig.from_env("artist_genres", maxsize=10000, ttl=24 * 3600))
+
+        # (team_id, poll_id) -> song ID -> artist IDs, of songs waiting to be enriched
+        self._pending: Dict[Tuple[str, str], Dict[str, List[str]]] = {}
+        # (team_id, poll_id, song ID) -> failed rounds
+        self._attempts: Dict[Tuple[str, str, str], int] = {}
+
+        self.enriched = 0
+        self.spotify_requests = 0
+        self.failures = 0
+
+        metrics.register("song_enrichment", self.stats)
+
+    def enqueue(self, team_id: str, poll_id: str, song_info: SongInfo):
+        """
+        Queue a submitted song for enrichment, returns right away.
+        """
+        if song_info.features is not None:
+            return
+        self._pending.setdefault((team_id, poll_id), {})[song_info.id] = song_info.artist_ids
+
+    async def enrich_pending(self):
+        """
+        Enrich every queued song, in as few Spotify requests as the batch limits allow.
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        artist_ids_by_song = {song_id: artist_ids for songs in pending.values() for song_id, artist_ids in songs.items()}
+        try:
+            features = await self.resolve(artist_ids_by_song)
+        except Exception as e:
+            log.error("Error resolving song features: %s", e)
+            for (team_id, poll_id), songs in pending.items():
+                self._retry(team_id, poll_id, songs)
+            return
+
+        for (team_id, poll_id), songs in pending.items():
+            # Songs left out by resolve() are missing the genres of some of their artists
+            unresolved = {song_id: artist_ids for song_id, artist_ids in songs.items() if song_id not in features}
+            if unresolved:
+                self._retry(team_id, poll_id, unresolved)
+            resolved = {song_id: artist_ids for song_id, artist_ids in songs.items() if song_id in features}
+            if not resolved:
+                continue
+
+            try:
+                updated = await self.weekly_polls_store.save_song_features(
+                    team_id, poll_id, {song_id: features[song_id] for song_id in resolved}
+                )
+                self.enriched += len(updated)
+                for song_id in resolved:
+                    self._attempts.pop((team_id, poll_id, song_id), None)
+            except FailedPrecondition:
+                # The poll changed while it was read, the features are cached for the next round
+                self._retry(team_id, poll_id, resolved)
+            except Exception as e:
+                log.error("Error saving song features of %s/%s: %s", team_id, poll_id, e)
+                self._retry(team_id, poll_id, resolved)
+
+    async def resolve(self, artist_ids_by_song: Dict[str, List[str]]) -> Dict[str, SongFeatures]:
+        """
+        Features of the given songs (song ID -> artist IDs), from the cache or Spotify.
+        Songs with an artist Spotify didn't return are left out, so they are neither cached nor
+        stored without that artist's genres.
+        """
+        features = {}
+        missing_song_ids = []
+        for song_id in artist_ids_by_song:
+            cached_features = self.features_cache.get(song_id)
+            if cached_features is not None:
+                features[song_id] = SongFeatures(**cached_features)
+            else:
+                missing_song_ids.append(song_id)
+        if not missing_song_ids:
+            return features
+
+        missing_artist_ids = list({
+            artist_id
+            for song_id in missing_song_ids
+            for artist_id in artist_ids_by_song[song_id]
+            if self.genres_cache.get(artist_id) is None
+        })
+
+        audio_features, artists = await asyncio.gather(
+            self.spotify_client.get_audio_features(missing_song_ids),
+            self.spotify_client.get_artists(missing_artist_ids) if missing_artist_ids else asyncio.sleep(0, []),
+        )
+        self.spotify_requests += self._requests(len(missing_song_ids), self.spotify_client.MAX_AUDIO_FEATURES_PER_REQUEST)
+        self.spotify_requests += self._requests(len(missing_artist_ids), self.spotify_client.MAX_ARTISTS_PER_REQUEST)
+
+        for artist in artists:
+            self.genres_cache.set(artist['id'], artist.get('genres', []))
+        audio_features_by_song = {track_features['id']: track_features for track_features in audio_features}
+
+        # e.g. a batch of /artists that was rate limited
+        unresolved_artist_ids = {artist_id for artist_id in missing_artist_ids if self.genres_cache.get(artist_id) is None}
+        if unresolved_artist_ids:
+            log.warning("No genres for %d artists, their songs are enriched later", len(unresolved_artist_ids))
+
+        for song_id in missing_song_ids:
+            if unresolved_artist_ids.intersection(artist_ids_by_song[song_id]):
+                continue
+            song_features = self._build_features(audio_features_by_song.get(song_id), artist_ids_by_song[song_id])
+            self.features_cache.set(song_id, song_features.model_dump(mode='json'))
+            features[song_id] = song_features
+        return features
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.enrich_pending()
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(songs) for songs in self._pending.values()),
+            "enriched": self.enriched,
+            "spotify_requests": self.spotify_requests,
+            "failures": self.failures,
+        }
+
+    def _build_features(self, audio_features: Optional[dict], artist_ids: List[str]) -> SongFeatures:
+        genres = []
+        for artist_id in artist_ids:
+            for genre in self.genres_cache.get(artist_id) or []:
+                if genre not in genres:
+                    genres.append(genre)
+
+        if audio_features is None:
+            # Not every track has audio features
+            return SongFeatures(genres=genres[:MAX_GENRES])
+        return SongFeatures(
+            tempo=round(audio_features['tempo']) if audio_features.get('tempo') else None,
+            energy=self._round(audio_features.get('energy')),
+            danceability=self._round(audio_features.get('danceability')),
+            valence=self._round(audio_features.get('valence')),
+            genres=genres[:MAX_GENRES],
+        )
+
+    def _retry(self, team_id: str, poll_id: str, songs: Dict[str, List[str]]):
+        for song_id, artist_ids in songs.items():
+            attempts = self._attempts.get((team_id, poll_id, song_id), 0) + 1
+            if attempts >= MAX_ATTEMPTS:
+                self._attempts.pop((team_id, poll_id, song_id), None)
+                self.failures += 1
+                continue
+            self._attempts[(team_id, poll_id, song_id)] = attempts
+            self._pending.setdefault((team_id, poll_id), {}).setdefault(song_id, artist_ids)
+
+    @staticmethod
+    def _requests(ids: int, per_request: int) -> int:
+        return -(-ids // per_request)
+
+    @staticmethod
+    def _round(value: Optional[float]) -> Optional[float]:
+        return round(value, 2) if value is not None else None
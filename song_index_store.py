@@ -0,0 +1,170 @@
+import re
+import unicodedata
+from datetime import datetime
+from google.cloud import firestore
+from typing import List, Optional
+from cache import CacheConfig, StoreCache
+from models.song_index import SongIndexEntry
+from models.weekly_polls import SongInfo
+from unit_of_work import UnitOfWork
+
+
+# Decorations that don't make a different song, e.g. "(feat. X)", "[Live]" or "- 2011 Remaster"
+_DECORATIONS = re.compile(r"\([^)]*\)|\[[^\]]*\]|\s-\s.*$")
+_NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+
+# Prefixes are indexed from 2 characters up to this length
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_LENGTH = 12
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercase, strip accents and punctuation, and collapse whitespace.
+    """
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    return _NON_ALPHANUMERIC.sub(" ", text).strip()
+
+
+def normalize_title(title: str) -> str:
+    return normalize_text(_DECORATIONS.sub("", title)) or normalize_text(title)
+
+
+def build_prefixes(*texts: str) -> List[str]:
+    prefixes = set()
+    for text in texts:
+        for word in text.split():
+            for length in range(MIN_PREFIX_LENGTH, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                prefixes.add(word[:length])
+    return sorted(prefixes)
+
+
+class SlackMusicSongIndexStore():
+    """
+    Per-team inverted index of every song submitted to the team's polls.
+    # /workspaces/{team_id}/song_index/{track_id}
+    Each entry is keyed by track ID and indexes the normalized title, the artists and the prefixes
+    of their words, so duplicate checks and searches are a single point read or indexed query.
+    """
+
+    def __init__(self, cache_config: Optional[CacheConfig] = None):
+        # Initialize Firestore client
+        self.db = firestore.AsyncClient()
+
+        self.cache = StoreCache("song_index", cache_config or CacheConfig.from_env("song_index", maxsize=1024, ttl=300))
+
+    async def get_entry(self, team_id: str, track_id: str) -> Optional[SongIndexEntry]:
+        cache_key = self._build_cache_key(team_id, track_id)
+        cached_entry = self._get_from_cache(cache_key)
+        if cached_entry:
+            return SongIndexEntry(**cached_entry)
+
+        doc = await self._collection(team_id).document(track_id).get()
+        if doc.exists:
+            self._add_to_cache(cache_key, doc.to_dict())
+            return SongIndexEntry(**doc.to_dict())
+        return None
+
+    async def stage_submission(self, unit: UnitOfWork, team_id: str, poll_id: str, song_info: SongInfo):
+        """
+        Stage the indexing of a submitted song, to be committed with the poll.
+        """
+        entry_data = self._build_entry_data(song_info)
+
+        entry = await self.get_entry(team_id, song_info.id)
+        if entry is None:
+            entry_data["first_submitted_by"] = song_info.submitted_by
+
+        unit.set(self._collection(team_id).document(song_info.id), {**entry_data, "submitted_in": firestore.ArrayUnion([poll_id])})
+
+        submitted_in = sorted({*(entry.submitted_in if entry else []), poll_id})
+        previous = entry.model_dump() if entry else {}
+        unit.after_commit(lambda: self._add_to_cache(self._build_cache_key(team_id, song_info.id), {**previous, **entry_data, "submitted_in": submitted_in}))
+
+    async def stage_remove_submission(self, unit: UnitOfWork, team_id: str, poll_id: str, track_id: str):
+        """
+        Stage the removal of a poll from the submissions of an indexed song.
+        """
+        # Merging into a missing entry would create a partial one
+        if await self.get_entry(team_id, track_id) is None:
+            return
+        unit.set(self._collection(team_id).document(track_id), {"submitted_in": firestore.ArrayRemove([poll_id])})
+        unit.after_commit(lambda: self.cache.pop(self._build_cache_key(team_id, track_id)))
+
+    async def record_winner(self, team_id: str, poll_id: str, song_info: SongInfo):
+        """
+        Record that a song won a poll. Songs submitted before the index existed aren't indexed yet,
+        so the whole entry is merged in and created when it is missing.
+        """
+        entry_data = self._build_entry_data(song_info)
+        if await self.get_entry(team_id, song_info.id) is None:
+            entry_data["first_submitted_by"] = song_info.submitted_by
+
+        await self._collection(team_id).document(song_info.id).set(
+            {**entry_data, "submitted_in": firestore.ArrayUnion([poll_id]), "won_in": firestore.ArrayUnion([poll_id])},
+            merge=True,
+        )
+        self.cache.pop(self._build_cache_key(team_id, song_info.id))
+
+    async def search(self, team_id: str, query: str, limit: int = 10) -> List[SongIndexEntry]:
+        """
+        Find songs whose title or artists have words starting with every word of the query.
+        The longest query word is looked up in the index, the other words are matched on the results.
+        """
+        words = normalize_text(query).split()
+        if not words:
+            return []
+
+        lookup_word = max(words, key=len)[:MAX_PREFIX_LENGTH]
+        if len(lookup_word) < MIN_PREFIX_LENGTH:
+            return []
+
+        # Fetch a few more than needed since the other words still have to match
+        index_query = self._collection(team_id).where(field_path="search_prefixes", op_string="array_contains", value=lookup_word).limit(limit * 5)
+
+        results = []
+        async for doc in index_query.stream():
+            entry = SongIndexEntry(**doc.to_dict())
+            entry_words = f"{entry.normalized_title} {' '.join(entry.artist_keys)}".split()
+            if all(any(entry_word.startswith(word) for entry_word in entry_words) for word in words):
+                results.append(entry)
+                if len(results) == limit:
+                    break
+        return results
+
+    @staticmethod
+    def _build_entry_data(song_info: SongInfo) -> dict:
+        normalized_title = normalize_title(song_info.title)
+        artist_keys = [normalize_text(artist) for artist in song_info.artist.split(", ")]
+        return {
+            "track_id": song_info.id,
+            "title": song_info.title,
+            "artist": song_info.artist,
+            "normalized_title": normalized_title,
+            "artist_keys": artist_keys,
+            "search_prefixes": build_prefixes(normalized_title, *artist_keys),
+            "last_submitted_at": datetime.now(),
+        }
+
+    def _collection(self, team_id: str):
+        return self.db.collection(f"workspaces/{team_id}/song_index")
+
+    ### Cache Layer ###
+
+    def _get_from_cache(self, cache_key: str) -> Optional[dict]:
+        """
+        Retrieve an index entry's data from the in-memory cache.
+        """
+        return self.cache.get(cache_key)
+
+    def _add_to_cache(self, cache_key: str, entry_data: dict):
+        """
+        Add an index entry's data to the in-memory cache.
+        """
+        self.cache.set(cache_key, entry_data)
+
+    def _build_cache_key(self, team_id: str, track_id: str) -> str:
+        """
+        Build a cache key based on team_id and track_id.
+        """
+        return f"{team_id}-{track_id}"
@@ -1,5 +1,5 @@
 from google.cloud import firestore
-import cachetools
+from cache import CacheConfig, StoreCache
 from typing import Optional
 from datetime import datetime
 from models.spotify_installations import SpotifyInstallation  # Import the model
@@ -7,12 +7,12 @@ from models.spotify_installations import SpotifyInstallation  # Import the model
 
 class SlackSpotifyInstallationStore():
 
-    def __init__(self):
+    def __init__(self, cache_config: Optional[CacheConfig] = None):
         # Initialize Firestore client
         self.db = firestore.AsyncClient()
 
-        # In-memory cache with TTL
-        self.cache = cachetools.TTLCache(maxsize=128, ttl=300)
+        # In-memory cache with TTL, configurable per store
+        self.cache = StoreCache("spotify_installations", cache_config or CacheConfig.from_env("spotify_installations", maxsize=32, ttl=300))
 
     async def get_installation(self, team_id: str) -> Optional[SpotifyInstallation]:
         """
@@ -32,6 +32,15 @@ class SlackSpotifyInstallationStore():
             return SpotifyInstallation(**doc.to_dict())
         return None
 
+    def get_last_known_installation(self, team_id: str) -> Optional[SpotifyInstallation]:
+        """
+        The cached Spotify installation of a team, however old, without reading Firestore.
+        """
+        installation_data = self.cache.get_last_known(self._build_cache_key(team_id))
+        if installation_data:
+            return SpotifyInstallation(**installation_data)
+        return None
+
     async def save_installation(self, team_id: str, installer_user_id: str, access_token: str, refresh_token: str, expires_at: int):
         """
         Save a new Spotify installation for a given team.
@@ -76,6 +85,22 @@ class SlackSpotifyInstallationStore():
             "updated_at": datetime.now()  # Update the timestamp
         })
 
+    def apply_snapshot(self, team_id: str, installation_data: Optional[dict]):
+        """
+        Push an installation received from a Firestore listener into the cache.
+        """
+        cache_key = self._build_cache_key(team_id)
+        if installation_data is None:
+            self.cache.pop(cache_key)
+        else:
+            self._add_to_cache(cache_key, installation_data)
+
+    def pin(self, team_id: str):
+        self.cache.pin(self._build_cache_key(team_id))
+
+    def unpin(self, team_id: str):
+        self.cache.unpin(self._build_cache_key(team_id))
+
     ### Cache Layer ###
 
     def _get_from_cache(self, cache_key: str) -> Optional[dict]:
@@ -88,7 +113,7 @@ class SlackSpotifyInstallationStore():
         """
         Add Spotify installation data to the in-memory cache.
         """
-        self.cache[cache_key] = installation_data
+        self.cache.set(cache_key, installation_data)
 
     def _build_cache_key(self, team_id: str) -> str:
         """
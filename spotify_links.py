@@ -0,0 +1,36 @@
+import re
+from typing import List, NamedTuple
+
+
+# https://open.spotify.com/track/<id>, optionally with an intl-xx/ locale, embed/ and any query string
+_SPOTIFY_URL = re.compile(
+    r"https?://open\.spotify\.com/(?:intl-[a-z]{2}(?:-[a-z]{2})?/)?(?:embed/)?(track|album|playlist)/([A-Za-z0-9]{22})(?![A-Za-z0-9])",
+    re.IGNORECASE,
+)
+
+# spotify:track:<id>. IDs are exactly 22 characters, a longer one isn't cut down to a wrong ID
+_SPOTIFY_URI = re.compile(r"spotify:(track|album|playlist):([A-Za-z0-9]{22})(?![A-Za-z0-9])")
+
+
+class SpotifyLink(NamedTuple):
+    kind: str  # 'track', 'album' or 'playlist'
+    id: str
+
+
+def extract_spotify_links(text: str) -> List[SpotifyLink]:
+    """
+    Every Spotify track, album and playlist link or URI in a pasted message, in order and without
+    duplicates.
+    """
+    matches = sorted(
+        [*_SPOTIFY_URL.finditer(text), *_SPOTIFY_URI.finditer(text)],
+        key=lambda match: match.start(),
+    )
+
+    links = []
+    for match in matches:
+        link = SpotifyLink(kind=match.group(1).lower(), id=match.group(2))
+        if link not in links:
+            links.append(link)
+    return links
+
@@ -0,0 +1,148 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+from typing import Any, Dict, Optional
+
+
+# Fields whose values are never logged, matched against dict keys and extra fields
+SECRET_KEYS = re.compile(r"token|secret|password|authorization|^code$|^trigger_id$", re.IGNORECASE)
+
+# Slack tokens and bearer credentials inside free text
+SECRET_PATTERNS = re.compile(r"xox[abposr]-[A-Za-z0-9-]+|xapp-[A-Za-z0-9-]+|Bearer\s+[A-Za-z0-9._~+/=-]+")
+
+REDACTED = "[REDACTED]"
+
+# Attributes every LogRecord has, anything else on a record came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def redact(value: Any) -> Any:
+    """
+    Copy of a logged value with secrets replaced, by key for dicts and by pattern for text.
+    """
+    if isinstance(value, dict):
+        return {key: REDACTED if isinstance(key, str) and SECRET_KEYS.search(key) else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return SECRET_PATTERNS.sub(REDACTED, value)
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: time, level, logger, message and the fields passed with extra=.
+    Arguments are redacted before they are formatted into the message.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        args = record.args
+        if isinstance(args, dict):
+            args = redact(args)
+        elif args:
+            args = tuple(redact(arg) for arg in args)
+        try:
+            message = str(record.msg) % args if args else str(record.msg)
+        except (TypeError, ValueError):
+            message = f"{record.msg} {args}"
+
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": SECRET_PATTERNS.sub(REDACTED, message),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = REDACTED if SECRET_KEYS.search(key) else redact(value)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below WARNING of each handler, e.g. {"vote": 0.1} keeps one
+    in ten of the records logged with extra={"handler": "vote"}. "*" sets the rate of the others.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.default_rate = rates.get("*", 1.0)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "handler", None), self.default_rate)
+        return rate >= 1 or random.random() < rate
+
+    @staticmethod
+    def parse_rates(spec: str) -> Dict[str, float]:
+        """
+        Rates from "vote=0.1,app_home_opened=0.01,*=1".
+        """
+        rates = {}
+        for item in spec.split(","):
+            if "=" in item:
+                name, rate = item.split("=", 1)
+                rates[name.strip()] = float(rate)
+        return rates
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are, so formatting and redaction happen on the listener
+    thread instead of the event loop. Only exceptions are rendered right away, while their
+    traceback is still around. Arguments are formatted later, so they mustn't be changed after
+    they are logged.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: Optional[str] = None, sample_rates: Optional[str] = None):
+    """
+    Send every log record through a queue to a background thread writing JSON lines to stdout.
+
+    The level comes from LOG_LEVEL (INFO by default) and the per-handler sampling rates from
+    LOG_SAMPLE_RATES. Records below the level are dropped before they are even created, and
+    the ones kept cost the handlers an enqueue. Replaces the root logger's handlers, and calling
+    it again only updates the level.
+    """
+    global _listener
+
+    root = logging.getLogger()
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+    if _listener is not None:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(SamplingFilter.parse_rates(sample_rates or os.getenv("LOG_SAMPLE_RATES", ""))))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Records still queued are written before the process exits
+    atexit.register(_listener.stop)
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set, Tuple
+
+import cachetools
+from google.cloud import firestore
+
+import metrics
+from resilience import CircuitBreaker
+from slack_dispatcher import TokenBucket
+
+
+log = logging.getLogger(__name__)
+
+# Outcomes of SubmissionThrottle.admit
+ADMITTED = "admitted"
+DUPLICATE = "duplicate"
+THROTTLED = "throttled"
+
+
+class FirestoreThrottleBackend():
+    """
+    Shares each team's submission budget between processes through Firestore.
+    # /submission_throttle/{team_id}-{window}
+    Submissions are counted in fixed windows with a transaction per submission. Set a Firestore TTL
+    policy on expires_at to have old windows deleted.
+    """
+
+    def __init__(self):
+        # Initialize Firestore client
+        self.db = firestore.AsyncClient()
+
+    async def take(self, key: str, limit: int, window: float) -> bool:
+        window_index = int(time.time() // window)
+        doc_ref = self.db.collection("submission_throttle").document(f"{key}-{window_index}")
+
+        @firestore.async_transactional
+        async def take_in_window(transaction) -> bool:
+            snapshot = await doc_ref.get(transaction=transaction)
+            count = snapshot.get("count") if snapshot.exists else 0
+            if count >= limit:
+                return False
+            transaction.set(doc_ref, {
+                "count": count + 1,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=window * 2),
+            })
+            return True
+
+        return await take_in_window(self.db.transaction())
+
+
+class SubmissionThrottle():
+    """
+    Decides whether a song submission may go ahead, before any Spotify or Firestore work is done.
+
+    Each user and each team has a token bucket of submissions per minute, so one noisy workspace
+    can't use up the app-wide Spotify quota. A submission repeating one of the user's last few
+    seconds, or arriving while the user's previous one is still being processed, is a duplicate:
+    the submission in progress refreshes the Home tab for both. With a shared backend, the team
+    budget is also enforced across processes.
+
+    The backend is called through the breaker when one is given and within backend_timeout
+    seconds. When it is slow or unavailable only the local buckets apply. Like the dedup's, the
+    breaker should be the throttle's own rather than the one of the stores.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = 6,
+        team_rate: float = 60,
+        duplicate_window: float = 10,
+        backend: Optional[FirestoreThrottleBackend] = None,
+        max_buckets: int = 10000,
+        breaker: Optional[CircuitBreaker] = None,
+        backend_timeout: float = 1.0,
+    ):
+        # Submissions per minute
+        self.user_rate = user_rate
+        self.team_rate = team_rate
+        self.backend = backend
+        self.breaker = breaker
+        self.backend_timeout = backend_timeout
+
+        # Idle users and teams are dropped first
+        self._user_buckets: Dict[Tuple[str, str], TokenBucket] = cachetools.LRUCache(maxsize=max_buckets)
+        self._team_buckets: Dict[str, TokenBucket] = cachetools.LRUCache(maxsize=max_buckets)
+
+        # (team_id, user_id) of submissions being processed, and (team_id, user_id, key) of recent ones
+        self._in_flight: Set[Tuple[str, str]] = set()
+        self._recent = cachetools.TTLCache(maxsize=max_buckets, ttl=duplicate_window)
+
+        self.admitted = 0
+        self.duplicates = 0
+        self.throttled = 0
+        self.backend_errors = 0
+
+        metrics.register("submission_throttle", self.stats)
+
+    async def admit(self, team_id: str, user_id: str, key: str) -> str:
+        """
+        ADMITTED, DUPLICATE or THROTTLED. An admitted submission must be followed by done().
+        key identifies what is submitted, e.g. the pasted text.
+        """
+        if (team_id, user_id) in self._in_flight or (team_id, user_id, key) in self._recent:
+            self.duplicates += 1
+            return DUPLICATE
+
+        user_bucket = self._bucket(self._user_buckets, (team_id, user_id), self.user_rate)
+        team_bucket = self._bucket(self._team_buckets, team_id, self.team_rate)
+        if not user_bucket.try_acquire():
+            self.throttled += 1
+            return THROTTLED
+        if not team_bucket.try_acquire():
+            user_bucket.release()
+            self.throttled += 1
+            return THROTTLED
+
+        self._in_flight.add((team_id, user_id))
+        self._recent[(team_id, user_id, key)] = True
+
+        if self.backend is not None and not await self._take_shared(team_id):
+            # Nothing was submitted, so the user can retry once the shared budget allows it
+            self._in_flight.discard((team_id, user_id))
+            self._recent.pop((team_id, user_id, key), None)
+            user_bucket.release()
+            team_bucket.release()
+            self.throttled += 1
+            return THROTTLED
+
+        self.admitted += 1
+        return ADMITTED
+
+    def done(self, team_id: str, user_id: str):
+        self._in_flight.discard((team_id, user_id))
+
+    def stats(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "duplicates": self.duplicates,
+            "throttled": self.throttled,
+            "in_flight": len(self._in_flight),
+            "backend_errors": self.backend_errors,
+        }
+
+    async def _take_shared(self, team_id: str) -> bool:
+        try:
+            if self.breaker is not None:
+                return await self.breaker.call_within(self.backend_timeout, self.backend.take, team_id, int(self.team_rate), 60)
+            return await asyncio.wait_for(self.backend.take(team_id, int(self.team_rate), 60), self.backend_timeout)
+        except Exception as e:
+            # The local buckets still apply, a backend outage mustn't block submissions
+            self.backend_errors += 1
+            log.warning("Skipping the shared submission budget of %s: %s", team_id, e)
+            return True
+
+    @staticmethod
+    def _bucket(buckets: dict, key, rate: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            # Bursts of up to a minute's worth of submissions
+            bucket = TokenBucket(rate=rate / 60, capacity=max(1, rate))
+            buckets[key] = bucket
+        return bucket
@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The stores create their Firestore clients on construction, nothing is read or written by the tests
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "slack-music-tests")
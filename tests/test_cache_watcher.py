@@ -0,0 +1,136 @@
+import asyncio
+
+from cache import CacheConfig
+from cache_watcher import FirestoreCacheWatcher
+from spotify_installation_store import SlackSpotifyInstallationStore
+from weekly_polls_store import SlackMusicWeeklyPollsStore
+
+
+class FakeSnapshot():
+
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeWatch():
+
+    def __init__(self):
+        self.unsubscribed = False
+
+    def unsubscribe(self):
+        self.unsubscribed = True
+
+
+class FakeDocument():
+
+    def __init__(self, db, path: str):
+        self.db = db
+        self.path = path
+
+    def collection(self, name: str):
+        return FakeCollection(self.db, f"{self.path}/{name}")
+
+    def on_snapshot(self, callback):
+        watch = FakeWatch()
+        self.db.listeners[self.path] = (callback, watch)
+        return watch
+
+
+class FakeCollection():
+
+    def __init__(self, db, path: str):
+        self.db = db
+        self.path = path
+
+    def document(self, name: str):
+        return FakeDocument(self.db, f"{self.path}/{name}")
+
+
+class FakeFirestore():
+    """
+    Sync client whose listeners are fired by the test with push().
+    """
+
+    def __init__(self):
+        # document path -> (callback, watch)
+        self.listeners = {}
+
+    def collection(self, path: str):
+        return FakeCollection(self, path)
+
+    def push(self, path: str, data):
+        callback, _ = self.listeners[path]
+        callback([FakeSnapshot(data)], [], None)
+
+
+POLL_PATH = "workspaces/T1/weekly_polls/2024-01-general"
+
+
+def build_watcher():
+    weekly_polls_store = SlackMusicWeeklyPollsStore(cache_config=CacheConfig(ttl=0))
+    spotify_installation_store = SlackSpotifyInstallationStore(cache_config=CacheConfig(ttl=0))
+    db = FakeFirestore()
+    return FirestoreCacheWatcher(weekly_polls_store, spotify_installation_store, db=db), db
+
+
+def test_snapshots_are_pushed_into_pinned_cache_entries():
+    async def scenario():
+        watcher, db = build_watcher()
+        store = watcher.weekly_polls_store
+        cache_key = store._build_cache_key("T1", "2024-01-general")
+
+        watcher.touch("T1", ["2024-01-general"])
+        assert cache_key in store.cache._pinned
+
+        db.push(POLL_PATH, {"poll_id": "2024-01-general", "status": "voting_open"})
+        await asyncio.sleep(0)
+        # Pinned entries never go stale, even with a TTL of 0
+        assert store.cache.get(cache_key)["status"] == "voting_open"
+
+        db.push(POLL_PATH, None)
+        await asyncio.sleep(0)
+        assert store.cache.get(cache_key) is None
+
+    asyncio.run(scenario())
+
+
+def test_moving_and_detaching_watches_unpins_entries():
+    async def scenario():
+        watcher, db = build_watcher()
+        polls_cache = watcher.weekly_polls_store.cache
+        installations_cache = watcher.spotify_installation_store.cache
+
+        watcher.touch("T1", ["2024-01-general"])
+        _, old_watch = db.listeners[POLL_PATH]
+        watcher.touch("T1", ["2024-02-general"])
+        assert old_watch.unsubscribed
+        assert watcher.weekly_polls_store._build_cache_key("T1", "2024-01-general") not in polls_cache._pinned
+        assert watcher.weekly_polls_store._build_cache_key("T1", "2024-02-general") in polls_cache._pinned
+
+        watcher.detach("T1")
+        assert not polls_cache._pinned
+        assert not installations_cache._pinned
+        assert watcher.stats() == {"watched_teams": 0, "watched_polls": 0}
+
+    asyncio.run(scenario())
+
+
+def test_installation_snapshots_replace_the_cached_installation():
+    async def scenario():
+        watcher, db = build_watcher()
+        store = watcher.spotify_installation_store
+
+        watcher.touch("T1", [])
+        db.push("workspaces/T1/spotify_installations/spotify_installation", {"access_token": "a"})
+        await asyncio.sleep(0)
+        assert store.cache.get(store._build_cache_key("T1")) == {"access_token": "a"}
+
+        db.push("workspaces/T1/spotify_installations/spotify_installation", None)
+        await asyncio.sleep(0)
+        assert store.cache.get(store._build_cache_key("T1")) is None
+
+    asyncio.run(scenario())
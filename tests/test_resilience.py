@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from cache import CacheConfig
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, Guarded
+from weekly_polls_store import SlackMusicWeeklyPollsStore
+
+
+class SlowClient():
+    """
+    Client whose calls take delay seconds, longer than the breaker's deadline unless changed.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = 0
+
+    async def fetch(self) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return "fetched"
+
+
+class SlowDocument():
+
+    async def get(self):
+        await asyncio.sleep(1)
+
+
+class SlowCollection():
+
+    def document(self, name: str):
+        return SlowDocument()
+
+
+class SlowFirestore():
+    """
+    Async client whose reads never make the deadline.
+    """
+
+    def collection(self, path: str):
+        return SlowCollection()
+
+
+def test_calls_past_the_deadline_fail_with_deadline_exceeded():
+    async def scenario():
+        breaker = CircuitBreaker("test_deadline", timeout=0.05)
+        client = Guarded(SlowClient(delay=1), breaker)
+
+        with pytest.raises(DeadlineExceeded):
+            await client.fetch()
+        assert breaker.stats()["timeouts"] == 1
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_after_consecutive_failures():
+    async def scenario():
+        breaker = CircuitBreaker("test_open", timeout=0.05, failure_threshold=2)
+        slow_client = SlowClient(delay=1)
+        client = Guarded(slow_client, breaker)
+
+        for _ in range(2):
+            with pytest.raises(DeadlineExceeded):
+                await client.fetch()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # Turned away without calling the client
+        with pytest.raises(CircuitOpenError):
+            await client.fetch()
+        assert slow_client.calls == 2
+        assert breaker.stats()["rejected"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_half_open_breaker_closes_after_a_successful_probe():
+    async def scenario():
+        breaker = CircuitBreaker("test_recovery", timeout=0.05, failure_threshold=1, reset_timeout=0.1)
+        slow_client = SlowClient(delay=1)
+        client = Guarded(slow_client, breaker)
+
+        with pytest.raises(DeadlineExceeded):
+            await client.fetch()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # A failed probe opens the breaker again
+        await asyncio.sleep(0.15)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(DeadlineExceeded):
+            await client.fetch()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        await asyncio.sleep(0.15)
+        slow_client.delay = 0
+        assert await client.fetch() == "fetched"
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert await client.fetch() == "fetched"
+
+    asyncio.run(scenario())
+
+
+def test_expired_polls_are_still_served_as_last_known_values():
+    async def scenario():
+        store = SlackMusicWeeklyPollsStore(cache_config=CacheConfig(ttl=0.05))
+        store.db = SlowFirestore()
+        weekly_polls_store = Guarded(store, CircuitBreaker("test_fallback", timeout=0.05))
+        store.apply_snapshot("T1", "2024-01-general", {"poll_id": "2024-01-general", "category": "general", "status": "voting_open"})
+
+        await asyncio.sleep(0.1)
+        with pytest.raises(DeadlineExceeded):
+            await weekly_polls_store.get_poll("T1", "2024-01-general")
+
+        polls = weekly_polls_store.get_last_known_polls("T1", ["2024-01-general", "2024-02-general"])
+        assert list(polls) == ["2024-01-general"]
+        assert polls["2024-01-general"].status == "voting_open"
+
+    asyncio.run(scenario())
@@ -0,0 +1,66 @@
+from typing import Callable, List, Optional
+
+from google.cloud import firestore
+
+from resilience import CircuitBreaker
+
+
+class UnitOfWork():
+    """
+    Collects writes to several documents, possibly of different stores, and commits them in a
+    single WriteBatch, so they are applied together in one round trip.
+
+    Stores stage their writes with stage_* methods and register how their caches change with
+    after_commit; the callbacks only run once the batch is committed, so a failed commit leaves
+    every cache as it was. With a breaker, the commit is made through it and gets its deadline.
+
+        async with UnitOfWork(db) as unit:
+            weekly_polls_store.stage_vote(unit, team_id, poll, vote)
+            user_store.stage_music_config(unit, team_id, user_id, user)
+    """
+
+    # Firestore limit of writes per batch
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, db: firestore.AsyncClient, breaker: Optional[CircuitBreaker] = None):
+        self.db = db
+        self.breaker = breaker
+        self._batch = db.batch()
+        self._writes = 0
+        self._after_commit: List[Callable[[], None]] = []
+
+    def set(self, doc_ref, fields: dict, merge: bool = True):
+        self._count_write()
+        self._batch.set(doc_ref, fields, merge=merge)
+
+    def create(self, doc_ref, data: dict):
+        self._count_write()
+        self._batch.create(doc_ref, data)
+
+    def delete(self, doc_ref, option=None):
+        self._count_write()
+        self._batch.delete(doc_ref, option=option)
+
+    def after_commit(self, callback: Callable[[], None]):
+        self._after_commit.append(callback)
+
+    async def commit(self):
+        if self._writes:
+            if self.breaker is not None:
+                await self.breaker.call(self._batch.commit)
+            else:
+                await self._batch.commit()
+        for callback in self._after_commit:
+            callback()
+
+    async def __aenter__(self) -> 'UnitOfWork':
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            await self.commit()
+
+    def _count_write(self):
+        if self._writes == self.MAX_BATCH_SIZE:
+            raise ValueError(f"A unit of work can't hold more than {self.MAX_BATCH_SIZE} writes")
+        self._writes += 1
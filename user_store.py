@@ -1,59 +1,138 @@
 import functools
+import os
 from google.cloud import firestore
 from typing import Optional
 from slack_sdk.oauth.installation_store.async_installation_store import AsyncInstallationStore
 from slack_sdk.oauth.installation_store.models import Installation
-import cachetools
-from models.users import User
+from cache import CacheConfig, StoreCache
+from models.users import User, UserSummary
+from unit_of_work import UnitOfWork
+from write_behind import WriteBehindBuffer, deep_merge
 
 
+# Music config fields only kept as history, never checked by a handler, so they are written behind
+WRITE_BEHIND_FIELDS = ("submissions",)
+
 
 class SlackMusicUserStore():
 
-    def __init__(self):
+    def __init__(self, cache_config: Optional[CacheConfig] = None):
         # Initialize Firestore client
         self.db = firestore.AsyncClient()
 
-        self.cache = cachetools.TTLCache(maxsize=128, ttl=300)
+        # Only compact UserSummary projections are cached, so far more users fit than the other stores
+        self.cache = StoreCache("users", cache_config or CacheConfig.from_env("users", maxsize=4096, ttl=300))
+
+        # Buffer for low-priority user updates, committed in batches off the critical path
+        self.write_behind = WriteBehindBuffer(self.db, flush_interval=float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0")))
 
     async def get_user(self, team_id: str, user_id: str) -> Optional[User]:
         """
-        Get a user's data from Firestore using user_id.
+        Get a user's full Slack profile from Firestore using user_id.
         # /workspaces/{team_id}/users/{user_id}
+        Full profiles are not cached, use get_user_summary on hot paths.
+        """
+        doc = await self.db.collection(f"workspaces/{team_id}/users").document(user_id).get()
+        if doc.exists:
+            user = User(**self._with_pending_writes(team_id, user_id, doc.to_dict()))
+            self._add_to_cache(self._build_cache_key(team_id, user_id), user.to_summary())
+            return user
+        return None
+
+    async def get_user_summary(self, team_id: str, user_id: str) -> Optional[UserSummary]:
+        """
+        Get the compact projection of a user, checking the cache first.
+        On a miss only the summary fields are read from Firestore.
         """
         cache_key = self._build_cache_key(team_id, user_id)
-        cache_user = self._get_from_cache(cache_key)
-        if cache_user:
-            return User(**cache_user)
+        cached_summary = self._get_from_cache(cache_key)
+        if cached_summary:
+            return cached_summary
 
-        doc = await self.db.collection(f"workspaces/{team_id}/users").document(user_id).get()
+        doc = await self.db.collection(f"workspaces/{team_id}/users").document(user_id).get(field_paths=UserSummary.FIELD_PATHS)
         if doc.exists:
-            self._add_to_cache(cache_key, doc.to_dict())
-            return User(**doc.to_dict())
+            summary = UserSummary.from_document(self._with_pending_writes(team_id, user_id, doc.to_dict()))
+            self._add_to_cache(cache_key, summary)
+            return summary
         return None
 
+    def get_last_known_user_summary(self, team_id: str, user_id: str) -> Optional[UserSummary]:
+        """
+        The cached summary of a user, however old, without reading Firestore.
+        """
+        return self.cache.get_last_known(self._build_cache_key(team_id, user_id))
+
     async def save_user(self, team_id: str, user_id: str, user: User):
         """
-        Save a user's data in Firestore using user_id.
+        Save a user's full data in Firestore using user_id.
         """
         user_data = user.model_dump(mode='json')
         await self.db.collection(f"workspaces/{team_id}/users").document(user_id).set(user_data)
+        self.write_behind.discard(team_id, self._build_doc_path(team_id, user_id))
         cache_key = self._build_cache_key(team_id, user_id)
-        self.cache[cache_key] = user_data
+        self._add_to_cache(cache_key, user.to_summary())
+
+    async def save_music_config(self, team_id: str, user_id: str, user: UserSummary):
+        """
+        Save only the slack_music_config of a user, leaving the Slack profile untouched.
+        """
+        async with UnitOfWork(self.db) as unit:
+            self.stage_music_config(unit, team_id, user_id, user)
+
+    def stage_music_config(self, unit: UnitOfWork, team_id: str, user_id: str, user: UserSummary):
+        """
+        Stage the write of a user's slack_music_config, to be committed with other documents.
+        The history fields (WRITE_BEHIND_FIELDS) are left out of the unit. Once it is committed they
+        are buffered and the cache is updated with the whole config, so reads in this process see
+        them before the buffer is flushed.
+        """
+        doc_path = self._build_doc_path(team_id, user_id)
+        music_config = user.slack_music_config.model_dump(mode='json')
+        history = {field: music_config.pop(field) for field in WRITE_BEHIND_FIELDS}
+        unit.set(self.db.document(doc_path), {"slack_music_config": music_config})
+
+        def apply():
+            self.write_behind.enqueue(team_id, doc_path, {"slack_music_config": history})
+            self._add_to_cache(self._build_cache_key(team_id, user_id), user)
+
+        unit.after_commit(apply)
+
+    async def warm_up(self, team_id: str) -> int:
+        """
+        Preload the summaries of a team's users into the cache, up to the cache capacity.
+        Returns the number of users loaded.
+        """
+        query = self.db.collection(f"workspaces/{team_id}/users").select(UserSummary.FIELD_PATHS).limit(self.cache.capacity)
+        loaded = 0
+        async for doc in query.stream():
+            self._add_to_cache(self._build_cache_key(team_id, doc.id), UserSummary.from_document(doc.to_dict()))
+            loaded += 1
+        return loaded
+
+    def _with_pending_writes(self, team_id: str, user_id: str, user_data: dict) -> dict:
+        """
+        Overlay buffered, not yet committed updates on a document read from Firestore.
+        """
+        pending = self.write_behind.pending(team_id, self._build_doc_path(team_id, user_id))
+        return deep_merge(user_data, pending) if pending else user_data
+
+    def _build_doc_path(self, team_id: str, user_id: str) -> str:
+        return f"workspaces/{team_id}/users/{user_id}"
 
     ### Cache Layer ###
 
-    def _get_from_cache(self, cache_key: str) -> Optional[dict]:
+    def _get_from_cache(self, cache_key: str) -> Optional[UserSummary]:
         """
-        Retrieve an installation's JSON data from the in-memory cache using cachetools.TTLCache.
+        Retrieve a user summary from the in-memory cache.
+        Summaries are frozen, so the cached instance is returned as is.
         """
         return self.cache.get(cache_key)
 
-    def _add_to_cache(self, cache_key: str, installation_json: dict):
+    def _add_to_cache(self, cache_key: str, user_summary: UserSummary):
         """
-        Add an installation's JSON data to the in-memory cache using cachetools.TTLCache.
+        Add a user summary to the in-memory cache.
         """
-        self.cache[cache_key] = installation_json
+        self.cache.set(cache_key, user_summary)
 
     def _build_cache_key(self, team_id: str, user_id: str) -> str:
         """
@@ -1,83 +1,367 @@
+import asyncio
 import functools
+import logging
+import random
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
-from typing import Optional
+from google.cloud.firestore_v1.field_path import FieldPath
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from slack_sdk.oauth.installation_store.async_installation_store import AsyncInstallationStore
 from slack_sdk.oauth.installation_store.models import Installation
-import cachetools
-from models.weekly_polls import WeeklyPoll, SongInfo
+from cache import CacheConfig, SingleFlight, StoreCache
+from models.weekly_polls import WeeklyPoll, SongFeatures, SongInfo, VoteInfo
+from unit_of_work import UnitOfWork
 
 
+log = logging.getLogger(__name__)
+
 
 class SlackMusicWeeklyPollsStore():
 
-    def __init__(self):
+    def __init__(self, cache_config: Optional[CacheConfig] = None):
         # Initialize Firestore client
         self.db = firestore.AsyncClient()
 
-        self.cache = cachetools.TTLCache(maxsize=128, ttl=300)
+        # Polls are served stale for up to max_stale seconds while they are refreshed in the background
+        self.cache = StoreCache("weekly_polls", cache_config or CacheConfig.from_env("weekly_polls", maxsize=128, ttl=300, max_stale=60))
+
+        # Single-flight loads, so concurrent misses for a hot poll share one Firestore read
+        self._loads = SingleFlight()
+
+        # Bumped on every save, so a load that started before a save doesn't overwrite it in the cache
+        self._write_versions: Dict[str, int] = {}
+
+        # (team_id, poll_id) of sharded polls whose vote_counts are behind their counter shards
+        self._unsummarized: Set[Tuple[str, str]] = set()
 
     async def get_poll(self, team_id:str, poll_id: str) -> Optional[WeeklyPoll]:
         # /workspaces/{team_id}/weekly_polls/{poll_id}
 
         cache_key = self._build_cache_key(team_id, poll_id)
-        cached_poll = self._get_from_cache(cache_key)
+        cached_poll, fresh = self.cache.get_stale(cache_key)
         if cached_poll:
+            if not fresh:
+                # Stale-while-revalidate: serve the cached poll and refresh it in the background
+                self._loads.start(cache_key, lambda: self._load_poll(team_id, poll_id))
             return WeeklyPoll(**cached_poll)
 
-        doc = await self.db.collection(f"workspaces/{team_id}/weekly_polls").document(poll_id).get()
-        if doc.exists:
-            self._add_to_cache(cache_key, doc.to_dict())
-            return WeeklyPoll(**doc.to_dict())
+        poll_data = await self._loads.do(cache_key, lambda: self._load_poll(team_id, poll_id))
+        if poll_data:
+            return WeeklyPoll(**poll_data)
         return None
 
-    async def save_poll(self, team_id: str, poll: WeeklyPoll):
+    async def get_polls(self, team_id: str, poll_ids: List[str]) -> Dict[str, WeeklyPoll]:
+        """
+        Get several polls of a team, the ones not cached are read in a single batched get_all.
+        Polls that don't exist are left out.
+        """
+        polls: Dict[str, WeeklyPoll] = {}
+        missing_poll_ids = []
+        for poll_id in poll_ids:
+            cache_key = self._build_cache_key(team_id, poll_id)
+            cached_poll, fresh = self.cache.get_stale(cache_key)
+            if not cached_poll:
+                missing_poll_ids.append(poll_id)
+                continue
+            if not fresh:
+                # Stale-while-revalidate, like get_poll
+                self._loads.start(cache_key, functools.partial(self._load_poll, team_id, poll_id))
+            polls[poll_id] = WeeklyPoll(**cached_poll)
+
+        if missing_poll_ids:
+            versions = {poll_id: self._write_versions.get(self._build_cache_key(team_id, poll_id), 0) for poll_id in missing_poll_ids}
+            async for doc in self.db.get_all([self._poll_ref(team_id, poll_id) for poll_id in missing_poll_ids]):
+                if not doc.exists:
+                    continue
+                cache_key = self._build_cache_key(team_id, doc.id)
+                if self._write_versions.get(cache_key, 0) != versions[doc.id]:
+                    # Saved by this process while reading, the cached poll is newer
+                    continue
+                poll_data = doc.to_dict()
+                self._add_to_cache(cache_key, poll_data)
+                polls[doc.id] = WeeklyPoll(**poll_data)
+        return polls
+
+    def get_last_known_polls(self, team_id: str, poll_ids: List[str]) -> Dict[str, WeeklyPoll]:
+        """
+        The cached polls among the given ones, however old, without reading Firestore.
+        """
+        polls: Dict[str, WeeklyPoll] = {}
+        for poll_id in poll_ids:
+            poll_data = self.cache.get_last_known(self._build_cache_key(team_id, poll_id))
+            if poll_data:
+                polls[poll_id] = WeeklyPoll(**poll_data)
+        return polls
+
+    async def get_or_create_poll(self, team_id: str, poll_id: str, factory: Callable[[], WeeklyPoll]) -> WeeklyPoll:
+        """
+        Get a poll, creating it with factory if it doesn't exist yet.
+        Concurrent callers for a missing poll share a single creation.
+        """
+        poll = await self.get_poll(team_id, poll_id)
+        if poll is not None:
+            return poll
+
+        async def create() -> dict:
+            poll = await self.get_poll(team_id, poll_id)
+            if poll is not None:
+                return poll.model_dump(mode='json')
+            return await self._create_poll(team_id, factory())
+
+        cache_key = self._build_cache_key(team_id, poll_id)
+        return WeeklyPoll(**await self._loads.do(("create", cache_key), create))
+
+    async def _create_poll(self, team_id: str, poll: WeeklyPoll) -> dict:
+        """
+        Create a poll document unless another process created it first, returns the stored poll.
+        Only one creation wins, so a vote or submission made on the first poll isn't overwritten.
+        """
         # /workspaces/{team_id}/weekly_polls/{poll_id}
+        poll_ref = self._poll_ref(team_id, poll.poll_id)
         poll_data = poll.model_dump(mode='json')
-        await self.db.collection(f"workspaces/{team_id}/weekly_polls").document(poll.poll_id).set(poll_data)
+        try:
+            await poll_ref.create(poll_data)
+        except AlreadyExists:
+            poll_data = (await poll_ref.get()).to_dict()
         cache_key = self._build_cache_key(team_id, poll.poll_id)
+        self._write_versions[cache_key] = self._write_versions.get(cache_key, 0) + 1
         self._add_to_cache(cache_key, poll_data)
+        return poll_data
+
+    def apply_snapshot(self, team_id: str, poll_id: str, poll_data: Optional[dict]):
+        """
+        Push a poll received from a Firestore listener into the cache.
+        The snapshot is authoritative, so in-flight loads must not overwrite it.
+        """
+        cache_key = self._build_cache_key(team_id, poll_id)
+        self._write_versions[cache_key] = self._write_versions.get(cache_key, 0) + 1
+        if poll_data is None:
+            self.cache.pop(cache_key)
+        else:
+            self._add_to_cache(cache_key, poll_data)
+
+    def pin(self, team_id: str, poll_id: str):
+        self.cache.pin(self._build_cache_key(team_id, poll_id))
+
+    def unpin(self, team_id: str, poll_id: str):
+        self.cache.unpin(self._build_cache_key(team_id, poll_id))
+
+    def _update_cached_poll(self, team_id: str, poll: WeeklyPoll):
+        cache_key = self._build_cache_key(team_id, poll.poll_id)
+        self._write_versions[cache_key] = self._write_versions.get(cache_key, 0) + 1
+        self._add_to_cache(cache_key, poll.model_dump(mode='json'))
+
+    def _poll_ref(self, team_id: str, poll_id: str):
+        return self.db.collection(f"workspaces/{team_id}/weekly_polls").document(poll_id)
+
+    def _random_shard_ref(self, poll_ref, poll: WeeklyPoll):
+        # Any shard can take any increment, only their sum is meaningful
+        return poll_ref.collection("vote_shards").document(str(random.randrange(poll.vote_shards)))
+
+    async def _load_poll(self, team_id: str, poll_id: str) -> Optional[dict]:
+        """
+        Read a poll from Firestore and cache it, unless it was saved in the meantime.
+        """
+        cache_key = self._build_cache_key(team_id, poll_id)
+        version = self._write_versions.get(cache_key, 0)
+
+        doc = await self.db.collection(f"workspaces/{team_id}/weekly_polls").document(poll_id).get()
+        if self._write_versions.get(cache_key, 0) != version:
+            # A save from this process is newer than what we just read
+            return self.cache.get_stale(cache_key)[0]
+
+        if doc.exists:
+            poll_data = doc.to_dict()
+            self._add_to_cache(cache_key, poll_data)
+            return poll_data
+        return None
 
-    async def cast_vote(self, team_id: str, poll_id: str, song_id: str, user_id: str):
-        # Reference to the weekly poll
-        poll_ref = self.db.collection(f"workspaces/{team_id}/weekly_polls").document(poll_id)
+    def stage_vote(self, unit: UnitOfWork, team_id: str, poll: WeeklyPoll, vote: VoteInfo) -> bool:
+        """
+        Stage a vote, returns False if the user already voted in the poll.
+        Polls with vote_shards keep each vote in the votes subcollection and count it on a random
+        counter shard, so voting doesn't contend on the poll document; the commit fails with
+        AlreadyExists if the user's vote is already there. Other polls get the vote merged into
+        their votes map.
+        """
+        poll_ref = self._poll_ref(team_id, poll.poll_id)
+        vote_data = vote.model_dump(mode='json')
+
+        if poll.vote_shards:
+            # /workspaces/{team_id}/weekly_polls/{poll_id}/votes/{user_id}
+            # /workspaces/{team_id}/weekly_polls/{poll_id}/vote_shards/{shard}
+            unit.create(poll_ref.collection("votes").document(vote.voted_by), vote_data)
+            unit.set(self._random_shard_ref(poll_ref, poll), {"counts": {vote.voted_for: firestore.Increment(1)}})
+        else:
+            if vote.voted_by in poll.votes:
+                return False
+            unit.set(poll_ref, {"votes": {vote.voted_by: vote_data}})
+
+        def apply():
+            if poll.vote_shards:
+                poll.vote_counts[vote.voted_for] = poll.vote_counts.get(vote.voted_for, 0) + 1
+                self._unsummarized.add((team_id, poll.poll_id))
+            else:
+                poll.votes[vote.voted_by] = vote
+            self._update_cached_poll(team_id, poll)
+
+        unit.after_commit(apply)
+        return True
+
+    async def stage_retract_vote(self, unit: UnitOfWork, team_id: str, poll: WeeklyPoll, user_id: str) -> Optional[VoteInfo]:
+        """
+        Stage the removal of a user's vote, returns the vote or None if the user hasn't voted.
+        """
+        poll_ref = self._poll_ref(team_id, poll.poll_id)
+
+        if poll.vote_shards:
+            vote_ref = poll_ref.collection("votes").document(user_id)
+            vote_doc = await vote_ref.get()
+            if not vote_doc.exists:
+                return None
+            vote = VoteInfo(**vote_doc.to_dict())
 
-        # Firestore transaction to ensure atomic vote count increment
-        @firestore.transactional
-        def increment_vote(transaction, poll_ref):
-            # Read poll document in the transaction
-            poll_snapshot = poll_ref.get(transaction=transaction)
+            # Deleted only if unchanged since it was read, so a vote is never uncounted twice
+            unit.delete(vote_ref, option=self.db.write_option(last_update_time=vote_doc.update_time))
+            unit.set(self._random_shard_ref(poll_ref, poll), {"counts": {vote.voted_for: firestore.Increment(-1)}})
+        else:
+            vote = poll.votes.get(user_id)
+            if vote is None:
+                return None
+            unit.set(poll_ref, {"votes": {user_id: firestore.DELETE_FIELD}})
 
-            # Update vote counts
-            vote_counts = poll_snapshot.get('vote_counts', {})
-            if song_id in vote_counts:
-                vote_counts[song_id] += 1
+        def apply():
+            if poll.vote_shards:
+                poll.vote_counts[vote.voted_for] = max(poll.vote_counts.get(vote.voted_for, 0) - 1, 0)
+                self._unsummarized.add((team_id, poll.poll_id))
             else:
-                vote_counts[song_id] = 1
+                poll.votes.pop(user_id, None)
+            self._update_cached_poll(team_id, poll)
+
+        unit.after_commit(apply)
+        return vote
+
+    def stage_song(self, unit: UnitOfWork, team_id: str, poll: WeeklyPoll, song_info: SongInfo):
+        """
+        Stage the submission of a song to the poll.
+        """
+        unit.set(self._poll_ref(team_id, poll.poll_id), {"songs": {song_info.id: song_info.model_dump(mode='json')}})
+
+        def apply():
+            poll.songs[song_info.id] = song_info
+            self._update_cached_poll(team_id, poll)
+
+        unit.after_commit(apply)
+
+    def stage_remove_song(self, unit: UnitOfWork, team_id: str, poll: WeeklyPoll, song_id: str) -> Optional[SongInfo]:
+        """
+        Stage the removal of a submitted song, returns the song or None if it isn't in the poll.
+        """
+        song_info = poll.songs.get(song_id)
+        if song_info is None:
+            return None
+        unit.set(self._poll_ref(team_id, poll.poll_id), {"songs": {song_id: firestore.DELETE_FIELD}})
+
+        def apply():
+            poll.songs.pop(song_id, None)
+            self._update_cached_poll(team_id, poll)
 
-            # Write the updated vote counts back
-            transaction.update(poll_ref, {'vote_counts': vote_counts})
+        unit.after_commit(apply)
+        return song_info
 
-        # Start the transaction
-        transaction = self.db.transaction()
-        await increment_vote(transaction, poll_ref)
+    def stage_status(self, unit: UnitOfWork, team_id: str, poll: WeeklyPoll):
+        """
+        Stage a change of the poll's status.
+        Only the status is written, so votes and songs saved meanwhile by other processes are kept.
+        """
+        unit.set(self._poll_ref(team_id, poll.poll_id), {"status": poll.status})
+        unit.after_commit(functools.partial(self._update_cached_poll, team_id, poll))
+
+    async def save_song_features(self, team_id: str, poll_id: str, features: Dict[str, SongFeatures]) -> List[str]:
+        """
+        Store the enrichment of songs of a poll, returns the IDs of the songs updated.
+        Songs withdrawn in the meantime are skipped, and the write only goes through if the poll
+        is unchanged since it was read, so it never brings a withdrawn song back.
+        """
+        poll_ref = self._poll_ref(team_id, poll_id)
+        doc = await poll_ref.get()
+        if not doc.exists:
+            return []
+        songs = doc.to_dict().get("songs") or {}
+        features = {song_id: song_features for song_id, song_features in features.items() if song_id in songs}
+        if not features:
+            return []
+
+        await poll_ref.update(
+            {
+                FieldPath("songs", song_id, "features").to_api_repr(): song_features.model_dump(mode='json')
+                for song_id, song_features in features.items()
+            },
+            option=self.db.write_option(last_update_time=doc.update_time),
+        )
+
+        cache_key = self._build_cache_key(team_id, poll_id)
+        cached_poll = self.cache.get_stale(cache_key)[0]
+        if cached_poll:
+            cached_songs = {
+                song_id: {**song, "features": features[song_id].model_dump(mode='json')} if song_id in features else song
+                for song_id, song in cached_poll.get("songs", {}).items()
+            }
+            self._write_versions[cache_key] = self._write_versions.get(cache_key, 0) + 1
+            self._add_to_cache(cache_key, {**cached_poll, "songs": cached_songs})
+        return list(features)
+
+    async def summarize_votes(self, team_id: str, poll_id: str) -> Dict[str, int]:
+        """
+        Roll the counter shards of a sharded poll up into its vote_counts.
+        """
+        poll_ref = self._poll_ref(team_id, poll_id)
+
+        vote_counts: Dict[str, int] = {}
+        async for shard in poll_ref.collection("vote_shards").stream():
+            for song_id, count in (shard.to_dict().get("counts") or {}).items():
+                vote_counts[song_id] = vote_counts.get(song_id, 0) + count
+        vote_counts = {song_id: count for song_id, count in vote_counts.items() if count > 0}
+
+        await poll_ref.update({"vote_counts": vote_counts})
+
+        cache_key = self._build_cache_key(team_id, poll_id)
+        cached_poll = self.cache.get_stale(cache_key)[0]
+        if cached_poll:
+            self._write_versions[cache_key] = self._write_versions.get(cache_key, 0) + 1
+            self._add_to_cache(cache_key, {**cached_poll, "vote_counts": vote_counts})
+        return vote_counts
+
+    async def summarize_pending(self):
+        """
+        Summarize the sharded polls that got votes since the last summary.
+        """
+        pending, self._unsummarized = self._unsummarized, set()
+        for team_id, poll_id in pending:
+            try:
+                await self.summarize_votes(team_id, poll_id)
+            except Exception as e:
+                log.error("Error summarizing votes of %s/%s: %s", team_id, poll_id, e)
+                self._unsummarized.add((team_id, poll_id))
 
-        # Optionally, record the user's vote
-        vote_ref = poll_ref.collection('votes').document(user_id)
-        vote_ref.set({'song_voted_for': song_id, 'voted_at': firestore.SERVER_TIMESTAMP})
+    async def run_summarizer(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.summarize_pending()
 
     ### Cache Layer ###
 
     def _get_from_cache(self, cache_key: str) -> Optional[dict]:
         """
-        Retrieve an installation's JSON data from the in-memory cache using cachetools.TTLCache.
+        Retrieve an installation's JSON data from the in-memory cache.
         """
         return self.cache.get(cache_key)
 
     def _add_to_cache(self, cache_key: str, installation_json: dict):
         """
-        Add an installation's JSON data to the in-memory cache using cachetools.TTLCache.
+        Add an installation's JSON data to the in-memory cache.
         """
-        self.cache[cache_key] = installation_json
+        self.cache.set(cache_key, installation_json)
 
     def _build_cache_key(self, team_id: str, poll_id: str) -> str:
         """
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from google.cloud import firestore
+
+
+log = logging.getLogger(__name__)
+
+
+def deep_merge(base: dict, changes: dict) -> dict:
+    """
+    Return a copy of base with changes merged in, nested dicts are merged key by key.
+    This mirrors how Firestore applies set(..., merge=True).
+    """
+    merged = dict(base)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class WriteBehindBuffer():
+    """
+    Buffers low-priority document updates and commits them later, batched per team.
+
+    Updates to the same document are merged while they wait, and every flush_interval seconds
+    each team's pending updates are written with set(..., merge=True) in WriteBatch commits of
+    at most 500 writes. Callers keep read-your-writes within the process by overlaying
+    pending(doc_path) on what they read from Firestore.
+    """
+
+    # Firestore limit of writes per batch
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, db: firestore.AsyncClient, flush_interval: float = 1.0):
+        self.db = db
+        self.flush_interval = flush_interval
+
+        # team_id -> document path -> fields to merge into the document
+        self._pending: Dict[str, Dict[str, dict]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._closed = asyncio.Event()
+
+    def enqueue(self, team_id: str, doc_path: str, fields: dict):
+        team_pending = self._pending.setdefault(team_id, {})
+        team_pending[doc_path] = deep_merge(team_pending.get(doc_path, {}), fields)
+
+    def pending(self, team_id: str, doc_path: str) -> Optional[dict]:
+        """
+        Fields queued for a document and not yet committed.
+        """
+        return self._pending.get(team_id, {}).get(doc_path)
+
+    def discard(self, team_id: str, doc_path: str):
+        """
+        Drop the queued fields of a document, used when a synchronous write supersedes them.
+        """
+        self._pending.get(team_id, {}).pop(doc_path, None)
+
+    async def flush(self):
+        """
+        Commit every pending update. Updates that fail to commit are queued again,
+        under anything enqueued for the same document in the meantime.
+        """
+        pending, self._pending = self._pending, {}
+        for team_id, team_pending in pending.items():
+            writes = list(team_pending.items())
+            for start in range(0, len(writes), self.MAX_BATCH_SIZE):
+                chunk = writes[start:start + self.MAX_BATCH_SIZE]
+                batch = self.db.batch()
+                for doc_path, fields in chunk:
+                    batch.set(self.db.document(doc_path), fields, merge=True)
+                try:
+                    await batch.commit()
+                except Exception as e:
+                    log.error("Error flushing %d buffered writes for %s: %s", len(chunk), team_id, e)
+                    for doc_path, fields in chunk:
+                        newer = self.pending(team_id, doc_path) or {}
+                        self._pending.setdefault(team_id, {})[doc_path] = deep_merge(fields, newer)
+
+    async def run(self):
+        while not self._closed.is_set():
+            try:
+                await asyncio.wait_for(self._closed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """
+        Stop the periodic flush and commit whatever is still pending.
+        The flush loop is stopped rather than cancelled, so a commit in progress is not lost.
+        """
+        self._closed.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        else:
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {"pending_writes": sum(len(team_pending) for team_pending in self._pending.values())}